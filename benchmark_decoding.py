@@ -0,0 +1,102 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from benchmark_edge_policies import INPUT_VOCAB_SIZE, TARGET_VOCAB_SIZE, random_commands, random_situations
+from dataloader import Batch, dataloader, memmap_dataloader
+from dataset_cache import cached_dataloader
+from model.config import cfg
+from model.model import GSCAN_model
+from model.utils import beam_search_decode, greedy_decode
+
+# Latency per example of greedy decoding and of beam search with every --beam_sizes, on the batches of a split
+# decoded by a trained model, or on random worlds and commands decoded by an untrained one (which rarely emits <eos>,
+# so every example takes --max_decoding_steps steps):
+#   python benchmark_decoding.py --beam_sizes 1 4 8
+#   python benchmark_decoding.py --data_path data/parsed_dataset/dev.json --checkpoint exp/model_best.pth.tar
+
+logger = logging.getLogger(__name__)
+
+PAD_IDX, SOS_IDX, EOS_IDX = 1, 2, 3
+
+
+def random_batches(batch_size, num_batches, device):
+    batches = []
+    for _ in range(num_batches):
+        commands, lengths = random_commands(batch_size)
+        situations = random_situations(batch_size, 6, 12)
+        batches.append(Batch(input=(commands.to(device), lengths.to(device)), target=None,
+                             situation=situations.to(device)))
+    return batches
+
+
+def benchmark(model, batches, beam_size, max_decoding_steps, pad_idx, sos_idx, eos_idx):
+    """:return: seconds per example and mean number of decoded tokens per example"""
+    elapsed, num_examples, num_tokens = 0., 0, 0
+    with torch.no_grad():
+        for i, batch in enumerate(batches):
+            start = time.time()
+            if beam_size > 1:
+                output_tokens = beam_search_decode(model, batch.input, batch.situation, max_decoding_steps, pad_idx,
+                                                   sos_idx, eos_idx, beam_size=beam_size,
+                                                   length_normalization=cfg.TEST.LENGTH_NORMALIZATION)[0]
+            else:
+                output_tokens = greedy_decode(model, batch.input, batch.situation, max_decoding_steps, pad_idx,
+                                              sos_idx, eos_idx)[0]
+            if output_tokens.is_cuda:
+                torch.cuda.synchronize()
+            if i > 0:  # the first batch warms up caches and allocators
+                elapsed += time.time() - start
+                num_examples += output_tokens.size(0)
+                num_tokens += int(output_tokens[:, 1:].ne(pad_idx).sum())
+    return elapsed / num_examples, num_tokens / num_examples
+
+
+def main(flags):
+    use_cuda = torch.cuda.is_available() and not flags.cpu
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    if flags.data_path:
+        load_data = {"json": dataloader, "memmap": memmap_dataloader, "cached": cached_dataloader}[cfg.DATA_FORMAT]
+        data_iter, input_vocab, target_vocab = load_data(flags.data_path, batch_size=flags.batch_size,
+                                                         use_cuda=use_cuda, random_shuffle=False,
+                                                         sparse_situations=cfg.SPARSE_SITUATIONS)
+        pad_idx, sos_idx, eos_idx = target_vocab.stoi['<pad>'], target_vocab.stoi['<sos>'], target_vocab.stoi['<eos>']
+        model = GSCAN_model(pad_idx, eos_idx, len(input_vocab.itos), len(target_vocab.itos))
+        batches = [batch for _, batch in zip(range(flags.num_batches + 1), data_iter)]
+    else:
+        pad_idx, sos_idx, eos_idx = PAD_IDX, SOS_IDX, EOS_IDX
+        model = GSCAN_model(pad_idx, eos_idx, INPUT_VOCAB_SIZE, TARGET_VOCAB_SIZE)
+        batches = random_batches(flags.batch_size, flags.num_batches + 1, device)
+    model = model.to(device)
+    model.device = device
+    if flags.checkpoint:
+        model.load_model(flags.checkpoint)
+    model.eval()
+
+    reference = None
+    for beam_size in flags.beam_sizes:
+        seconds, tokens = benchmark(model, batches, beam_size, flags.max_decoding_steps, pad_idx, sos_idx, eos_idx)
+        reference = reference or seconds
+        logger.info("{:>6s} {:2d}: {:7.3f} ms per example ({:5.2f}x greedy), {:5.1f} tokens per example".format(
+            "beam" if beam_size > 1 else "greedy", beam_size, 1000 * seconds, seconds / reference, tokens))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency of greedy decoding and beam search")
+    parser.add_argument('--beam_sizes', type=int, nargs='*', default=[1, 4, 8],
+                        help='1 is greedy decoding, the first size is the reference.')
+    parser.add_argument('--data_path', type=str, default='',
+                        help='Split to decode, random worlds and commands when not given.')
+    parser.add_argument('--checkpoint', type=str, default='')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--max_decoding_steps', type=int, default=cfg.TEST.MAX_DECODING_STEP)
+    parser.add_argument('--cpu', action='store_true', help='Benchmark on CPU even if CUDA is available.')
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    np.random.seed(0)
+    torch.manual_seed(0)
+    main(args)
@@ -0,0 +1,96 @@
+import argparse
+import logging
+import os
+import socket
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from benchmark_edge_policies import INPUT_VOCAB_SIZE, TARGET_VOCAB_SIZE, random_commands, random_situations
+from model.config import cfg
+from model.model import GSCAN_model
+
+# Training throughput of the data-parallel training of main_model.py (DistributedDataParallel over gloo) with every
+# --num_processes local processes, on random worlds, commands and targets, and its scaling efficiency: the throughput
+# with n processes divided by n times the throughput with the first number of processes. Every process gets
+# --threads_per_process threads, by default the cores divided by the largest number of processes:
+#   python benchmark_distributed.py --num_processes 1 2 4 8
+
+logger = logging.getLogger(__name__)
+
+PAD_IDX, SOS_IDX, EOS_IDX = 1, 2, 3
+
+
+def random_targets(batch_size, max_length=12):
+    """:return: [batch_size, max_length + 2] <sos> ... <eos> action sequences padded with <pad>, and their lengths"""
+    lengths = torch.randint(1, max_length + 1, (batch_size,)) + 2
+    targets = torch.randint(EOS_IDX + 1, TARGET_VOCAB_SIZE, (batch_size, int(lengths.max())))
+    positions = torch.arange(targets.size(1))[None, :]
+    targets[:, 0] = SOS_IDX
+    targets[positions == lengths[:, None] - 1] = EOS_IDX
+    targets.masked_fill_(positions >= lengths[:, None], PAD_IDX)
+    return targets, lengths
+
+
+def train_steps(rank, world_size, port, flags, results):
+    torch.set_num_threads(flags.threads_per_process)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+    np.random.seed(rank)
+    model = GSCAN_model(PAD_IDX, EOS_IDX, INPUT_VOCAB_SIZE, TARGET_VOCAB_SIZE, is_baseline=flags.baseline)
+    training_model = DistributedDataParallel(model, find_unused_parameters=True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=cfg.TRAIN.SOLVER.LR)
+    batches = [(random_commands(flags.batch_size), random_situations(flags.batch_size, 6, 12),
+                random_targets(flags.batch_size)) for _ in range(flags.num_steps + 1)]
+    model.train()
+    elapsed = 0.
+    for i, (commands, situations, targets) in enumerate(batches):
+        start = time.time()
+        target_scores, _ = training_model(commands, situations, targets)
+        model.get_loss(target_scores, targets[0]).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if i > 0:  # the first step warms up caches, allocators and the gradient buckets
+            elapsed += time.time() - start
+    elapsed = torch.tensor(elapsed)
+    dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)
+    if rank == 0:
+        results.put(world_size * flags.batch_size * flags.num_steps / float(elapsed))
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main(flags):
+    flags.threads_per_process = flags.threads_per_process or max(1, (os.cpu_count() or 1) // max(flags.num_processes))
+    context = mp.get_context('spawn')
+    reference = None
+    for num_processes in flags.num_processes:
+        results = context.SimpleQueue()
+        mp.spawn(train_steps, args=(num_processes, free_port(), flags, results), nprocs=num_processes)
+        examples_per_second = results.get()
+        reference = reference or examples_per_second / num_processes
+        logger.info("{:3d} processes x {:2d} threads: {:8.1f} examples/s, scaling efficiency {:5.1f}%".format(
+            num_processes, flags.threads_per_process, examples_per_second,
+            100. * examples_per_second / (num_processes * reference)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scaling of data-parallel training over local processes")
+    parser.add_argument('--num_processes', type=int, nargs='*', default=[1, 2, 4],
+                        help='Numbers of processes to train with, the first one is the reference.')
+    parser.add_argument('--threads_per_process', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=cfg.TRAIN.BATCH_SIZE, help='Examples per process and step.')
+    parser.add_argument('--num_steps', type=int, default=20)
+    parser.add_argument('--baseline', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    main(args)
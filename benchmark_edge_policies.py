@@ -0,0 +1,136 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from dataloader import dataloader, memmap_dataloader
+from dataset_cache import cached_dataloader
+from model.config import cfg
+from model.gnn import EdgePolicy
+from model.model import GSCAN_model
+from model.situation import SITUATION_CATEGORIES, situation_features
+from model.utils import evaluate
+
+# Compares the LGCN edge policies (see EdgePolicy in model/gnn.py) with the complete graph:
+#   throughput of the situation encoder (forward and backward) on random worlds of every --grid_sizes, and
+#   accuracy / exact match on a split for models trained with each policy (--checkpoint POLICY=PATH, repeatable):
+#   python benchmark_edge_policies.py --grid_sizes 6 12 24
+#   python benchmark_edge_policies.py --data_path data/parsed_dataset/dev.json --checkpoint complete=exp/a.pth \
+#       --checkpoint knn=exp/b.pth
+
+logger = logging.getLogger(__name__)
+
+INPUT_VOCAB_SIZE = 20
+TARGET_VOCAB_SIZE = 10
+
+
+def random_situations(batch_size, grid_size, max_objects):
+    """:return: [batch_size, grid_size, grid_size, 16] worlds of 1 to max_objects objects and an agent"""
+    num_cells = grid_size * grid_size
+    categories = torch.zeros(batch_size, num_cells, len(SITUATION_CATEGORIES), dtype=torch.long)
+    for i in range(batch_size):
+        objects = torch.randperm(num_cells)[:np.random.randint(1, max_objects + 1)]
+        for block, num_categories in enumerate(SITUATION_CATEGORIES[:-1]):
+            categories[i, objects, block] = torch.randint(1, num_categories, (objects.size(0),))
+        categories[i, np.random.randint(num_cells), -1] = np.random.randint(1, SITUATION_CATEGORIES[-1])
+    return situation_features(categories).float().view(batch_size, grid_size, grid_size, -1)
+
+
+def random_commands(batch_size, max_length=9):
+    lengths = torch.randint(3, max_length + 1, (batch_size,))
+    commands = torch.randint(2, INPUT_VOCAB_SIZE, (batch_size, int(lengths.max())))
+    return commands, lengths
+
+
+def edges_per_node(model, situations):
+    occupied = situations.sum(dim=-1).gt(0)
+    num_nodes = occupied.flatten(1).sum(dim=1)
+    if model.edge_policy is None:
+        return float((num_nodes * (num_nodes - 1)).sum()) / float(num_nodes.sum())
+    graph_membership = torch.repeat_interleave(torch.arange(num_nodes.size(0)), num_nodes)
+    cells = occupied.flatten(1).nonzero()[:, 1]
+    edges = model.edge_policy(cells, graph_membership, num_nodes, situations.size(1))
+    return float(edges.size(1)) / float(num_nodes.sum())
+
+
+def benchmark_throughput(policy, grid_size, max_objects, batch_size, num_batches, device):
+    cfg.GRAPH_EDGE_POLICY = policy
+    model = GSCAN_model(1, 3, INPUT_VOCAB_SIZE, TARGET_VOCAB_SIZE).to(device)
+    model.device = device
+    batches = [(random_commands(batch_size), random_situations(batch_size, grid_size, max_objects))
+               for _ in range(num_batches + 1)]
+    edges = np.mean([edges_per_node(model, situations) for _, situations in batches])
+    elapsed = 0.
+    for i, ((commands, lengths), situations) in enumerate(batches):
+        start = time.time()
+        situation_out = model.encode_input((commands.to(device), lengths.to(device)), situations.to(device))[3]
+        situation_out.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if i > 0:  # the first batch warms up caches and allocators
+            elapsed += time.time() - start
+    return num_batches * batch_size / elapsed, edges
+
+
+def benchmark_accuracy(policy, checkpoint_path, data_path, use_cuda, max_decoding_steps):
+    cfg.GRAPH_EDGE_POLICY = policy
+    load_data = {"json": dataloader, "memmap": memmap_dataloader, "cached": cached_dataloader}[cfg.DATA_FORMAT]
+    data_iter, input_vocab, target_vocab = load_data(data_path, batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
+                                                     random_shuffle=False, sparse_situations=cfg.SPARSE_SITUATIONS)
+    pad_idx, sos_idx, eos_idx = target_vocab.stoi['<pad>'], target_vocab.stoi['<sos>'], target_vocab.stoi['<eos>']
+    model = GSCAN_model(pad_idx, eos_idx, len(input_vocab.itos), len(target_vocab.itos))
+    model = model.cuda() if use_cuda else model
+    model.load_model(checkpoint_path)
+    with torch.no_grad():
+        model.eval()
+        start = time.time()
+        accuracy, exact_match, _ = evaluate(data_iter, model=model, max_decoding_steps=max_decoding_steps,
+                                            pad_idx=pad_idx, sos_idx=sos_idx, eos_idx=eos_idx)
+    return accuracy, exact_match, time.time() - start
+
+
+def main(flags):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    cfg.GRAPH_KNN, cfg.GRAPH_RADIUS = flags.k, flags.radius
+    for grid_size, max_objects in zip(flags.grid_sizes, flags.max_objects or [None] * len(flags.grid_sizes)):
+        # by default a third of the cells can hold an object, so bigger worlds also have more objects
+        max_objects = max_objects or grid_size * grid_size // 3
+        reference = None
+        for policy in flags.policies:
+            examples_per_second, edges = benchmark_throughput(policy, grid_size, max_objects, flags.batch_size,
+                                                              flags.num_batches, device)
+            reference = reference or examples_per_second
+            logger.info("grid {:2d}x{:<2d} up to {:3d} objects {:>10s}: {:8.1f} examples/s ({:4.2f}x), {:6.1f} "
+                        "edges per node".format(grid_size, grid_size, max_objects, policy, examples_per_second,
+                                                examples_per_second / reference, edges))
+
+    for policy_checkpoint in flags.checkpoint:
+        policy, checkpoint_path = policy_checkpoint.split('=', 1)
+        assert policy == "complete" or policy in EdgePolicy.POLICIES, "Unknown edge policy {}.".format(policy)
+        accuracy, exact_match, seconds = benchmark_accuracy(policy, checkpoint_path, flags.data_path, use_cuda,
+                                                            flags.max_decoding_steps)
+        logger.info("{:>10s}: Accuracy: {:5.2f} Exact Match: {:5.2f} ({:.1f} s)".format(policy, accuracy, exact_match,
+                                                                                       seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput and accuracy of the LGCN edge policies")
+    parser.add_argument('--grid_sizes', type=int, nargs='*', default=[6, 12, 24])
+    parser.add_argument('--max_objects', type=int, nargs='*', default=None,
+                        help='Maximum number of objects per world for every grid size, a third of the cells by '
+                             'default.')
+    parser.add_argument('--policies', type=str, nargs='*', default=["complete"] + list(EdgePolicy.POLICIES))
+    parser.add_argument('--k', type=int, default=cfg.GRAPH_KNN)
+    parser.add_argument('--radius', type=int, default=cfg.GRAPH_RADIUS)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_batches', type=int, default=20)
+    parser.add_argument('--checkpoint', type=str, action='append', default=[],
+                        help='POLICY=PATH of a model trained with that edge policy, evaluated on --data_path.')
+    parser.add_argument('--data_path', type=str, default='')
+    parser.add_argument('--max_decoding_steps', type=int, default=30)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    main(args)
@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+import torch
+
+from dataloader import Vocabulary
+from model.situation import situation_categories, situation_features
+
+# Converts the per-split .json files written by preprocess_parsed_dataset.py into fixed-shape .npy arrays that
+# dataloader.memmap_dataloader can slice without parsing anything. Run once after preprocessing:
+#   python build_memmap_dataset.py --data_directory data/parsed_dataset --output_directory data/memmap_dataset
+
+logger = logging.getLogger(__name__)
+
+INPUT_SPECIALS = ['<unk>', '<pad>']
+TARGET_SPECIALS = ['<unk>', '<pad>', '<sos>', '<eos>']
+# float32 is what the model consumes, so batches are views of the memmaps; uint8 and float16 take less disk and page
+# cache but every batch is cast
+SITUATION_DTYPES = {'float32': np.float32, 'uint8': np.uint8, 'float16': np.float16}
+# bumped whenever the set of arrays written per split or their dtypes change, so cached splits of an older layout are
+# rebuilt
+FORMAT_VERSION = 5
+
+
+def tokenize(value):
+    # torchtext's Field splits strings on whitespace and keeps lists as they are
+    return value.split() if isinstance(value, str) else list(value)
+
+
+def read_examples(data_path):
+    with open(data_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def situation_fingerprint(situation):
+    """Canonical key of a situation: its shape and its features as float32 bytes, so equal worlds collide."""
+    situation = np.ascontiguousarray(situation, dtype=np.float32)
+    return hashlib.sha1(repr(situation.shape).encode() + situation.tobytes()).digest()
+
+
+def build_vocabularies(data_path):
+    input_counter, target_counter = Counter(), Counter()
+    for example in read_examples(data_path):
+        input_counter.update(tokenize(example['input']))
+        target_counter.update(tokenize(example['target']))
+    return (Vocabulary.from_counter(input_counter, INPUT_SPECIALS),
+            Vocabulary.from_counter(target_counter, TARGET_SPECIALS))
+
+
+def convert_split(data_path, split_directory, input_vocab, target_vocab, situation_dtype='float32'):
+    """
+    Two streaming passes over a .json split: the first finds the array shapes, the second fills the memmaps, so
+    memory stays flat regardless of the split size. Many examples share their world, so every distinct situation is
+    stored once, in order of first appearance, and examples refer to it through situation_ids. Situations are written
+    both dense and as their occupied cells (cells, cell_features, cell_categories and cell_offsets, see
+    model.situation.SparseSituation). meta.json records whether every cell is made of one-hot blocks, i.e. whether
+    cell_categories describe the cells exactly. Indices and lengths are stored as int64, the dtype the model consumes.
+    :return: number of converted examples
+    """
+    num_examples, max_input_length, max_target_length, situation_shape, num_cells = 0, 0, 0, None, 0
+    situation_ids = {}  # fingerprint -> row in the situation table
+    for example in read_examples(data_path):
+        num_examples += 1
+        max_input_length = max(max_input_length, len(tokenize(example['input'])))
+        max_target_length = max(max_target_length, len(tokenize(example['target'])) + 2)  # <sos> and <eos>
+        situation = np.asarray(example['situation'])
+        fingerprint = situation_fingerprint(situation)
+        if fingerprint not in situation_ids:
+            situation_ids[fingerprint] = len(situation_ids)
+            num_cells += int(situation.any(-1).sum())
+        shape = situation.shape
+        if situation_shape is None:
+            situation_shape = shape
+        elif shape != situation_shape:
+            raise ValueError("{}: situation of shape {} does not match {}.".format(data_path, shape, situation_shape))
+    if situation_shape is None:
+        raise ValueError("{} holds no examples.".format(data_path))
+
+    os.makedirs(split_directory, exist_ok=True)
+    open_memmap = lambda name, dtype, shape: np.lib.format.open_memmap(
+        os.path.join(split_directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+    num_situations = len(situation_ids)
+    situations = open_memmap('situations', SITUATION_DTYPES[situation_dtype], (num_situations,) + situation_shape)
+    example_situation_ids = open_memmap('situation_ids', np.int64, (num_examples,))
+    inputs = open_memmap('input', np.int64, (num_examples, max_input_length))
+    input_lengths = open_memmap('input_lengths', np.int64, (num_examples,))
+    targets = open_memmap('target', np.int64, (num_examples, max_target_length))
+    target_lengths = open_memmap('target_lengths', np.int64, (num_examples,))
+    cells = open_memmap('cells', np.int64, (num_cells,))
+    cell_features = open_memmap('cell_features', SITUATION_DTYPES[situation_dtype], (num_cells, situation_shape[-1]))
+    cell_categories = open_memmap('cell_categories', np.int64, (num_cells, 4))
+    cell_offsets = open_memmap('cell_offsets', np.int64, (num_situations + 1,))
+    categorical = True
+    cell_offsets[0] = 0
+    inputs[:] = input_vocab.stoi['<pad>']
+    targets[:] = target_vocab.stoi['<pad>']
+
+    num_written = 0
+    for i, example in enumerate(read_examples(data_path)):
+        input_indices = input_vocab.encode(tokenize(example['input']))
+        target_indices = target_vocab.encode(['<sos>'] + tokenize(example['target']) + ['<eos>'])
+        inputs[i, :len(input_indices)] = input_indices
+        input_lengths[i] = len(input_indices)
+        targets[i, :len(target_indices)] = target_indices
+        target_lengths[i] = len(target_indices)
+        situation = np.asarray(example['situation'], dtype=np.float32)
+        situation_id = situation_ids[situation_fingerprint(situation)]
+        example_situation_ids[i] = situation_id
+        if situation_id < num_written:
+            continue
+        # ids are handed out in order of first appearance, so a new situation is always the next row
+        num_written += 1
+        if situation_dtype == 'uint8' and not np.array_equal(situation, situation.astype(np.uint8)):
+            raise ValueError("{}: example {} has non-integer situation features, use --situation_dtype float16."
+                             .format(data_path, i))
+        situations[situation_id] = situation
+        flat_situation = situation.reshape(-1, situation.shape[-1])
+        occupied = np.flatnonzero(flat_situation.any(-1))
+        start = cell_offsets[situation_id]
+        cell_offsets[situation_id + 1] = start + len(occupied)
+        cells[start:start + len(occupied)] = occupied
+        cell_features[start:start + len(occupied)] = flat_situation[occupied]
+        if situation.shape[-1] == 16:
+            categories = situation_categories(torch.from_numpy(flat_situation[occupied]))
+            cell_categories[start:start + len(occupied)] = categories.numpy()
+            categorical = categorical and np.array_equal(situation_features(categories).numpy(),
+                                                         flat_situation[occupied])
+        else:
+            categorical = False
+
+    for array in (situations, example_situation_ids, inputs, input_lengths, targets, target_lengths, cells,
+                  cell_features, cell_categories, cell_offsets):
+        array.flush()
+    with open(os.path.join(split_directory, 'meta.json'), 'w') as f:
+        json.dump({'format_version': FORMAT_VERSION, 'source': os.path.abspath(data_path),
+                   'num_examples': num_examples, 'num_situations': num_situations, 'num_cells': num_cells,
+                   'categorical': categorical,
+                   'situation_shape': list(situation_shape), 'situation_dtype': situation_dtype,
+                   'max_input_length': max_input_length, 'max_target_length': max_target_length}, f)
+    logger.info("{}: {} examples share {} distinct situations.".format(data_path, num_examples, num_situations))
+    return num_examples
+
+
+def main(flags):
+    splits = flags.splits or sorted(file_name[:-len('.json')] for file_name in os.listdir(flags.data_directory)
+                                    if file_name.endswith('.json'))
+    os.makedirs(flags.output_directory, exist_ok=True)
+
+    # Vocabularies always come from the training split, exactly like main_model.train builds them.
+    input_vocab, target_vocab = build_vocabularies(os.path.join(flags.data_directory, 'train.json'))
+    input_vocab.save(os.path.join(flags.output_directory, 'input_vocab.json'))
+    target_vocab.save(os.path.join(flags.output_directory, 'target_vocab.json'))
+    logger.info("Input vocabulary: {} tokens, target vocabulary: {} tokens.".format(len(input_vocab),
+                                                                                  len(target_vocab)))
+
+    for split in splits:
+        num_examples = convert_split(os.path.join(flags.data_directory, split + '.json'),
+                                     os.path.join(flags.output_directory, split), input_vocab, target_vocab,
+                                     situation_dtype=flags.situation_dtype)
+        logger.info("Converted {} examples of split {}.".format(num_examples, split))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert parsed gSCAN splits to memory-mapped .npy arrays")
+    parser.add_argument('--data_directory', type=str, default='data/parsed_dataset',
+                        help='Directory with the <split>.json files (must contain train.json).')
+    parser.add_argument('--output_directory', type=str, default='data/memmap_dataset')
+    parser.add_argument('--splits', type=str, nargs='*', default=None,
+                        help='Splits to convert, all .json files in --data_directory by default.')
+    parser.add_argument('--situation_dtype', type=str, default='float32', choices=sorted(SITUATION_DTYPES))
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    main(args)
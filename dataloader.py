@@ -1,9 +1,399 @@
+import collections
+import concurrent.futures
+import json
+import os
+import time
+
+import numpy as np
 import torch
 import torchtext as tt
 
+from model.situation import SituationTable, SparseSituation
+
+
+class Vocabulary(object):
+    """Token <-> index mapping with the same ordering torchtext's Field.build_vocab produces (specials first, then
+    tokens by descending frequency, ties broken alphabetically), so indices line up with existing checkpoints."""
+
+    def __init__(self, itos):
+        self.itos = list(itos)
+        # like torchtext, unknown tokens map to index 0 ('<unk>'), so this can also be assigned to a Field's vocab
+        self.stoi = collections.defaultdict(int, {token: idx for idx, token in enumerate(self.itos)})
+
+    def __len__(self):
+        return len(self.itos)
+
+    @classmethod
+    def from_counter(cls, counter, specials):
+        words = sorted(word for word in counter if word not in specials)
+        words.sort(key=lambda word: counter[word], reverse=True)
+        return cls(list(specials) + words)
+
+    def encode(self, tokens):
+        unk_idx = self.stoi['<unk>']
+        return [self.stoi.get(token, unk_idx) for token in tokens]
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'itos': self.itos}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f)['itos'])
+
+
+class Batch(object):
+    """Mirrors the attributes of a torchtext batch: input and target are (indices, lengths) pairs."""
+
+    def __init__(self, input, target, situation):
+        self.input = input
+        self.target = target
+        self.situation = situation
+
+
+class MemmapDataset(object):
+    """
+    One split converted by build_memmap_dataset.py. Every array is opened as a copy-on-write memmap, so opening a split
+    costs nothing, a batch only touches the rows it needs and, for arrays stored in the dtype the model consumes, the
+    rows of consecutive examples reach the model as views of the memmap. Every distinct situation is stored once and
+    batches carry a SituationTable with the distinct situations of the batch. With sparse_situations, the table is a
+    SparseSituation read from the occupied-cell arrays and the dense situations are never touched.
+    """
+
+    def __init__(self, split_directory, sparse_situations=False):
+        with open(os.path.join(split_directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        # copy-on-write: writable like tensors are expected to be, without ever writing to the split
+        load = lambda name: np.load(os.path.join(split_directory, name + '.npy'), mmap_mode='c')
+        self.situations = load('situations')  # [num_situations, grid, grid, num_features]
+        if self.meta.get('format_version', 1) >= 3:
+            self.situation_ids = load('situation_ids')  # [num_examples] row of situations of every example
+        else:
+            # older splits store one situation per example
+            self.situation_ids = np.arange(self.meta['num_examples'])
+        self.inputs = load('input')  # [num_examples, max_input_length]
+        self.input_lengths = load('input_lengths')
+        self.targets = load('target')  # [num_examples, max_target_length], with <sos> and <eos>
+        self.target_lengths = load('target_lengths')
+        self.sparse_situations = sparse_situations
+        # whether every cell round-trips through its categories, recorded from format 4 on
+        self.categorical = self.meta.get('categorical')
+        if sparse_situations:
+            assert self.meta.get('format_version', 1) >= 2, \
+                "{} has no occupied-cell arrays, convert it again.".format(split_directory)
+            self.cells = load('cells')  # [num_cells]
+            self.cell_features = load('cell_features')  # [num_cells, num_features]
+            self.cell_offsets = load('cell_offsets')  # [num_situations + 1]
+            # per-cell categories are only written for one-hot cells
+            if self.categorical:
+                self.cell_categories = load('cell_categories')  # [num_cells, 4]
+
+    def __len__(self):
+        return self.meta['num_examples']
+
+    def num_nodes(self, chunk_size=65536):
+        """Number of occupied grid cells per example, i.e. the number of LGCN graph nodes."""
+        if self.sparse_situations:
+            return np.diff(self.cell_offsets)[self.situation_ids]
+        num_situations = len(self.situations)
+        num_nodes = np.empty(num_situations, dtype=np.int64)
+        for start in range(0, num_situations, chunk_size):
+            chunk = np.asarray(self.situations[start:start + chunk_size])
+            num_nodes[start:start + chunk_size] = chunk.reshape(chunk.shape[0], -1, chunk.shape[-1]).any(-1).sum(-1)
+        return num_nodes[self.situation_ids]
+
+    def empty_buffers(self, batch_size, pin_memory=False):
+        """Preallocated tensors large enough for any batch of this split, to be filled by collate(out=...)."""
+        situation_shape = tuple(self.meta['situation_shape'])
+        empty = lambda shape, dtype: torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+        buffers = [empty((batch_size, self.meta['max_input_length']), torch.long), empty((batch_size,), torch.long),
+                   empty((batch_size, self.meta['max_target_length']), torch.long), empty((batch_size,), torch.long),
+                   empty((batch_size,), torch.long)]
+        if self.sparse_situations:
+            max_cells = batch_size * situation_shape[0] * situation_shape[1]
+            buffers += [empty((max_cells,), torch.long), empty((max_cells, situation_shape[-1]), torch.float),
+                        empty((batch_size + 1,), torch.long)]
+            return buffers + ([empty((max_cells, 4), torch.long)] if self.categorical else [])
+        return buffers + [empty((batch_size,) + situation_shape, torch.float)]
+
+    def situation_arrays(self, indices):
+        """:return: the distinct situations of the given examples and, per example, its row among them"""
+        situation_ids = self.situation_ids[indices]
+        rows, index = np.unique(situation_ids, return_inverse=True)
+        if rows[-1] - rows[0] + 1 == len(rows):
+            # consecutive examples mostly reference consecutive rows, which can be read as a view
+            rows = slice(int(rows[0]), int(rows[-1]) + 1)
+        return [index] + self.table_arrays(rows)
+
+    def table_arrays(self, rows):
+        """:param rows: a slice or a sorted array of rows of the situation table"""
+        if not self.sparse_situations:
+            return [self.situations[rows]]
+        row_indices = np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows
+        starts, ends = self.cell_offsets[row_indices], self.cell_offsets[row_indices + 1]
+        batch_offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+        if isinstance(rows, slice):
+            positions = slice(starts[0], ends[-1])
+        else:
+            # positions of the cells of every example, concatenated: starts[i] + 0 ... starts[i] + count[i] - 1
+            positions = np.repeat(starts - batch_offsets[:-1], ends - starts) + np.arange(batch_offsets[-1])
+        arrays = [self.cells[positions], self.cell_features[positions], batch_offsets]
+        return arrays + ([self.cell_categories[positions]] if self.categorical else [])
+
+    def collate(self, indices, device=torch.device('cpu'), out=None):
+        """
+        :param indices: a slice (zero-copy view of the memmaps) or a sorted array of example indices
+        :param device: device to put the batch tensors on
+        :param out: buffers from empty_buffers() to write the batch into instead of allocating new tensors; the
+        returned batch then holds views of these buffers
+        :return: a Batch padded to the longest input and target in the batch
+        """
+        input_lengths = self.input_lengths[indices]
+        target_lengths = self.target_lengths[indices]
+        arrays = [self.inputs[indices, :input_lengths.max()], input_lengths,
+                  self.targets[indices, :target_lengths.max()], target_lengths] + self.situation_arrays(indices)
+        if out is None:
+            # no copy for arrays already in these dtypes, the ones build_memmap_dataset.py writes from format 5 on
+            dtypes = [np.int64] * 5 + ([np.int64, np.float32, np.int64, np.int64] if self.sparse_situations
+                                       else [np.float32])
+            tensors = [torch.from_numpy(np.asarray(array, dtype=dtype)) for array, dtype in zip(arrays, dtypes)]
+        else:
+            tensors = [buffer[tuple(slice(0, size) for size in array.shape)] for buffer, array in zip(out, arrays)]
+            for tensor, array in zip(tensors, arrays):
+                np.copyto(tensor.numpy(), array, casting='unsafe')
+        tensors = [tensor.to(device, non_blocking=True) for tensor in tensors]
+        if self.sparse_situations:
+            situations = SparseSituation(*tensors[5:8], grid_size=self.meta['situation_shape'][0],
+                                         categories=tensors[8] if self.categorical else None)
+        else:
+            situations = tensors[5]
+        return Batch(input=(tensors[0], tensors[1]), target=(tensors[2], tensors[3]),
+                     situation=SituationTable(situations, index=tensors[4], categorical=self.categorical))
+
+
+def padding_statistics(target_lengths, batches, batch_size):
+    """
+    :param target_lengths: [num_examples] target sequence lengths
+    :param batches: example indices of every batch of one pass
+    :return: fraction of real target tokens in the padded batches and decoder time steps for one pass over the
+    given batches, and the same numbers for the examples batched uniformly at random, as reference.
+    """
+    def padding(batches):
+        max_lengths = np.array([target_lengths[batch].max() for batch in batches])
+        padded_tokens = sum(len(batch) * max_length for batch, max_length in zip(batches, max_lengths))
+        return float(target_lengths.sum()) / padded_tokens, int(max_lengths.sum())
+
+    uniform_order = np.random.permutation(len(target_lengths))
+    uniform_batches = [uniform_order[i:i + batch_size] for i in range(0, len(uniform_order), batch_size)]
+    padding_efficiency, decoder_steps = padding(batches)
+    uniform_padding_efficiency, uniform_decoder_steps = padding(uniform_batches)
+    return {'padding_efficiency': padding_efficiency, 'decoder_steps': decoder_steps,
+            'uniform_padding_efficiency': uniform_padding_efficiency,
+            'uniform_decoder_steps': uniform_decoder_steps}
+
+
+class BucketBatchSampler(object):
+    """
+    Yields batches of example indices that have similar target lengths, so the decoder does not loop over time steps
+    that are padding for most of the batch. Examples are shuffled, cut into pools of pool_size_multiplier batches,
+    sorted within a pool by target length (then by the secondary keys), and the resulting batches are shuffled again,
+    so every epoch sees different batches in a different order.
+    """
+
+    def __init__(self, target_lengths, batch_size, secondary_keys=(), shuffle=True, pool_size_multiplier=50):
+        """
+        :param target_lengths: [num_examples] target sequence lengths, the primary sort key
+        :param batch_size: number of examples per batch
+        :param secondary_keys: sequence of [num_examples] arrays (e.g. command lengths, node counts) to break ties
+        :param shuffle: shuffle the pools and the batch order on every pass
+        :param pool_size_multiplier: number of batches per sorted pool; larger pools give tighter batches but less
+        randomness
+        """
+        self.target_lengths = np.asarray(target_lengths)
+        self.secondary_keys = [np.asarray(key) for key in secondary_keys]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * pool_size_multiplier
+        self.epoch_statistics = None
+
+    def __len__(self):
+        return (len(self.target_lengths) + self.batch_size - 1) // self.batch_size
+
+    def batches(self):
+        num_examples = len(self.target_lengths)
+        order = np.random.permutation(num_examples) if self.shuffle else np.arange(num_examples)
+        batches = []
+        for start in range(0, num_examples, self.pool_size):
+            pool = order[start:start + self.pool_size]
+            # np.lexsort sorts by the last key first
+            keys = [key[pool] for key in reversed(self.secondary_keys)] + [self.target_lengths[pool]]
+            pool = pool[np.lexsort(keys)]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch_statistics = padding_statistics(self.target_lengths, batches, self.batch_size)
+        for batch in batches:
+            yield batch
+
+
+class MemmapIterator(object):
+    """Drop-in replacement for tt.data.Iterator over a MemmapDataset; reshuffles on every pass."""
+
+    def __init__(self, dataset, batch_size, device, shuffle=True, batch_sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.batch_sampler = batch_sampler
+        self.num_shards, self.shard = 1, 0
+
+    def set_shard(self, num_shards, shard):
+        """
+        Restricts every pass to batches shard, shard + num_shards, ... of the batches drawn by all the processes of a
+        distributed training run, which must therefore seed numpy's random generator alike. The batches left over when
+        their number is not a multiple of num_shards are dropped, so that every process takes as many steps.
+        """
+        self.num_shards, self.shard = num_shards, shard
+
+    @property
+    def epoch_statistics(self):
+        """padding_statistics of the current epoch's batches when bucketing, None otherwise"""
+        return self.batch_sampler.epoch_statistics if self.batch_sampler is not None else None
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler) // self.num_shards
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size // self.num_shards
+
+    def index_batches(self):
+        batches = self.unsharded_index_batches()
+        for i, indices in zip(range(len(self) * self.num_shards), batches):
+            if i % self.num_shards == self.shard:
+                yield indices
+
+    def unsharded_index_batches(self):
+        num_examples = len(self.dataset)
+        if self.batch_sampler is not None:
+            for indices in self.batch_sampler:
+                yield np.sort(indices)
+            return
+        if not self.shuffle:
+            for start in range(0, num_examples, self.batch_size):
+                yield slice(start, min(start + self.batch_size, num_examples))
+            return
+        order = np.random.permutation(num_examples)
+        for start in range(0, num_examples, self.batch_size):
+            # sorting the rows of a batch keeps the memmap reads sequential
+            yield np.sort(order[start:start + self.batch_size])
+
+    def __iter__(self):
+        for indices in self.index_batches():
+            yield self.dataset.collate(indices, self.device)
+
+
+class PrefetchIterator(object):
+    """
+    Assembles the batches of a MemmapIterator on background threads while the model trains on the current one.
+    Reading the memmaps and casting into the buffers happen in numpy, which releases the GIL, so threads are enough.
+
+    Batch k is written into buffer slot k % (prefetch_depth + 1): at most prefetch_depth batches are in flight, and
+    the slot of the batch the caller is holding is only refilled once the caller asks for the next one. Batches are
+    therefore views of reused (pinned, when copying to CUDA) buffers and must not be kept across iterations.
+    """
+
+    def __init__(self, iterator, num_workers=2, prefetch_depth=4, pin_memory=False):
+        assert isinstance(iterator, MemmapIterator), "Prefetching requires a memmap dataset (cfg.DATA_FORMAT)."
+        self.iterator = iterator
+        self.num_workers = num_workers
+        self.prefetch_depth = prefetch_depth
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.slots = [iterator.dataset.empty_buffers(iterator.batch_size, pin_memory=self.pin_memory)
+                      for _ in range(prefetch_depth + 1)]
+        self.copy_done = [None] * len(self.slots)
+        self.statistics = None
+
+    @property
+    def epoch_statistics(self):
+        return self.iterator.epoch_statistics
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def fill(self, slot, indices):
+        if self.copy_done[slot] is not None:
+            # the asynchronous host-to-device copy of the slot's previous batch must finish before overwriting it
+            self.copy_done[slot].synchronize()
+        return self.iterator.dataset.collate(indices, out=self.slots[slot])
+
+    def __iter__(self):
+        # queue_depth_sum / batches is the mean number of ready batches found when asking for the next one
+        statistics = {'batches': 0, 'stall_seconds': 0., 'queue_depth_sum': 0}
+        self.statistics = statistics
+        index_batches = self.iterator.index_batches()
+        pending = collections.deque()
+        submitted = 0
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers)
+
+        def submit():
+            nonlocal submitted
+            indices = next(index_batches, None)
+            if indices is not None:
+                slot = submitted % len(self.slots)
+                pending.append((slot, executor.submit(self.fill, slot, indices)))
+                submitted += 1
+
+        try:
+            for _ in range(self.prefetch_depth):
+                submit()
+            while pending:
+                statistics['queue_depth_sum'] += sum(future.done() for _, future in pending)
+                slot, future = pending.popleft()
+                start = time.time()
+                batch = future.result()
+                statistics['stall_seconds'] += time.time() - start
+                statistics['batches'] += 1
+                submit()
+                if self.iterator.device.type == 'cuda':
+                    batch = Batch(input=tuple(t.to(self.iterator.device, non_blocking=True) for t in batch.input),
+                                  target=tuple(t.to(self.iterator.device, non_blocking=True) for t in batch.target),
+                                  situation=batch.situation.to(self.iterator.device, non_blocking=True))
+                    self.copy_done[slot] = torch.cuda.Event()
+                    self.copy_done[slot].record()
+                yield batch
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+class BucketIterator(tt.data.BucketIterator):
+    """tt.data.BucketIterator that records the padding_statistics of every epoch's batches, like BucketBatchSampler."""
+
+    epoch_statistics = None
+
+    def create_batches(self):
+        super().create_batches()
+        self.batches = list(self.batches)
+        examples = self.dataset.examples
+        positions = {id(example): i for i, example in enumerate(examples)}
+        target_lengths = np.array([len(example.target) + 2 for example in examples])  # with <sos> and <eos>
+        self.epoch_statistics = padding_statistics(
+            target_lengths, [np.array([positions[id(example)] for example in batch]) for batch in self.batches],
+            self.batch_size)
+
 
 def dataloader(data_path, batch_size=32, use_cuda=False, fix_length=None, input_vocab=None, target_vocab=None,
-               random_shuffle=True):
+               random_shuffle=True, bucket_keys=None, sparse_situations=False):
+    """
+    :param bucket_keys: None for uniform batches, or a list starting with 'target' and optionally followed by
+    'input' to batch examples of similar target (then command) lengths together.
+    """
+    assert not sparse_situations, "Sparse situations need the memmap or cached data format."
     INPUT_FIELD = tt.data.Field(sequential=True, include_lengths=True, batch_first=True, fix_length=fix_length)
     # INPUT_FIELD = tt.data.Field(sequential=True, include_lengths=True, batch_first=True, fix_length=fix_length)
     TARGET_FIELD = tt.data.Field(sequential=True, include_lengths=True, batch_first=True, is_target=True,
@@ -25,7 +415,14 @@ def dataloader(data_path, batch_size=32, use_cuda=False, fix_length=None, input_
         TARGET_FIELD.build_vocab(dataset)
     else:
         TARGET_FIELD.vocab = target_vocab
-    if use_cuda:
+    if bucket_keys:
+        assert bucket_keys[0] == 'target' and set(bucket_keys) <= {'target', 'input'}, \
+            "Unsupported bucket keys {} for json datasets.".format(bucket_keys)
+        iterator = BucketIterator(dataset, batch_size=batch_size,
+                                  device=torch.device(type='cuda' if use_cuda else 'cpu'),
+                                  sort_key=lambda x: tuple(len(getattr(x, key)) for key in bucket_keys),
+                                  shuffle=random_shuffle, sort_within_batch=False)
+    elif use_cuda:
         iterator = tt.data.Iterator(dataset, batch_size=batch_size, device=torch.device(type='cuda'),
                                     shuffle=random_shuffle)
     else:
@@ -34,6 +431,39 @@ def dataloader(data_path, batch_size=32, use_cuda=False, fix_length=None, input_
     return iterator, INPUT_FIELD.vocab, TARGET_FIELD.vocab
 
 
+def memmap_dataloader(data_path, batch_size=32, use_cuda=False, fix_length=None, input_vocab=None, target_vocab=None,
+                      random_shuffle=True, bucket_keys=None, sparse_situations=False):
+    """
+    Same interface as dataloader(), but data_path is a split directory written by build_memmap_dataset.py. The
+    vocabularies are the ones the split was encoded with (stored next to the split directories); passing different
+    ones is an error since the token indices on disk could not be reinterpreted. bucket_keys may additionally
+    contain 'nodes' to bucket by the number of occupied grid cells. batch.situation is a model.situation.SituationTable
+    of the distinct situations in the batch; with sparse_situations, its situations are a
+    model.situation.SparseSituation holding only the occupied cells.
+    """
+    assert fix_length is None, "fix_length is not supported for memmap datasets."
+    store_directory = os.path.dirname(os.path.normpath(data_path))
+    stored_input_vocab = Vocabulary.load(os.path.join(store_directory, 'input_vocab.json'))
+    stored_target_vocab = Vocabulary.load(os.path.join(store_directory, 'target_vocab.json'))
+    assert input_vocab is None or list(input_vocab.itos) == stored_input_vocab.itos, \
+        "{} was encoded with a different input vocabulary.".format(data_path)
+    assert target_vocab is None or list(target_vocab.itos) == stored_target_vocab.itos, \
+        "{} was encoded with a different target vocabulary.".format(data_path)
+    device = torch.device(type='cuda') if use_cuda else torch.device(type='cpu')
+    dataset = MemmapDataset(data_path, sparse_situations=sparse_situations)
+    batch_sampler = None
+    if bucket_keys:
+        assert bucket_keys[0] == 'target' and set(bucket_keys) <= {'target', 'input', 'nodes'}, \
+            "Unsupported bucket keys {}.".format(bucket_keys)
+        key_arrays = {'input': lambda: dataset.input_lengths, 'nodes': dataset.num_nodes}
+        batch_sampler = BucketBatchSampler(dataset.target_lengths, batch_size=batch_size,
+                                           secondary_keys=[key_arrays[key]() for key in bucket_keys[1:]],
+                                           shuffle=random_shuffle)
+    iterator = MemmapIterator(dataset, batch_size=batch_size, device=device, shuffle=random_shuffle,
+                              batch_sampler=batch_sampler)
+    return iterator, stored_input_vocab, stored_target_vocab
+
+
 if __name__ == '__main__':
 
     train_iter, input_vocab, target_vocab = dataloader('data/train.json')
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from build_memmap_dataset import FORMAT_VERSION, build_vocabularies, convert_split
+from dataloader import Vocabulary, memmap_dataloader
+
+# Cache of integer-encoded splits next to the parsed .json files, so that only the first run after the data changes
+# pays for tokenizing and numericalizing. Layout under <data directory>/.cache:
+#   hashes/<file>.json                     content hash of <file>, reused while its size and mtime are unchanged
+#   vocabularies/<source hash>/            vocabularies built from a training split
+#   <vocabulary hash>/{input,target}_vocab.json
+#   <vocabulary hash>/<split>-<source hash>/  memmap split as written by build_memmap_dataset.convert_split
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path, cache_directory):
+    """sha1 of the file contents; the digest is memoized and only recomputed when the file's size or mtime change."""
+    stat = os.stat(path)
+    memo_path = os.path.join(cache_directory, 'hashes', os.path.basename(path) + '.json')
+    if os.path.exists(memo_path):
+        with open(memo_path, 'r') as f:
+            memo = json.load(f)
+        if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+            return memo['sha1']
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            sha1.update(chunk)
+    os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+    write_json_atomic(memo_path, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1.hexdigest()})
+    return sha1.hexdigest()
+
+
+def vocabulary_hash(input_vocab, target_vocab):
+    return hashlib.sha1(json.dumps([list(input_vocab.itos), list(target_vocab.itos)]).encode()).hexdigest()
+
+
+def write_json_atomic(path, content):
+    temporary_path = path + '.tmp.{}'.format(os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(temporary_path, path)
+
+
+def cached_vocabularies(data_path, cache_directory):
+    vocab_directory = os.path.join(cache_directory, 'vocabularies', file_hash(data_path, cache_directory)[:16])
+    input_vocab_path = os.path.join(vocab_directory, 'input_vocab.json')
+    target_vocab_path = os.path.join(vocab_directory, 'target_vocab.json')
+    if not os.path.exists(target_vocab_path):
+        logger.info("Building vocabularies from {}...".format(data_path))
+        input_vocab, target_vocab = build_vocabularies(data_path)
+        os.makedirs(vocab_directory, exist_ok=True)
+        write_json_atomic(input_vocab_path, {'itos': input_vocab.itos})
+        write_json_atomic(target_vocab_path, {'itos': target_vocab.itos})
+    return Vocabulary.load(input_vocab_path), Vocabulary.load(target_vocab_path)
+
+
+def is_complete(split_directory):
+    """:return: whether split_directory holds a split written by the current convert_split"""
+    meta_path = os.path.join(split_directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        return json.load(f).get('format_version') == FORMAT_VERSION
+
+
+def cached_split(data_path, input_vocab, target_vocab, cache_directory):
+    """
+    :return: the memmap split directory holding data_path encoded with the given vocabularies. Processes caching the
+    same split concurrently each build it, and all but the first to finish discard their copy.
+    """
+    store_directory = os.path.join(cache_directory, vocabulary_hash(input_vocab, target_vocab)[:16])
+    split_name = os.path.splitext(os.path.basename(data_path))[0]
+    split_directory = os.path.join(store_directory, '{}-{}'.format(split_name,
+                                                                   file_hash(data_path, cache_directory)[:16]))
+    if is_complete(split_directory):
+        return split_directory
+
+    os.makedirs(store_directory, exist_ok=True)
+    for name, vocab in [('input_vocab.json', input_vocab), ('target_vocab.json', target_vocab)]:
+        if not os.path.exists(os.path.join(store_directory, name)):
+            write_json_atomic(os.path.join(store_directory, name), {'itos': list(vocab.itos)})
+    # the source or the format changed: drop the splits encoded from its previous contents, but not the current one
+    # if another process published it in the meantime
+    for name in os.listdir(store_directory):
+        path = os.path.join(store_directory, name)
+        if name.rsplit('-', 1)[0] == split_name and '.tmp.' not in name and \
+                not (path == split_directory and is_complete(path)):
+            shutil.rmtree(path, ignore_errors=True)
+
+    logger.info("Caching {} in {}...".format(data_path, split_directory))
+    temporary_directory = split_directory + '.tmp.{}'.format(os.getpid())
+    convert_split(data_path, temporary_directory, input_vocab, target_vocab)
+    try:
+        os.replace(temporary_directory, split_directory)
+    except OSError:
+        # another process published the split first
+        if not is_complete(split_directory):
+            raise
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    return split_directory
+
+
+def cached_dataloader(data_path, batch_size=32, use_cuda=False, fix_length=None, input_vocab=None, target_vocab=None,
+                      random_shuffle=True, bucket_keys=None, sparse_situations=False, cache_directory=None):
+    """
+    Same interface as dataloader() on a .json split, but the vocabularies (when not given) and the integer-encoded
+    split are read from the cache, which is rebuilt automatically whenever the contents of data_path change.
+    """
+    cache_directory = cache_directory or os.path.join(os.path.dirname(os.path.abspath(data_path)), '.cache')
+    if input_vocab is None or target_vocab is None:
+        input_vocab, target_vocab = cached_vocabularies(data_path, cache_directory)
+    split_directory = cached_split(data_path, input_vocab, target_vocab, cache_directory)
+    return memmap_dataloader(split_directory, batch_size=batch_size, use_cuda=use_cuda, fix_length=fix_length,
+                             random_shuffle=random_shuffle, bucket_keys=bucket_keys,
+                             sparse_situations=sparse_situations)
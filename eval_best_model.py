@@ -3,46 +3,32 @@ import os
 
 from torch.optim.lr_scheduler import LambdaLR
 
-from dataloader import dataloader
+from dataloader import Vocabulary, dataloader, memmap_dataloader
+from dataset_cache import cached_dataloader
+from evaluate_splits import SPLITS, evaluate_splits
 from model.config import cfg
 from model.model import GSCAN_model
 from model.utils import *
 
 
-def evaluate(data_iterator, model, max_decoding_steps, pad_idx, sos_idx, eos_idx, max_examples_to_evaluate=None):
-    target_accuracies = []
-    exact_match = 0
-    num_examples = 0
-    correct_terms = 0
-    total_terms = 0
-    for input_sequence, output_sequence, target_sequence, _, _, aux_acc_target in predict(
-            data_iterator=data_iterator, model=model, max_decoding_steps=max_decoding_steps, pad_idx=pad_idx,
-            sos_idx=sos_idx, eos_idx=eos_idx, max_examples_to_evaluate=max_examples_to_evaluate):
-        num_examples += output_sequence.shape[0]
-        seq_eq = torch.eq(output_sequence, target_sequence)
-        mask = torch.eq(target_sequence, pad_idx) + torch.eq(target_sequence, sos_idx)
-        seq_eq.masked_fill_(mask, 0)
-        total = (~mask).sum(-1).float()
-        accuracy = seq_eq.sum(-1) / total
-        total_terms += total.sum().data.item()
-        correct_terms += seq_eq.sum().data.item()
-        exact_match += accuracy.eq(1.).sum().data.item()
-        target_accuracies.append(aux_acc_target)
-    return (float(correct_terms) / total_terms) * 100, (exact_match / num_examples) * 100, \
-           float(np.mean(np.array(target_accuracies))) * 100
-
-
 def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, resume_from_file: str, is_baseline: bool):
     device = torch.device(type='cuda') if use_cuda else torch.device(type='cpu')
 
+    load_data = {"json": dataloader, "memmap": memmap_dataloader, "cached": cached_dataloader}[cfg.DATA_FORMAT]
+    input_vocab, target_vocab = None, None
+    if cfg.LOAD_VOCABULARIES:
+        input_vocab, target_vocab = Vocabulary.load(cfg.INPUT_VOCAB_PATH), Vocabulary.load(cfg.TARGET_VOCAB_PATH)
     logger.info("Loading Training set...")
-    train_iter, train_input_vocab, train_target_vocab = dataloader(train_data_path,
-                                                                   batch_size=cfg.TRAIN.BATCH_SIZE,
-                                                                   use_cuda=use_cuda)
+    train_iter, train_input_vocab, train_target_vocab = load_data(train_data_path,
+                                                                  batch_size=cfg.TRAIN.BATCH_SIZE,
+                                                                  use_cuda=use_cuda,
+                                                                  input_vocab=input_vocab, target_vocab=target_vocab,
+                                                                  sparse_situations=cfg.SPARSE_SITUATIONS)
     val_iters = {}
     for split_name, path in val_data_paths.items():
-        val_iters[split_name], _, _ = dataloader(path, batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
-                                                 input_vocab=train_input_vocab, target_vocab=train_target_vocab)
+        val_iters[split_name], _, _ = load_data(path, batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
+                                                input_vocab=train_input_vocab, target_vocab=train_target_vocab,
+                                                sparse_situations=cfg.SPARSE_SITUATIONS)
 
     pad_idx, sos_idx, eos_idx = train_target_vocab.stoi['<pad>'], train_target_vocab.stoi['<sos>'], \
                                 train_target_vocab.stoi['<eos>']
@@ -79,32 +65,24 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, resume_fro
         model.eval()
         logger.info("Evaluating..")
         print(val_iters)
-        for split_name, val_iter in val_iters.items():
-            accuracy, exact_match, target_accuracy = evaluate(
-                val_iter, model=model,
+        for split_name, (accuracy, exact_match, target_accuracy), _ in evaluate_splits(
+                model, val_iters,
                 max_decoding_steps=30, pad_idx=pad_idx,
                 sos_idx=sos_idx,
                 eos_idx=eos_idx,
-                max_examples_to_evaluate=None)
+                num_workers=cfg.EVAL_NUM_WORKERS):
             logger.info(" %s Accuracy: %5.2f Exact Match: %5.2f "
                         " Target Accuracy: %5.2f " % (split_name, accuracy, exact_match, target_accuracy))
 
 
 def main(flags, use_cuda):
-    train_data_path = os.path.join(cfg.DATA_DIRECTORY, "train.json")
-
-    test_splits = [
-        'situational_1',
-        'situational_2',
-        'test',
-        'visual',
-        'visual_easier',
-        'dev',
-        'adverb_1',
-        'adverb_2',
-        'contextual',
-    ]
-    val_data_paths = {split_name: os.path.join(cfg.DATA_DIRECTORY, split_name + '.json') for split_name in test_splits}
+    if cfg.DATA_FORMAT == "memmap":
+        data_directory, extension = cfg.MEMMAP_DIRECTORY, ''
+    else:
+        data_directory, extension = cfg.DATA_DIRECTORY, '.json'
+    train_data_path = os.path.join(data_directory, "train" + extension)
+
+    val_data_paths = {split_name: os.path.join(data_directory, split_name + extension) for split_name in flags.splits}
 
     if cfg.MODE == "train":
         train(train_data_path=train_data_path, val_data_paths=val_data_paths, use_cuda=use_cuda,
@@ -133,6 +111,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="LGCN models for GSCAN")
     parser.add_argument('--load', type=str, help='Path to model')
     parser.add_argument('--baseline', dest='is_baseline', action='store_true')
+    parser.add_argument('--splits', type=str, nargs='*', default=SPLITS, help='Splits to evaluate, all by default.')
     parser.set_defaults(is_baseline=False)
     args = parser.parse_args()
 
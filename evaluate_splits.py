@@ -0,0 +1,236 @@
+import argparse
+import copy
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import torch
+
+from dataloader import Vocabulary, dataloader, memmap_dataloader
+from dataset_cache import cached_dataloader
+from model.config import cfg
+from model.model import GSCAN_model
+from model.utils import evaluate
+
+# Evaluates a model on several splits concurrently: the model's parameters are moved to shared memory once and a pool
+# of forked worker processes, one per split up to the number of cores, runs evaluate() on them, so that the total time
+# approaches the one of the largest split. Results are logged as the splits finish:
+#   python evaluate_splits.py --checkpoint exp/model_best.pth.tar
+#   python evaluate_splits.py --checkpoint exp/model_best.pth.tar --splits dev test visual
+
+logger = logging.getLogger(__name__)
+
+SPLITS = ['situational_1', 'situational_2', 'test', 'visual', 'visual_easier', 'dev', 'adverb_1', 'adverb_2',
+          'contextual']
+
+# set in every worker by _initialize_worker, inherited through fork instead of being pickled
+_worker_state = {}
+
+
+def _initialize_worker(model, data_iterators, decoding_arguments, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker_state.update(model=model, data_iterators=data_iterators, decoding_arguments=decoding_arguments)
+
+
+def _evaluate_split(split_name):
+    start = time.time()
+    with torch.no_grad():
+        results = evaluate(_worker_state['data_iterators'][split_name], model=_worker_state['model'],
+                           **_worker_state['decoding_arguments'])
+    return split_name, results, time.time() - start
+
+
+def evaluate_splits(model, data_iterators, max_decoding_steps, pad_idx, sos_idx, eos_idx, num_workers=1):
+    """
+    Evaluates model on every iterator of data_iterators in a pool of worker processes. The workers are forked, so they
+    share the iterators with this process and the model's parameters through shared memory (model.share_memory()):
+    nothing is copied or reloaded per split. The largest splits are started first. CUDA models and num_workers=1, the
+    default, evaluate the splits one after the other in this process. The workers share the cores, unless this process
+    used several threads: OpenMP threads do not survive the fork, so its workers get a single thread each.
+    :param data_iterators: {split name: iterator over its batches}
+    :param num_workers: number of worker processes, 0 for one per core (at most one per split)
+    :return: generator of (split name, (accuracy, exact match, target accuracy), seconds) in order of completion
+    """
+    model.eval()
+    decoding_arguments = dict(max_decoding_steps=max_decoding_steps, pad_idx=pad_idx, sos_idx=sos_idx, eos_idx=eos_idx)
+    num_cores = os.cpu_count() or 1
+    num_workers = min(num_workers or num_cores, len(data_iterators))
+    split_names = sorted(data_iterators, key=lambda split_name: len(data_iterators[split_name]), reverse=True)
+    if num_workers <= 1 or next(model.parameters()).is_cuda:
+        _initialize_worker(model, data_iterators, decoding_arguments, torch.get_num_threads())
+        for split_name in split_names:
+            yield _evaluate_split(split_name)
+        return
+
+    model.share_memory()
+    num_threads = max(1, num_cores // num_workers) if torch.get_num_threads() == 1 else 1
+    context = multiprocessing.get_context('fork')
+    with context.Pool(num_workers, initializer=_initialize_worker,
+                      initargs=(model, data_iterators, decoding_arguments, num_threads)) as pool:
+        for result in pool.imap_unordered(_evaluate_split, split_names):
+            yield result
+
+
+class BackgroundEvaluator(object):
+    """
+    Evaluates snapshots of a model's weights with evaluate_splits() in a forked worker process, so that training goes
+    on during the evaluation. The worker owns a CPU copy of the model (the data iterators must yield CPU batches), loads
+    every snapshot into it and evaluates the splits one after the other with num_threads threads: it occupies that many
+    cores next to the threads of the training process, which it would otherwise inherit and compete with on every core.
+    A forked process cannot use several OpenMP threads once its parent did, so more than one thread needs a
+    single-threaded training process. At most queue_size snapshots wait for the worker; submitting another one while
+    the queue is full skips the oldest waiting snapshot.
+    """
+
+    def __init__(self, model, data_iterators, max_decoding_steps, pad_idx, sos_idx, eos_idx, queue_size=1,
+                 num_threads=1):
+        if num_threads > 1 and torch.get_num_threads() > 1:
+            raise ValueError("The background evaluation can only use {} threads when training uses a single one, not "
+                             "{}.".format(num_threads, torch.get_num_threads()))
+        context = multiprocessing.get_context('fork')
+        self.snapshot_queue = context.Queue(maxsize=queue_size)
+        self.result_queue = context.Queue()
+        self.snapshots = {}  # iteration -> checkpoint state of the submitted snapshots, until their results arrive
+        worker_model = copy.deepcopy(model).cpu()
+        decoding_arguments = dict(max_decoding_steps=max_decoding_steps, pad_idx=pad_idx, sos_idx=sos_idx,
+                                  eos_idx=eos_idx, num_workers=1)
+        self.worker = context.Process(target=self.evaluate_snapshots, name="background-evaluation",
+                                      args=(worker_model, data_iterators, decoding_arguments, num_threads),
+                                      daemon=True)
+        self.worker.start()
+
+    def evaluate_snapshots(self, model, data_iterators, decoding_arguments, num_threads):
+        # runs in the worker process, a None snapshot stops it
+        torch.set_num_threads(num_threads)
+        for iteration, model_state_dict in iter(self.snapshot_queue.get, None):
+            split_results = None
+            try:
+                model.load_state_dict(model_state_dict)
+                split_results = {}
+                for split_name, results, seconds in evaluate_splits(model, data_iterators, **decoding_arguments):
+                    split_results[split_name] = results
+                    logger.info(" %s Accuracy: %5.2f Exact Match: %5.2f  Target Accuracy: %5.2f (iteration %d)"
+                                % ((split_name,) + tuple(results) + (iteration,)))
+            except Exception:
+                logger.exception("Evaluation of iteration {} failed.".format(iteration))
+            self.result_queue.put((iteration, split_results))
+
+    def submit(self, iteration, model, optimizer):
+        """Snapshots the weights of model and the state of optimizer, and queues the weights for evaluation."""
+        model_state_dict = {name: tensor.detach().to('cpu', copy=True) for name, tensor in model.state_dict().items()}
+        self.snapshots[iteration] = {'model_state_dict': model_state_dict,
+                                     'optimizer_state_dict': copy.deepcopy(optimizer.state_dict())}
+        while True:
+            try:
+                self.snapshot_queue.put_nowait((iteration, model_state_dict))
+                return
+            except queue.Full:
+                pass
+            try:
+                skipped_iteration, _ = self.snapshot_queue.get_nowait()
+            except queue.Empty:  # the worker took the waiting snapshot in the meantime
+                continue
+            del self.snapshots[skipped_iteration]
+            logger.info("Evaluation still busy, skipping the snapshot of iteration {}.".format(skipped_iteration))
+
+    def finished(self, wait=False, timeout=None):
+        """
+        :param wait: block until the results of every submitted snapshot arrived
+        :param timeout: seconds to wait at most, forever if None
+        :return: list of (iteration, {split name: (accuracy, exact match, target accuracy)}, checkpoint state with the
+        snapshot's model_state_dict and optimizer_state_dict) of the evaluations that finished since the last call,
+        failed evaluations are left out
+        :raises RuntimeError: if the worker died with snapshots left to evaluate
+        :raises TimeoutError: if waiting took longer than timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        finished = []
+        while self.snapshots:
+            try:
+                # wake up every second to check that the worker is still there to send the results
+                iteration, split_results = self.result_queue.get(timeout=1.) if wait else \
+                    self.result_queue.get_nowait()
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError("The background evaluation died (exit code {}) before evaluating the snapshots "
+                                       "of iterations {}.".format(self.worker.exitcode, sorted(self.snapshots)))
+                if not wait:
+                    break
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError("The background evaluation did not finish in {} s.".format(timeout))
+                continue
+            snapshot = self.snapshots.pop(iteration)
+            if split_results is not None:
+                finished.append((iteration, split_results, snapshot))
+        return finished
+
+    def close(self, timeout=None):
+        """
+        Waits for the evaluation of the submitted snapshots and stops the worker, which is killed if that fails.
+        :param timeout: seconds to wait for the evaluations at most, forever if None
+        :return: finished() of the snapshots that were still being evaluated
+        :raises RuntimeError: if the worker died with snapshots left to evaluate
+        :raises TimeoutError: if the evaluations took longer than timeout
+        """
+        try:
+            finished = self.finished(wait=True, timeout=timeout)
+        except (RuntimeError, TimeoutError):
+            self.worker.terminate()
+            self.worker.join()
+            raise
+        self.snapshot_queue.put(None)
+        self.worker.join()
+        return finished
+
+
+def main(flags):
+    use_cuda = torch.cuda.is_available() and not flags.cpu
+    if cfg.DATA_FORMAT == "memmap":
+        data_directory, extension = cfg.MEMMAP_DIRECTORY, ''
+    else:
+        data_directory, extension = cfg.DATA_DIRECTORY, '.json'
+    load_data = {"json": dataloader, "memmap": memmap_dataloader, "cached": cached_dataloader}[cfg.DATA_FORMAT]
+
+    if cfg.LOAD_VOCABULARIES:
+        input_vocab, target_vocab = Vocabulary.load(cfg.INPUT_VOCAB_PATH), Vocabulary.load(cfg.TARGET_VOCAB_PATH)
+    else:
+        _, input_vocab, target_vocab = load_data(os.path.join(data_directory, "train" + extension),
+                                                 batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda)
+    data_iterators = {}
+    for split_name in flags.splits:
+        data_iterators[split_name], _, _ = load_data(os.path.join(data_directory, split_name + extension),
+                                                     batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
+                                                     input_vocab=input_vocab, target_vocab=target_vocab,
+                                                     random_shuffle=False, sparse_situations=cfg.SPARSE_SITUATIONS)
+    pad_idx, sos_idx, eos_idx = target_vocab.stoi['<pad>'], target_vocab.stoi['<sos>'], target_vocab.stoi['<eos>']
+
+    model = GSCAN_model(pad_idx, eos_idx, len(input_vocab.itos), len(target_vocab.itos), is_baseline=flags.is_baseline)
+    model = model.cuda() if use_cuda else model
+    assert os.path.isfile(flags.checkpoint), "No checkpoint found at {}".format(flags.checkpoint)
+    logger.info("Loading checkpoint from file at '{}'".format(flags.checkpoint))
+    model.load_model(flags.checkpoint)
+
+    start = time.time()
+    for split_name, (accuracy, exact_match, target_accuracy), seconds in evaluate_splits(
+            model, data_iterators, max_decoding_steps=flags.max_decoding_steps, pad_idx=pad_idx, sos_idx=sos_idx,
+            eos_idx=eos_idx, num_workers=flags.num_workers):
+        logger.info(" %s Accuracy: %5.2f Exact Match: %5.2f  Target Accuracy: %5.2f (%.1f s)"
+                    % (split_name, accuracy, exact_match, target_accuracy, seconds))
+    logger.info("Evaluated {} splits in {:.1f} s.".format(len(data_iterators), time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate a model on several splits concurrently")
+    parser.add_argument('--checkpoint', type=str, required=True, help='Path to model')
+    parser.add_argument('--baseline', dest='is_baseline', action='store_true')
+    parser.add_argument('--splits', type=str, nargs='*', default=SPLITS, help='Splits to evaluate, all by default.')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Worker processes, one per core (at most one per split) by default.')
+    parser.add_argument('--max_decoding_steps', type=int, default=cfg.TEST.MAX_DECODING_STEP)
+    parser.add_argument('--cpu', action='store_true', help='Evaluate on CPU even if CUDA is available.')
+    parser.set_defaults(is_baseline=False)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    main(args)
@@ -1,10 +1,15 @@
 import argparse
 import os
 import sys
+import time
 
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import LambdaLR
 
-from dataloader import dataloader
+from dataloader import MemmapIterator, PrefetchIterator, Vocabulary, dataloader, memmap_dataloader
+from dataset_cache import cached_dataloader
+from evaluate_splits import BackgroundEvaluator, evaluate_splits
 from model.config import cfg
 from model.model import GSCAN_model
 from model.utils import *
@@ -12,15 +17,37 @@ from model.utils import *
 
 def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name: str, is_baseline: bool,
           resume_from_file=None):
+    # under torchrun, every process trains on its shard of the training set and only the first one evaluates and saves
+    distributed = dist.is_initialized()
+    is_main_process = not distributed or dist.get_rank() == 0
+    load_data = {"json": dataloader, "memmap": memmap_dataloader, "cached": cached_dataloader}[cfg.DATA_FORMAT]
+    input_vocab, target_vocab = None, None
+    if cfg.LOAD_VOCABULARIES:
+        input_vocab, target_vocab = Vocabulary.load(cfg.INPUT_VOCAB_PATH), Vocabulary.load(cfg.TARGET_VOCAB_PATH)
     logger.info("Loading Training set...")
     logger.info(model_name)
-    train_iter, train_input_vocab, train_target_vocab = dataloader(train_data_path,
-                                                                   batch_size=cfg.TRAIN.BATCH_SIZE,
-                                                                   use_cuda=use_cuda)
+    if distributed and not is_main_process:
+        dist.barrier()  # the first process builds the cached split and vocabularies, the others open them after
+    train_iter, train_input_vocab, train_target_vocab = load_data(train_data_path,
+                                                                  batch_size=cfg.TRAIN.BATCH_SIZE,
+                                                                  use_cuda=use_cuda,
+                                                                  input_vocab=input_vocab, target_vocab=target_vocab,
+                                                                  sparse_situations=cfg.SPARSE_SITUATIONS,
+                                                                  bucket_keys=cfg.TRAIN.BUCKET_KEYS or None)
+    if distributed and is_main_process:
+        dist.barrier()
+    if distributed:
+        assert isinstance(train_iter, MemmapIterator), "Distributed training needs the memmap or cached data format."
+        train_iter.set_shard(dist.get_world_size(), dist.get_rank())
+    if cfg.TRAIN.NUM_LOADER_WORKERS > 0:
+        train_iter = PrefetchIterator(train_iter, num_workers=cfg.TRAIN.NUM_LOADER_WORKERS,
+                                      prefetch_depth=cfg.TRAIN.PREFETCH_DEPTH, pin_memory=use_cuda)
     val_iters = {}
-    for split_name, path in val_data_paths.items():
-        val_iters[split_name], _, _ = dataloader(path, batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
-                                                 input_vocab=train_input_vocab, target_vocab=train_target_vocab)
+    for split_name, path in (val_data_paths.items() if is_main_process else []):
+        val_iters[split_name], _, _ = load_data(path, batch_size=cfg.VAL_BATCH_SIZE,
+                                                use_cuda=use_cuda and not cfg.TRAIN.BACKGROUND_EVALUATION,
+                                                input_vocab=train_input_vocab, target_vocab=train_target_vocab,
+                                                sparse_situations=cfg.SPARSE_SITUATIONS)
 
     pad_idx, sos_idx, eos_idx = train_target_vocab.stoi['<pad>'], train_target_vocab.stoi['<sos>'], \
                                 train_target_vocab.stoi['<eos>']
@@ -36,9 +63,11 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name
     '''
     logger.info("Done Loading Training set.")
 
-    # if generate_vocabularies:
-    #     training_set.save_vocabularies(input_vocab_path, target_vocab_path)
-    #     logger.info("Saved vocabularies to {} for input and {} for target.".format(input_vocab_path, target_vocab_path))
+    if cfg.GENERATE_VOCABULARIES:
+        Vocabulary(train_input_vocab.itos).save(cfg.INPUT_VOCAB_PATH)
+        Vocabulary(train_target_vocab.itos).save(cfg.TARGET_VOCAB_PATH)
+        logger.info("Saved vocabularies to {} for input and {} for target.".format(cfg.INPUT_VOCAB_PATH,
+                                                                                   cfg.TARGET_VOCAB_PATH))
 
     logger.info("Loading Dev. set...")
 
@@ -72,6 +101,18 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name
         start_iteration = model.trained_iterations
         logger.info("Loaded checkpoint '{}' (iter {})".format(resume_from_file, start_iteration))
 
+    # gradients are averaged over the processes during the backward pass, DistributedDataParallel also makes every
+    # process start from the weights of the first one. Some parameters never get a gradient (e.g. the situation
+    # embeddings of the baseline), hence find_unused_parameters.
+    training_model = DistributedDataParallel(model, find_unused_parameters=True) if distributed else model
+
+    background_evaluator = None
+    if cfg.TRAIN.BACKGROUND_EVALUATION and is_main_process:
+        background_evaluator = BackgroundEvaluator(model, val_iters, max_decoding_steps=30, pad_idx=pad_idx,
+                                                   sos_idx=sos_idx, eos_idx=eos_idx,
+                                                   queue_size=cfg.TRAIN.EVALUATION_QUEUE_SIZE,
+                                                   num_threads=cfg.TRAIN.EVALUATION_NUM_THREADS)
+
     logger.info("Training starts..")
     training_iteration = start_iteration
     while training_iteration < cfg.TRAIN.MAX_EPOCH:  # iterations here actually means "epoch"
@@ -79,11 +120,14 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name
         # Shuffle the dataset and loop over it.
         # training_set.shuffle_data()
         num_batch = 0
+        num_examples, epoch_start = 0, time.time()
+        if distributed:
+            np.random.seed(cfg.TRAIN.DISTRIBUTED_SEED + training_iteration)
         for x in train_iter:
             is_best = False
             model.train()
-            target_scores, target_position_scores = model(x.input, x.situation,
-                                                          x.target)
+            target_scores, target_position_scores = training_model(x.input, x.situation,
+                                                                   x.target)
 
             loss = model.get_loss(target_scores, x.target[0])
 
@@ -99,9 +143,12 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name
             scheduler.step()
             optimizer.zero_grad()
             model.update_state(is_best=is_best)
+            if background_evaluator is not None:
+                best_exact_match = save_best_snapshots(model, model_name, background_evaluator.finished(),
+                                                       best_exact_match)
 
             # Print current metrics.
-            if num_batch % cfg.PRINT_EVERY == 0:
+            if is_main_process and num_batch % cfg.PRINT_EVERY == 0:
                 accuracy, exact_match = model.get_metrics(target_scores, x.target[0])
                 if cfg.AUXILIARY_TASK:
                     auxiliary_accuracy_target = model.get_auxiliary_accuracy(target_position_scores,
@@ -114,21 +161,39 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name
                                                                  learning_rate, auxiliary_accuracy_target))
 
             num_batch += 1
-
-        if training_iteration % cfg.EVALUATE_EVERY == 0:
+            num_examples += x.target[0].size(0)
+
+        num_processes = dist.get_world_size() if distributed else 1
+        logger.info("Epoch %d: %8.1f training examples/s over %d processes"
+                    % (training_iteration, num_processes * num_examples / (time.time() - epoch_start), num_processes))
+        loader_statistics = getattr(train_iter, 'statistics', None)
+        if loader_statistics is not None and loader_statistics['batches'] > 0:
+            logger.info("Input pipeline: mean queue depth %4.2f / %d, stalled %6.2fs over %d batches"
+                        % (loader_statistics['queue_depth_sum'] / loader_statistics['batches'],
+                           cfg.TRAIN.PREFETCH_DEPTH, loader_statistics['stall_seconds'],
+                           loader_statistics['batches']))
+        # the padding statistics of bucketed batches, memmap or json
+        statistics = getattr(train_iter, 'epoch_statistics', None)
+        if statistics is not None:
+            logger.info("Target padding efficiency %5.2f (uniform batches %5.2f), decoder steps %d (uniform batches %d)"
+                        % (100. * statistics['padding_efficiency'], 100. * statistics['uniform_padding_efficiency'],
+                           statistics['decoder_steps'], statistics['uniform_decoder_steps']))
+
+        if training_iteration % cfg.EVALUATE_EVERY == 0 and background_evaluator is not None:
+            background_evaluator.submit(training_iteration, model, optimizer)
+        elif is_main_process and training_iteration % cfg.EVALUATE_EVERY == 0:
             with torch.no_grad():
                 model.eval()
                 logger.info("Evaluating..")
                 test_exact_match = 0
                 test_accuracy = 0
                 try:
-                    for split_name, val_iter in val_iters.items():
-                        accuracy, exact_match, target_accuracy = evaluate(
-                            val_iter, model=model,
+                    for split_name, (accuracy, exact_match, target_accuracy), _ in evaluate_splits(
+                            model, val_iters,
                             max_decoding_steps=30, pad_idx=pad_idx,
                             sos_idx=sos_idx,
                             eos_idx=eos_idx,
-                            max_examples_to_evaluate=None)
+                            num_workers=cfg.EVAL_NUM_WORKERS):
                         if split_name == 'dev':
                             test_exact_match = exact_match
                             test_accuracy = accuracy
@@ -150,25 +215,52 @@ def train(train_data_path: str, val_data_paths: dict, use_cuda: bool, model_name
                     model.save_checkpoint(file_name=file_name, is_best=is_best,
                                           optimizer_state_dict=optimizer.state_dict())
 
-        if training_iteration % cfg.SAVE_EVERY == 0:
+        if is_main_process and training_iteration % cfg.SAVE_EVERY == 0:
             logger.info("forcing to save model every several epochs...")
             file_name = model_name + " checkpoint_force.{}th.tar".format(str(training_iteration))
             # file_name = os.path.join(os.getcwd(), cfg.OUTPUT_DIRECTORY, model_name, file_name)
-            model.save_checkpoint(file_name=file_name, is_best=False, optimizer_state_dict=optimizer.state_dict())
+            model.save_checkpoint(file_name=file_name, is_best=False, optimizer_state_dict=optimizer.state_dict(),
+                                  rotate=True)
 
         training_iteration += 1  # warning: iteratin represents epochs here
+    if background_evaluator is not None:
+        save_best_snapshots(model, model_name, background_evaluator.close(), best_exact_match)
+    model.wait_for_checkpoints()
     logger.info("Finished training.")
 
 
+def save_best_snapshots(model, model_name, finished, best_exact_match):
+    """
+    Saves the snapshots evaluated by a BackgroundEvaluator that beat best_exact_match on the dev split, like the
+    evaluation at the end of an epoch saves the current weights.
+    :param finished: BackgroundEvaluator.finished()
+    :return: the new best exact match
+    """
+    for iteration, split_results, snapshot in finished:
+        accuracy, exact_match, _ = split_results.get('dev', (0, 0, 0))
+        if exact_match > best_exact_match:
+            best_exact_match = exact_match
+            model.update_state(accuracy=accuracy, exact_match=exact_match, is_best=True)
+            logger.info("saving best model of iteration {}...".format(iteration))
+            model.save_checkpoint(file_name=model_name + "checkpoint.{}th.tar".format(str(iteration)), is_best=True,
+                                  optimizer_state_dict=snapshot['optimizer_state_dict'],
+                                  model_state_dict=snapshot['model_state_dict'])
+    return best_exact_match
+
+
 def main(flags, use_cuda):
-    if not os.path.exists(os.path.join(cfg.OUTPUT_DIRECTORY, flags.run)):
-        os.mkdir(os.path.join(os.getcwd(), cfg.OUTPUT_DIRECTORY, flags.run))
+    # every process of a distributed run gets here
+    os.makedirs(os.path.join(os.getcwd(), cfg.OUTPUT_DIRECTORY, flags.run), exist_ok=True)
 
     # Some checks on the flags
     if cfg.GENERATE_VOCABULARIES:
         assert cfg.INPUT_VOCAB_PATH and cfg.TARGET_VOCAB_PATH, "Please specify paths to vocabularies to save."
 
-    train_data_path = os.path.join(cfg.DATA_DIRECTORY, "train.json")
+    if cfg.DATA_FORMAT == "memmap":
+        data_directory, extension = cfg.MEMMAP_DIRECTORY, ''
+    else:
+        data_directory, extension = cfg.DATA_DIRECTORY, '.json'
+    train_data_path = os.path.join(data_directory, "train" + extension)
 
     test_splits = [
         'situational_1',
@@ -180,7 +272,7 @@ def main(flags, use_cuda):
         'adverb_2',
         'contextual'
     ]
-    val_data_paths = {split_name: os.path.join(cfg.DATA_DIRECTORY, split_name + '.json') for split_name in test_splits}
+    val_data_paths = {split_name: os.path.join(data_directory, split_name + extension) for split_name in test_splits}
 
     if cfg.MODE == "train":
         if flags.is_baseline:
@@ -207,8 +299,18 @@ if __name__ == "__main__":
     parser.set_defaults(redirect_output=False, is_baseline=False)
     args = parser.parse_args()
     FORMAT = "%(asctime)-15s %(message)s"
-
-    if args.redirect_output:
+    # Data-parallel training starts one process per core group with torchrun, which sets RANK and WORLD_SIZE; the
+    # arguments of main_model.py follow --, otherwise torchrun takes --run for its own --run_path:
+    #   torchrun --nproc_per_node 8 main_model.py -- --run NAME
+    # and on each of several nodes, with the same rendezvous endpoint:
+    #   torchrun --nnodes 4 --nproc_per_node 8 --rdzv_backend c10d --rdzv_endpoint HOST:29500 \
+    #       main_model.py -- --run NAME
+    rank = int(os.environ.get('RANK', 0))
+
+    if rank > 0:
+        logging.basicConfig(format=FORMAT, level=logging.WARNING,
+                            datefmt="%Y-%m-%d %H:%M")
+    elif args.redirect_output:
         output_file = open(os.path.join('exp/', args.run + '.txt'), 'w')
         sys.stdout = output_file
         sys.stderr = sys.stdout
@@ -226,4 +328,15 @@ if __name__ == "__main__":
         logger.info("Using CUDA.")
         logger.info("Cuda version: {}".format(torch.version.cuda))
 
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        dist.init_process_group(backend=cfg.TRAIN.DISTRIBUTED_BACKEND)
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        # the processes of a node share its cores
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        if use_cuda:
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+        logger.info("Process {} of {}, {} threads.".format(rank, dist.get_world_size(), torch.get_num_threads()))
+
     main(args, use_cuda)
+    if dist.is_initialized():
+        dist.destroy_process_group()
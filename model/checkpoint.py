@@ -0,0 +1,105 @@
+import collections
+import concurrent.futures
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+BEST_CHECKPOINT = 'model_best.pth.tar'
+
+_writers = {}  # output directory -> its CheckpointWriter
+
+
+def cpu_copy(state):
+    """:return: copy of state (nested dicts, lists and tuples of tensors) with every tensor copied to the CPU"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        copied = type(state)((key, cpu_copy(value)) for key, value in state.items())
+        if hasattr(state, '_metadata'):  # module versions of a state_dict, read by load_state_dict
+            copied._metadata = state._metadata
+        return copied
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(value) for value in state)
+    return state
+
+
+def replace_with_link(source, link_path):
+    """Atomically points link_path at the file source: a hardlink, or a relative symlink where hardlinks fail."""
+    temporary_path = link_path + '.tmp.{}'.format(os.getpid())
+    try:
+        os.link(source, temporary_path)
+    except OSError:
+        os.symlink(os.path.relpath(source, os.path.dirname(link_path)), temporary_path)
+    os.replace(temporary_path, link_path)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread: save() copies the state to the CPU, so training can go on modifying its
+    tensors, and returns; the thread writes it to a temporary file renamed over the checkpoint, so a checkpoint on
+    disk is always complete. The best checkpoint is linked to, not copied, as model_best.pth.tar. Only the last
+    keep_last rotated checkpoints are kept.
+    """
+
+    def __init__(self, output_directory, keep_last=0):
+        """:param keep_last: number of rotated checkpoints kept on disk, 0 keeps all"""
+        self.output_directory = output_directory
+        self.keep_last = keep_last
+        self.rotated_paths = collections.deque()
+        self.best_path = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint-writer')
+        self.pending = []
+
+    def save(self, file_name, state, is_best=False, rotate=False):
+        """
+        :param state: dictionary to save with torch.save
+        :param is_best: link model_best.pth.tar to the checkpoint once it is written
+        :param rotate: count the checkpoint among the keep_last ones, deleting the oldest
+        :return: path the checkpoint is written to
+        """
+        self.raise_errors()
+        path = os.path.join(self.output_directory, file_name)
+        self.pending.append(self.executor.submit(self.write, path, cpu_copy(state), is_best, rotate))
+        return path
+
+    def write(self, path, state, is_best, rotate):
+        temporary_path = path + '.tmp.{}'.format(os.getpid())
+        with open(temporary_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+        if is_best:
+            replace_with_link(path, os.path.join(self.output_directory, BEST_CHECKPOINT))
+            self.best_path = path
+        if rotate:
+            self.rotated_paths.append(path)
+            while self.keep_last and len(self.rotated_paths) > self.keep_last:
+                old_path = self.rotated_paths.popleft()
+                # a symlinked best checkpoint needs its target, a hardlinked one does not
+                if old_path != self.best_path or not os.path.islink(os.path.join(self.output_directory,
+                                                                                  BEST_CHECKPOINT)):
+                    os.remove(old_path)
+                    logger.info("Removed checkpoint {}.".format(old_path))
+
+    def raise_errors(self):
+        """Re-raises the error of any checkpoint that failed to be written."""
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def wait(self):
+        """Blocks until every checkpoint saved so far is written."""
+        concurrent.futures.wait(self.pending)
+        self.raise_errors()
+
+
+def checkpoint_writer(output_directory, keep_last=0):
+    """:return: the CheckpointWriter of output_directory, created with keep_last on first use"""
+    if output_directory not in _writers:
+        _writers[output_directory] = CheckpointWriter(output_directory, keep_last=keep_last)
+    return _writers[output_directory]
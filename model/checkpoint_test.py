@@ -0,0 +1,59 @@
+# TODO: use test framework instead of asserts
+import logging
+import os
+import tempfile
+import time
+
+import torch
+
+from model.checkpoint import BEST_CHECKPOINT, CheckpointWriter
+
+logger = logging.getLogger(__name__)
+
+
+def test_checkpoint_writer_copies_state_before_writing():
+    start = time.time()
+    with tempfile.TemporaryDirectory() as output_directory:
+        writer = CheckpointWriter(output_directory)
+        weights = torch.zeros(4)
+        path = writer.save('checkpoint.tar', {'model_state_dict': {'weights': weights}}, is_best=True)
+        weights.add_(1.)  # training goes on while the checkpoint is written
+        writer.wait()
+        assert torch.equal(torch.load(path)['model_state_dict']['weights'], torch.zeros(4)), \
+            "test_checkpoint_writer_copies_state_before_writing FAILED"
+        best_path = os.path.join(output_directory, BEST_CHECKPOINT)
+        assert os.path.samefile(best_path, path), "test_checkpoint_writer_copies_state_before_writing FAILED"
+        assert sorted(os.listdir(output_directory)) == sorted([BEST_CHECKPOINT, 'checkpoint.tar']), \
+            "test_checkpoint_writer_copies_state_before_writing FAILED"
+    end = time.time()
+    logger.info("test_checkpoint_writer_copies_state_before_writing PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_checkpoint_writer_keeps_last_rotated_checkpoints():
+    start = time.time()
+    with tempfile.TemporaryDirectory() as output_directory:
+        writer = CheckpointWriter(output_directory, keep_last=2)
+        writer.save('best.tar', {'epoch': 0}, is_best=True)
+        for epoch in range(1, 5):
+            writer.save('force.{}.tar'.format(epoch), {'epoch': epoch}, is_best=epoch == 1, rotate=True)
+        writer.wait()
+        assert sorted(os.listdir(output_directory)) == sorted([BEST_CHECKPOINT, 'best.tar', 'force.3.tar',
+                                                               'force.4.tar']), \
+            "test_checkpoint_writer_keeps_last_rotated_checkpoints FAILED"
+        # the best checkpoint outlives the rotated checkpoint it was linked to
+        assert torch.load(os.path.join(output_directory, BEST_CHECKPOINT))['epoch'] == 1, \
+            "test_checkpoint_writer_keeps_last_rotated_checkpoints FAILED"
+    end = time.time()
+    logger.info("test_checkpoint_writer_keeps_last_rotated_checkpoints PASSED in {} seconds".format(end - start))
+    return
+
+
+def run_all_tests():
+    test_checkpoint_writer_copies_state_before_writing()
+    test_checkpoint_writer_keeps_last_rotated_checkpoints()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    run_all_tests()
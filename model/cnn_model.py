@@ -1,11 +1,34 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from model.config import cfg
+
+
+class ContiguousGradient(torch.autograd.Function):
+    """
+    Identity whose backward returns a gradient with the default strides of its input. The gradient of a kernel sliced
+    out of the fused weight is a view of the fused weight's gradient; AccumulateGrad copies it to a contiguous gradient
+    except when the view passes for contiguous, as a 1x1 kernel's does whatever the strides of its size 1 dimensions,
+    and DistributedDataParallel then warns at every step that the gradient's strides do not match its bucket's.
+    """
+    @staticmethod
+    def forward(ctx, tensor):
+        return tensor.view_as(tensor)
+
+    @staticmethod
+    def backward(ctx, gradient):
+        return gradient.clone(memory_format=torch.contiguous_format)
 
 
 class ConvolutionalNet(nn.Module):
-    """Simple conv. net. Convolves the input channels but retains input image width."""
+    """
+    Simple conv. net. Convolves the input channels but retains input image width.
+    When fused (by default if cfg.FUSED_CONVOLUTION, which is off), the three convolutions run as a single one, see
+    fused_weight; conv_1, conv_2 and conv_3 hold the parameters either way, so checkpoints load in both modes.
+    """
     def __init__(self, num_channels: int, cnn_kernel_size: int, num_conv_channels: int, dropout_probability: float,
-                 stride=1, flatten_output=False):
+                 stride=1, flatten_output=False, fused=None):
         super(ConvolutionalNet, self).__init__()
         self.conv_1 = nn.Conv2d(in_channels=num_channels, out_channels=num_conv_channels, kernel_size=1,
                                 padding=0, stride=stride)
@@ -19,12 +42,47 @@ class ConvolutionalNet(nn.Module):
         self.layers = nn.Sequential(*layers)
         self.output_dimension = num_conv_channels * 3
         self.flatten_output = flatten_output
+        assert cnn_kernel_size % 2 == 1, "cnn_kernel_size must be odd to retain the image width."
+        self.kernel_size = max(5, cnn_kernel_size)
+        self.stride = stride
+        self.fused = cfg.FUSED_CONVOLUTION if fused is None else fused
+
+    def fused_weight(self):
+        """
+        The kernels of conv_1, conv_2 and conv_3 zero-embedded at the centre of the largest kernel and concatenated
+        along the output channels. The convolutions are applied to the image transposed to [width, height], which
+        amounts to convolving the image itself with the transposed kernels.
+        :return: [3 * num_conv_channels, image_channels, kernel_size, kernel_size] weight and [3 * num_conv_channels]
+        bias
+        """
+        weights = []
+        for conv in (self.conv_1, self.conv_2, self.conv_3):
+            margin = (self.kernel_size - conv.kernel_size[0]) // 2
+            weights.append(F.pad(ContiguousGradient.apply(conv.weight), [margin] * 4))
+        weight = torch.cat(weights).transpose(2, 3)
+        return weight, torch.cat([self.conv_1.bias, self.conv_2.bias, self.conv_3.bias])
 
     def forward(self, input_images: torch.Tensor) -> torch.Tensor:
         """
         :param input_images: [batch_size, image_width, image_width, image_channels]
         :return: [batch_size, image_width * image_width, num_conv_channels]
         """
+        if not self.fused:
+            return self.unfused_forward(input_images)
+        batch_size = input_images.size(0)
+        weight, bias = self.fused_weight()
+        # a channels-last view of the input, no copy: the convolution then also writes channels-last features, which
+        # are [batch_size, image_width, image_width, num_channels] once permuted back
+        input_images = input_images.permute(0, 3, 1, 2)
+        images_features = F.conv2d(input_images.contiguous(memory_format=torch.channels_last), weight, bias,
+                                   stride=self.stride, padding=self.kernel_size // 2)
+        images_features = self.layers(images_features.permute(0, 2, 3, 1))
+        _, image_dimension, _, num_channels = images_features.size()
+        if self.flatten_output:
+            return images_features.reshape(batch_size, image_dimension * image_dimension, num_channels)
+        return images_features.reshape(batch_size, image_dimension, image_dimension, num_channels)
+
+    def unfused_forward(self, input_images: torch.Tensor) -> torch.Tensor:
         batch_size = input_images.size(0)
         input_images = input_images.transpose(1, 3)
         conved_1 = self.conv_1(input_images)
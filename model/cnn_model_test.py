@@ -0,0 +1,51 @@
+# TODO: use test framework instead of asserts
+import logging
+import time
+
+import torch
+
+from model.cnn_model import ConvolutionalNet
+from model.testing import gradients_match, weighted_gradients
+
+logger = logging.getLogger(__name__)
+
+# (image_channels, cnn_kernel_size, num_conv_channels, flatten_output): the baseline and the LGCN situation encoders,
+# and a largest kernel smaller than conv_2's
+TEST_CONFIGURATIONS = [(16, 7, 50, False), (64, 7, 64, True), (16, 3, 8, False)]
+
+
+def test_fused_convolution_matches_unfused():
+    start = time.time()
+    for num_channels, cnn_kernel_size, num_conv_channels, flatten_output in TEST_CONFIGURATIONS:
+        torch.manual_seed(0)
+        fused_net = ConvolutionalNet(num_channels, cnn_kernel_size, num_conv_channels, 0.,
+                                     flatten_output=flatten_output, fused=True)
+        unfused_net = ConvolutionalNet(num_channels, cnn_kernel_size, num_conv_channels, 0.,
+                                       flatten_output=flatten_output, fused=False)
+        unfused_net.load_state_dict(fused_net.state_dict())
+        input_images = torch.randn(4, 6, 6, num_channels, requires_grad=True)
+
+        outputs, gradients = [], []
+        for net in (fused_net, unfused_net):
+            out = net(input_images)
+            inputs = [input_images] + list(net.parameters())
+            gradients.append(weighted_gradients(out, inputs))
+            outputs.append(out)
+        assert outputs[0].shape == outputs[1].shape, "test_fused_convolution_matches_unfused FAILED"
+        assert torch.allclose(outputs[0], outputs[1], atol=1e-5), "test_fused_convolution_matches_unfused FAILED"
+        assert gradients_match(*gradients, atol=1e-4), "test_fused_convolution_matches_unfused FAILED"
+        # DistributedDataParallel expects gradients laid out like their parameters
+        for parameter, fused_gradient in zip(fused_net.parameters(), gradients[0][1:]):
+            assert fused_gradient.stride() == parameter.stride(), "test_fused_convolution_matches_unfused FAILED"
+    end = time.time()
+    logger.info("test_fused_convolution_matches_unfused PASSED in {} seconds".format(end - start))
+    return
+
+
+def run_all_tests():
+    test_fused_convolution_matches_unfused()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    run_all_tests()
@@ -43,6 +43,12 @@ __C.GENERATE_VOCABULARIES = False
 __C.LOAD_VOCABULARIES = False
 __C.INPUT_VOCAB_PATH = ""
 __C.TARGET_VOCAB_PATH = ""
+__C.DATA_FORMAT = "json" # "json" (torchtext), "memmap" (see build_memmap_dataset.py) or "cached" (see dataset_cache.py)
+__C.MEMMAP_DIRECTORY = "data/memmap_dataset"
+__C.SPARSE_SITUATIONS = False # batches carry only the occupied cells (memmap and cached formats)
+# the situation features are one-hot blocks (gSCAN): embed them by table lookup, except for the memmap and cached splits
+# that recorded otherwise in their meta.json
+__C.SITUATION_LOOKUP_EMBEDDING = True
 
 __C.INIT_WRD_EMB_FROM_FILE = False
 __C.WRD_EMB_INIT_FILE = ''
@@ -60,12 +66,22 @@ __C.SITU_D_FEAT = 64 # 3 * D_CNN_OUTPUT if CNN then LGCN
 __C.SITU_D_CTX = 64 # 512
 __C.SITU_D_CMD = 64 # 512
 __C.SITU_D_CNN_OUTPUT = 64
+# run the three situation convolutions as one (kernels zero-embedded in the largest), fewer kernel launches but more
+# FLOPs: faster on GPU, about twice slower on CPU, see ConvolutionalNet in model/cnn_model.py
+__C.FUSED_CONVOLUTION = False
+__C.LGCN_BACKEND = "dense" # "dense" (padded masked attention) or "dgl" (DGL message passing), see model/gnn.py
+__C.GRAPH_EDGE_POLICY = "complete" # "complete", "knn", "row_column" or "radius", see EdgePolicy in model/gnn.py
+__C.GRAPH_KNN = 8 # incoming edges per node for the "knn" edge policy
+__C.GRAPH_RADIUS = 3 # grid distance of the "radius" edge policy
 #1
 
 ## Decoder
 __C.DEC_D_H = 64
 __C.DEC_NUM_LAYER = 1
 __C.DEC_CONDITIONAL_ATTENTION = True
+# teacher forcing with the per-step work reduced to attention and the recurrent matmul (single-layer decoder only), see
+# BahdanauAttentionDecoderRNN.teacher_forced_steps in model/decoder.py
+__C.DEC_FAST_TEACHER_FORCING = True
 
 
 
@@ -125,7 +141,13 @@ __C.AUXILIARY_TASK = False
 __C.TRAIN = AttrDict()
 __C.TRAIN.BATCH_SIZE = 64
 __C.VAL_BATCH_SIZE = 512
+# processes evaluating the splits at once: 1 evaluates them one after the other in the training process, more (0 = one
+# per core) fork the training process, threads included, and move the model to shared memory, see evaluate_splits.py
+__C.EVAL_NUM_WORKERS = 1
 __C.TRAIN.START_EPOCH = 0
+__C.TRAIN.BUCKET_KEYS = [] # e.g. ['target', 'input', 'nodes'] to batch similar lengths together, [] = uniform
+__C.TRAIN.NUM_LOADER_WORKERS = 0 # > 0 assembles memmap batches on background threads
+__C.TRAIN.PREFETCH_DEPTH = 4
 
 __C.TRAIN.CLIP_GRADIENTS = True
 __C.TRAIN.GRAD_MAX_NORM = 8.
@@ -139,10 +161,20 @@ __C.TRAIN.SOLVER.ADAM_BETA2 = 0.999
 __C.TRAIN.SOLVER.LR_DECAY_STEP = 20000
 __C.TRAIN.MAX_EPOCH = 1000
 __C.TRAIN.RUN_EVAL = True
-__C.TRAIN.USE_MULTI_GPU = True
+# evaluate snapshots of the weights in a background process while training goes on, see BackgroundEvaluator in
+# evaluate_splits.py; the validation batches are then built on the CPU
+__C.TRAIN.BACKGROUND_EVALUATION = False
+__C.TRAIN.EVALUATION_QUEUE_SIZE = 1 # snapshots waiting for the background evaluation, the oldest is skipped beyond
+# threads of the background evaluation, the cores it takes from training; more than 1 needs single-threaded training,
+# as OpenMP threads do not survive the fork of a process that used several of them (the worker would hang)
+__C.TRAIN.EVALUATION_NUM_THREADS = 1
+# data-parallel training over the processes started by torchrun (see main_model.py), on every core of every node
+__C.TRAIN.DISTRIBUTED_BACKEND = "gloo"
+__C.TRAIN.DISTRIBUTED_SEED = 0 # the processes shuffle the training set alike from this seed + the epoch
 __C.PRINT_EVERY = 100
 __C.EVALUATE_EVERY = 1
 __C.SAVE_EVERY = 100
+__C.TRAIN.KEEP_LAST_CHECKPOINTS = 3 # forced checkpoints (every SAVE_EVERY epochs) kept on disk, 0 keeps all
 
 #GSCAN Specific
 __C.TRAIN.K = 0
@@ -156,6 +188,8 @@ __C.TRAIN.WEIGHT_TARGET_LOSS = 0.3 # change only when auxiliary is used
 __C.TEST = AttrDict()
 __C.TEST.SPLIT = "" #\TODO test split not initialized yet
 __C.TEST.MAX_DECODING_STEP = 30
+__C.TEST.BEAM_SIZE = 1 # hypotheses kept per example when predicting, 1 = greedy decoding
+__C.TEST.LENGTH_NORMALIZATION = 1. # beam search ranks hypotheses by log-probability / length ** LENGTH_NORMALIZATION
 
 __C.TEST.BATCH_SIZE = 1
 __C.TEST.EPOCH = -1  # Needs to be supplied
@@ -14,17 +14,18 @@ class Attention(nn.Module):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     def forward(self, queries: torch.Tensor, projected_keys: torch.Tensor, values: torch.Tensor,
-                memory_lengths: List[int]):
+                memory_lengths: List[int], mask=None):
         """
         Key-value memory which takes queries and retrieves weighted combinations of values
           This version masks out certain memories, so that you can differing numbers of memories per batch.
-        :param queries: [batch_size, 1, query_dim]
+        :param queries: [batch_size, num_queries, query_dim], e.g. one query per beam search hypothesis
         :param projected_keys: [batch_size, num_memory, query_dim]
         :param values: [batch_size, num_memory, value_dim]
         :param memory_lengths: [batch_size] actual number of keys in each batch
+        :param mask: [batch_size, num_memory] mask of the actual keys, built from memory_lengths when not given
         :return:
-            soft_values_retrieval : soft-retrieval of values; [batch_size, 1, value_dim]
-            attention_weights : soft-retrieval of values; [batch_size, 1, n_memory]
+            soft_values_retrieval : soft-retrieval of values; [batch_size, num_queries, value_dim]
+            attention_weights : soft-retrieval of values; [batch_size, num_queries, n_memory]
         """
         batch_size = projected_keys.size(0)
         assert len(memory_lengths) == batch_size
@@ -32,20 +33,22 @@ class Attention(nn.Module):
             memory_lengths = torch.tensor(memory_lengths, dtype=torch.long, device=self.device)
 
         # Project queries down to the correct dimension.
-        # [bsz, 1, query_dimension] X [bsz, query_dimension, hidden_dim] = [bsz, 1, hidden_dim]
+        # [bsz, num_queries, query_dimension] X [bsz, query_dimension, hidden_dim] = [bsz, num_queries, hidden_dim]
         queries = self.query_layer(queries)
 
-        # [bsz, 1, query_dim] X [bsz, query_dim, num_memory] = [bsz, num_memory, 1]
-        scores = self.energy_layer(torch.tanh(queries + projected_keys))
-        scores = scores.squeeze(2).unsqueeze(1)
+        # [bsz, num_queries, 1, query_dim] + [bsz, 1, num_memory, query_dim] -> [bsz, num_queries, num_memory]; the keys
+        # are broadcast over the queries, not copied
+        scores = self.energy_layer(torch.tanh(queries.unsqueeze(2) + projected_keys.unsqueeze(1)))
+        scores = scores.squeeze(3)
 
         # Mask out keys that are on a padding location.encoded_commands
-        mask = sequence_mask(memory_lengths)  # [batch_size, num_memory]
+        if mask is None:
+            mask = sequence_mask(memory_lengths, max_len=projected_keys.size(1))  # [batch_size, num_memory]
         mask = mask.unsqueeze(1)  # [batch_size, 1, num_memory]
         scores = scores.masked_fill(mask == 0, float('-inf'))  # fill with large negative numbers
-        attention_weights = F.softmax(scores, dim=2)  # [batch_size, 1, num_memory]
+        attention_weights = F.softmax(scores, dim=2)  # [batch_size, num_queries, num_memory]
 
-        # [bsz, 1, num_memory] X [bsz, num_memory, value_dim] = [bsz, 1, value_dim]
+        # [bsz, num_queries, num_memory] X [bsz, num_memory, value_dim] = [bsz, num_queries, value_dim]
         soft_values_retrieval = torch.bmm(attention_weights, values)
         return soft_values_retrieval, attention_weights
 
@@ -83,7 +86,7 @@ class BahdanauAttentionDecoderRNN(nn.Module):
 
     def forward_step(self, input_tokens, last_hidden,
                      encoded_commands, commands_lengths,
-                     encoded_situations, situations_lengths):
+                     encoded_situations, situations_lengths, beam_size=1):
         """
         Run batch decoder forward for a single time step.
          Each decoder step considers all of the encoder_outputs through attention.
@@ -95,6 +98,9 @@ class BahdanauAttentionDecoderRNN(nn.Module):
         :param commands_lengths: length of each padded input seqencoded_commandsuence that were passed to the encoder.
         :param encoded_situations: the situation encoder outputs, [image_dimension * image_dimension, batch_size,
          hidden_size]
+        :param beam_size: number of hypotheses per example: input_tokens and last_hidden hold batch_size * beam_size
+        rows, the hypotheses of example i in rows i * beam_size to (i + 1) * beam_size - 1, and attend to the encoder
+        outputs of example i, which are not repeated per hypothesis
         :return: output : un-normalized output probabilities, [batch_size, output_size]
           hidden : current decoder state, which is a pair of tensors [num_layers, batch_size, hidden_size]
            (pair for hidden and cell)
@@ -107,10 +113,14 @@ class BahdanauAttentionDecoderRNN(nn.Module):
         embedded_input = self.dropout(embedded_input)
         embedded_input = embedded_input.unsqueeze(0)  # [1, batch_size, hidden_size]
 
-        # Bahdanau attention
+        # Bahdanau attention, the hypotheses of an example are the queries to its memories
+        per_example = lambda x: x.reshape(-1, beam_size, x.size(-1))  # [batch_size, beam_size, dim]
+        per_hypothesis = lambda x: x.reshape(-1, 1, x.size(-1))  # [batch_size * beam_size, 1, dim]
         context_command, attention_weights_commands = self.textual_attention(
-            queries=last_hidden.transpose(0, 1), projected_keys=encoded_commands,
+            queries=per_example(last_hidden.transpose(0, 1)), projected_keys=encoded_commands,
             values=encoded_commands, memory_lengths=commands_lengths)
+        context_command, attention_weights_commands = per_hypothesis(context_command), \
+                                                      per_hypothesis(attention_weights_commands)
         batch_size, image_num_memory, _ = encoded_situations.size()
         # situation_lengths = [image_num_memory for _ in range(batch_size)]
 
@@ -122,8 +132,10 @@ class BahdanauAttentionDecoderRNN(nn.Module):
 
         # visual attention
         context_situation, attention_weights_situations = self.visual_attention(
-            queries=queries, projected_keys=encoded_situations,
+            queries=per_example(queries), projected_keys=encoded_situations,
             values=encoded_situations, memory_lengths=situations_lengths)
+        context_situation, attention_weights_situations = per_hypothesis(context_situation), \
+                                                          per_hypothesis(attention_weights_situations)
         # context : [batch_size, 1, hidden_size]
         # attention_weights : [batch_size, 1, max_input_length]
 
@@ -184,7 +196,7 @@ class BahdanauAttentionDecoderRNN(nn.Module):
                   initial_c.index_select(dim=1, index=perm_idx))
 
         encoded_commands = encoded_commands.index_select(dim=0, index=perm_idx)  # change from 1 to 0
-        commands_lengths = torch.tensor(commands_lengths, device=self.device)
+        commands_lengths = torch.as_tensor(commands_lengths, device=encoded_commands.device)
         commands_lengths = commands_lengths.index_select(dim=0, index=perm_idx)
         encoded_situations = encoded_situations.index_select(dim=0, index=perm_idx)
 
@@ -194,28 +206,109 @@ class BahdanauAttentionDecoderRNN(nn.Module):
         projected_keys_textual = self.textual_attention.key_layer(
             encoded_commands)  # [max_input_length, batch_size, dec_hidden_dim]
 
-        all_attention_weights = []
-        lstm_output = []
-        for time in range(max_time):
-            input_token = input_tokens_sorted[:, time]
-            (output, hidden, context_situation, attention_weights_commands,
-             attention_weights_situations) = self.forward_step(input_token, hidden, projected_keys_textual,
-                                                               commands_lengths,
-                                                               projected_keys_visual, situations_lengths)
-            all_attention_weights.append(attention_weights_situations.unsqueeze(0))
-            lstm_output.append(output.unsqueeze(0))
-        lstm_output = torch.cat(lstm_output, dim=0)  # [max_time, batch_size, output_size]
-        attention_weights = torch.cat(all_attention_weights, dim=0)  # [max_time, batch_size, situation_dim**2]
+        if cfg.DEC_FAST_TEACHER_FORCING and self.num_layers == 1:
+            lstm_output, attention_weights = self.teacher_forced_steps(input_tokens_sorted, input_lengths, hidden,
+                                                                       projected_keys_textual, commands_lengths,
+                                                                       projected_keys_visual, situations_lengths)
+        else:
+            all_attention_weights = []
+            lstm_output = []
+            for time in range(max_time):
+                input_token = input_tokens_sorted[:, time]
+                (output, hidden, context_situation, attention_weights_commands,
+                 attention_weights_situations) = self.forward_step(input_token, hidden, projected_keys_textual,
+                                                                   commands_lengths,
+                                                                   projected_keys_visual, situations_lengths)
+                all_attention_weights.append(attention_weights_situations.unsqueeze(0))
+                lstm_output.append(output.unsqueeze(0))
+            lstm_output = torch.cat(lstm_output, dim=0)  # [max_time, batch_size, output_size]
+            attention_weights = torch.cat(all_attention_weights, dim=0)  # [max_time, batch_size, situation_dim**2]
+            # as in teacher_forced_steps, the steps past the end of a sequence do not attend
+            in_sequence = input_lengths.gt(torch.arange(max_time, device=input_lengths.device)[:, None])
+            attention_weights = attention_weights * in_sequence[:, :, None]
 
         # Reverse the sorting
         _, unperm_idx = perm_idx.sort(0)
         lstm_output = lstm_output.index_select(dim=1, index=unperm_idx)  # [max_time, batch_size, output_size]
-        seq_len = input_lengths[unperm_idx].tolist()
+        seq_len = input_lengths[unperm_idx]
         attention_weights = attention_weights.index_select(dim=1, index=unperm_idx)
 
         return lstm_output, seq_len, attention_weights.sum(dim=0)
         # output : [unnormalized log-score] [max_length, batch_size, output_size]
-        # seq_len : length of each output sequence
+        # seq_len : [batch_size] length of each output sequence
+
+    def teacher_forced_steps(self, input_tokens, input_lengths, init_hidden, projected_keys_textual, commands_lengths,
+                             projected_keys_visual, situations_lengths):
+        """
+        Same computation as calling forward_step for every time step, with everything that does not depend on the
+        previous step taken out of the loop: the whole target sequence is embedded and dropped out at once, the
+        attention masks are built once, the embedding's share of the LSTM input projection is computed for all steps
+        in one matmul, and the output projections run on all steps after the loop. A step is left with the two
+        attentions and one matmul of the contexts and the previous hidden state, as an LSTMCell on the weights of
+        self.lstm, which must have a single layer.
+        As in a packed RNN, the sequences are sorted by decreasing length, so the sequences that have not ended at step
+        t are the first n_t rows and only those are computed. The positions past the end of a sequence are zeros,
+        which the loss ignores as padding.
+        :param input_tokens: [batch_size, max_time] target tokens, sorted by decreasing length
+        :param input_lengths: [batch_size] length of every target sequence, in decreasing order
+        :param init_hidden: tuple of tensors [1, batch_size, hidden_size] (for hidden and cell)
+        :return: unnormalized log-scores [max_time, batch_size, output_size] and situation attention weights
+        [max_time, batch_size, situation_length]
+        """
+        batch_size, max_time = input_tokens.size()
+        hidden_size = self.hidden_size
+        embedded_input = self.dropout(self.embedding(input_tokens.t()))  # [max_time, batch_size, hidden_size]
+        command_mask = sequence_mask(commands_lengths, max_len=projected_keys_textual.size(1))
+        situation_mask = sequence_mask(torch.as_tensor(situations_lengths, device=projected_keys_visual.device),
+                                       max_len=projected_keys_visual.size(1))
+
+        # the LSTM input is [embedded input, command context, situation context]
+        weight_ih = self.lstm.weight_ih_l0  # [4 * hidden_size, 3 * hidden_size]
+        input_gates = F.linear(embedded_input, weight_ih[:, :hidden_size], self.lstm.bias_ih_l0 + self.lstm.bias_hh_l0)
+        input_gates = input_gates.unbind(0)  # one backward for all steps, instead of one per step of the full tensor
+        recurrent_weight = torch.cat([weight_ih[:, hidden_size:], self.lstm.weight_hh_l0], dim=1)
+
+        # number of sequences that have not ended at every step, read once per batch
+        active_sizes = input_lengths.gt(torch.arange(max_time, device=input_lengths.device)[:, None]).sum(dim=1)
+        # outputs of the rows that ended are zeros
+        pad_rows = lambda x: F.pad(x, [0, 0, 0, batch_size - x.size(0)])
+        lstm_outputs, contexts, attention_weights = [], [], []
+
+        hidden, cell = init_hidden[0][0], init_hidden[1][0]  # [batch_size, hidden_size]
+        for time, num_active in enumerate(active_sizes.tolist()):
+            # the rows that ended are the last ones, dropping them only narrows the views; every view narrows the
+            # previous one, so that the backward of a step also only touches the rows active at that step
+            hidden, cell = hidden[:num_active], cell[:num_active]
+            projected_keys_textual, projected_keys_visual = projected_keys_textual[:num_active], \
+                                                            projected_keys_visual[:num_active]
+            commands_lengths, situations_lengths = commands_lengths[:num_active], situations_lengths[:num_active]
+            command_mask, situation_mask = command_mask[:num_active], situation_mask[:num_active]
+            queries = hidden.unsqueeze(1)  # [num_active, 1, hidden_size]
+            context_command, _ = self.textual_attention(
+                queries=queries, projected_keys=projected_keys_textual, values=projected_keys_textual,
+                memory_lengths=commands_lengths, mask=command_mask)
+            if self.conditional_attention:
+                queries = self.tanh(self.queries_to_keys(torch.cat([queries, context_command], dim=-1)))
+            context_situation, attention_weights_situations = self.visual_attention(
+                queries=queries, projected_keys=projected_keys_visual, values=projected_keys_visual,
+                memory_lengths=situations_lengths, mask=situation_mask)
+            context = torch.cat([context_command, context_situation], dim=-1).squeeze(1)  # [num_active, 2 * hidden]
+
+            gates = input_gates[time][:num_active] + F.linear(torch.cat([context, hidden], dim=-1), recurrent_weight)
+            input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=1)
+            cell = torch.sigmoid(forget_gate) * cell + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+            hidden = torch.sigmoid(output_gate) * torch.tanh(cell)
+            lstm_outputs.append(pad_rows(hidden))
+            contexts.append(pad_rows(context))
+            attention_weights.append(pad_rows(attention_weights_situations.squeeze(1)))
+        lstm_output = torch.stack(lstm_outputs)  # [max_time, batch_size, hidden_size]
+
+        if self.is_baseline:
+            pre_output = torch.cat([embedded_input, lstm_output, torch.stack(contexts)], dim=2)
+            output = self.hidden_to_output(self.output_to_hidden(pre_output))
+        else:
+            output = self.hidden_to_output(lstm_output)
+        return output, torch.stack(attention_weights)
 
     def initialize_hidden(self, encoder_message: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         """
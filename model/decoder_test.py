@@ -0,0 +1,95 @@
+# TODO: use test framework instead of asserts
+import logging
+import time
+
+import torch
+
+from model.config import cfg
+from model.decoder import Decoder
+from model.testing import gradients_match, weighted_gradients
+
+logger = logging.getLogger(__name__)
+
+TEST_TARGET_VOCAB_SIZE = 9
+TEST_TARGET_LENGTHS = [6, 2, 9, 4]
+TEST_COMMAND_LENGTHS = [5, 7, 3, 7]
+TEST_SITUATION_LENGTH = 36
+
+
+def decoder_inputs(target_lengths, command_lengths):
+    batch_size = len(target_lengths)
+    target_lengths = torch.tensor(target_lengths, dtype=torch.long)
+    targets = torch.randint(2, TEST_TARGET_VOCAB_SIZE, (batch_size, int(target_lengths.max())))
+    targets.masked_fill_(torch.arange(targets.size(1))[None, :] >= target_lengths[:, None], 0)
+    initial_hidden = torch.randn(batch_size, cfg.CMD_D_H, requires_grad=True)
+    encoded_commands = torch.randn(batch_size, max(command_lengths), cfg.CMD_D_H, requires_grad=True)
+    encoded_situations = torch.randn(batch_size, TEST_SITUATION_LENGTH, cfg.SITU_D_CNN_OUTPUT * 3, requires_grad=True)
+    return (targets, target_lengths, initial_hidden, encoded_commands, torch.tensor(command_lengths),
+            encoded_situations, [TEST_SITUATION_LENGTH] * batch_size)
+
+
+def situation_attention_reference(decoder, targets, target_lengths, initial_hidden, encoded_commands,
+                                  commands_lengths, encoded_situations, situations_lengths):
+    """
+    :return: [batch_size, situation_length] situation attention summed over the steps of every target sequence,
+    decoding every example on its own for exactly its length
+    """
+    attention_decoder = decoder.attentionDecoder
+    hidden = attention_decoder.initialize_hidden(decoder.tanh(decoder.enc_hidden_to_dec_hidden(initial_hidden)))
+    projected_keys_textual = attention_decoder.textual_attention.key_layer(encoded_commands)
+    projected_keys_visual = attention_decoder.visual_attention.key_layer(encoded_situations)
+    attention_sums = []
+    for row, target_length in enumerate(target_lengths.tolist()):
+        row_hidden = tuple(state[:, row:row + 1] for state in hidden)
+        attention_sum = 0.
+        for time in range(target_length):
+            _, row_hidden, _, _, attention_weights = attention_decoder.forward_step(
+                targets[row:row + 1, time], row_hidden, projected_keys_textual[row:row + 1],
+                commands_lengths[row:row + 1], projected_keys_visual[row:row + 1], situations_lengths[row:row + 1])
+            attention_sum = attention_sum + attention_weights
+        attention_sums.append(attention_sum)
+    return torch.cat(attention_sums, dim=0)
+
+
+def test_fast_teacher_forcing_matches_forward_step():
+    start = time.time()
+    fast_teacher_forcing = cfg.DEC_FAST_TEACHER_FORCING
+    for is_baseline in (True, False):
+        torch.manual_seed(0)
+        decoder = Decoder(TEST_TARGET_VOCAB_SIZE, 0, is_baseline=is_baseline)
+        # training mode, but without dropout so that both implementations see the same inputs
+        decoder.attentionDecoder.dropout.p = 0.
+        inputs = decoder_inputs(TEST_TARGET_LENGTHS, TEST_COMMAND_LENGTHS)
+        differentiable_inputs = [inputs[2], inputs[3], inputs[5]] + list(decoder.parameters())
+        # the fast path skips the steps past the end of every sequence, whose outputs the loss ignores
+        in_sequence = torch.arange(inputs[0].size(1))[:, None] < inputs[1][None, :]  # [max_time, batch_size]
+
+        outputs, attention_sums, gradients = [], [], []
+        for fast in (True, False):
+            cfg.DEC_FAST_TEACHER_FORCING = fast
+            decoder_output, context_situation = decoder(*inputs)
+            gradients.append(weighted_gradients([decoder_output * in_sequence[:, :, None], context_situation],
+                                                differentiable_inputs))
+            outputs.append(decoder_output[in_sequence])
+            attention_sums.append(context_situation)
+        cfg.DEC_FAST_TEACHER_FORCING = fast_teacher_forcing
+
+        assert torch.allclose(outputs[0], outputs[1], atol=1e-6), \
+            "test_fast_teacher_forcing_matches_forward_step FAILED"
+        reference_attention_sum = situation_attention_reference(decoder, *inputs)
+        for attention_sum in attention_sums:
+            assert torch.allclose(attention_sum, reference_attention_sum, atol=1e-6), \
+                "test_fast_teacher_forcing_matches_forward_step FAILED"
+        assert gradients_match(*gradients, atol=1e-6), "test_fast_teacher_forcing_matches_forward_step FAILED"
+    end = time.time()
+    logger.info("test_fast_teacher_forcing_matches_forward_step PASSED in {} seconds".format(end - start))
+    return
+
+
+def run_all_tests():
+    test_fast_teacher_forcing_matches_forward_step()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    run_all_tests()
@@ -1,6 +1,3 @@
-import dgl
-import dgl.function as fn
-from dgl.nn.pytorch.softmax import edge_softmax
 import numpy as np
 import torch as th
 import torch.nn.functional as F
@@ -9,10 +6,156 @@ import torch.nn as nn
 from .config import cfg
 from .utils import *
 
+try:
+    import dgl
+    import dgl.function as fn
+    from dgl.nn.pytorch.softmax import edge_softmax
+except ImportError:  # only the "dgl" LGCN backend needs DGL
+    dgl = None
+
+
+class CompleteGraphBuilder(object):
+    """
+    Builds the batched graph of a batch of situations, where every node (occupied cell) is connected to every other
+    node of its situation. The edges of all graphs are computed at once with tensor operations, without per-graph or
+    per-edge Python.
+    """
+
+    @staticmethod
+    def complete_edges(num_nodes):
+        """
+        :param num_nodes: [batch_size] long tensor, number of nodes of every graph
+        :return: [2, sum of num_nodes * (num_nodes - 1)] source and destination of every edge of the complete graphs,
+        without self loops, by graph, then source, then destination
+        """
+        num_edges = num_nodes * (num_nodes - 1)
+        graph = th.repeat_interleave(th.arange(num_nodes.size(0), device=num_nodes.device), num_edges)
+        # edge k of a graph of n nodes goes from node k // (n - 1) to the (k % (n - 1))-th other node
+        edge_offsets = th.cumsum(num_edges, 0) - num_edges
+        k = th.arange(graph.size(0), device=num_nodes.device) - edge_offsets[graph]
+        num_neighbours = num_nodes[graph] - 1
+        src, dst = k // num_neighbours, k % num_neighbours
+        dst += (dst >= src).long()
+        node_offsets = th.cumsum(num_nodes, 0) - num_nodes
+        return th.stack([src, dst]) + node_offsets[graph]
+
+    def __call__(self, num_nodes, edges=None):
+        """
+        :param num_nodes: [batch_size] long tensor, number of nodes of every graph
+        :param edges: [2, num_edges] source and destination of the edges to build instead of the complete graphs, from
+        an EdgePolicy
+        :return: the batched graph, the nodes of graph i follow the nodes of graph i - 1
+        """
+        if edges is None:
+            edges = self.complete_edges(num_nodes)
+        num_nodes, edges = num_nodes.cpu(), edges.cpu()
+        batch_g = dgl.DGLGraph()
+        batch_g.add_nodes(int(num_nodes.sum()))
+        batch_g.add_edges(edges[0], edges[1])
+        return batch_g
+
+
+def graph_membership_of(num_nodes):
+    """
+    :param num_nodes: [batch_size] long tensor, number of nodes of every graph
+    :return: [total number of nodes] index of the graph of every node
+    """
+    return th.repeat_interleave(th.arange(num_nodes.size(0), device=num_nodes.device), num_nodes)
+
+
+def padding_layout(graph_membership, num_nodes):
+    """
+    :param graph_membership: [total number of nodes] index of the graph of every node
+    :param num_nodes: [batch_size] number of nodes of every graph
+    :return: position of every node in its padded graph, and the [batch_size, max_nodes, max_nodes] mask of the
+    edges (dst, src) of the complete graphs, without self loops
+    """
+    node_offsets = th.cumsum(num_nodes, 0) - num_nodes
+    positions = th.arange(graph_membership.size(0), device=graph_membership.device) - node_offsets[graph_membership]
+    max_nodes = int(num_nodes.max()) if num_nodes.numel() else 0
+    nodes = th.arange(max_nodes, device=num_nodes.device)
+    is_node = nodes[None, :] < num_nodes[:, None]
+    edge_mask = is_node[:, :, None] & is_node[:, None, :] & (nodes[:, None] != nodes[None, :])
+    return positions, edge_mask
+
+
+class EdgePolicy(object):
+    """
+    Restricts the complete graph of every situation to a neighbourhood of each cell, so that message passing does not
+    grow quadratically with the number of objects in large worlds. A node receives messages from:
+      "knn": its k nearest nodes by grid (Manhattan) distance, at most k edges per node
+      "row_column": the nodes in the same row or column
+      "radius": the nodes within grid distance radius
+    Which cells neighbour each other only depends on the grid size, so the neighbour index (distance and same-line
+    tables between all cells) is computed once per grid size. The kept edges are returned as an edge list, on which
+    the LGCN does work proportional to the number of edges instead of max_nodes ** 2 per graph.
+    """
+
+    POLICIES = ("knn", "row_column", "radius")
+
+    def __init__(self, policy, k=8, radius=3):
+        assert policy in self.POLICIES, "Unknown edge policy {}.".format(policy)
+        self.policy = policy
+        self.k = k
+        self.radius = radius
+        self.neighbour_indices = {}
+
+    def neighbour_index(self, grid_size, device):
+        """
+        :return: [grid_size ** 2, grid_size ** 2] grid distance between every pair of cells (by flat index), and whether
+        they share a row or a column
+        """
+        key = (grid_size, str(device))
+        if key not in self.neighbour_indices:
+            cells = th.arange(grid_size * grid_size, device=device)
+            rows, columns = cells // grid_size, cells % grid_size
+            row_distances = (rows[:, None] - rows[None, :]).abs()
+            column_distances = (columns[:, None] - columns[None, :]).abs()
+            self.neighbour_indices[key] = (row_distances + column_distances,
+                                           (row_distances == 0) | (column_distances == 0))
+        return self.neighbour_indices[key]
+
+    def __call__(self, cells, graph_membership, num_nodes, grid_size):
+        """
+        :param cells: [total number of nodes] flat grid index (row * grid_size + column) of every node
+        :param graph_membership: [total number of nodes] index of the graph of every node
+        :param num_nodes: [batch_size] number of nodes of every graph
+        :return: [2, num_edges] source and destination node (indices into the packed nodes) of every kept edge
+        """
+        positions, edge_mask = padding_layout(graph_membership, num_nodes)
+        padded_cells = cells.new_zeros(edge_mask.shape[:2])
+        padded_cells[graph_membership, positions] = cells
+        distances, same_line = self.neighbour_index(grid_size, cells.device)
+        pair = (padded_cells[:, :, None], padded_cells[:, None, :])
+        if self.policy == "row_column":
+            keep = same_line[pair]
+        elif self.policy == "radius":
+            keep = distances[pair] <= self.radius
+        else:
+            k = min(self.k, edge_mask.size(-1) - 1)
+            # padding and self loops are never among the nearest, unless a node has fewer than k neighbours
+            candidates = distances[pair].masked_fill(~edge_mask, 2 * grid_size)
+            nearest = candidates.topk(k, dim=-1, largest=False).indices
+            keep = th.zeros_like(edge_mask).scatter_(-1, nearest, True)
+        graph, dst, src = (edge_mask & keep).nonzero(as_tuple=True)
+        node_offsets = th.cumsum(num_nodes, 0) - num_nodes
+        return th.stack([src + node_offsets[graph], dst + node_offsets[graph]])
+
 
 class LGCNLayer(nn.Module):
-    def __init__(self):
+    """
+    Language-conditioned message passing over the graph of the occupied cells of every situation, complete unless
+    restricted by an EdgePolicy. Two numerically equivalent backends compute the messages: "dgl" runs them on a
+    batched DGL graph, "dense" needs no DGL and, on complete graphs, pads the nodes of every graph to
+    [batch_size, max_nodes, d] and computes them as masked attention with batched matmuls, which is faster for the few
+    nodes of gSCAN situations. On the edge list of an EdgePolicy, "dense" gathers and scatters per edge instead.
+    """
+
+    def __init__(self, backend=None):
         super().__init__()
+        self.backend = backend or cfg.LGCN_BACKEND
+        assert self.backend in ("dgl", "dense"), "Unknown LGCN backend {}.".format(self.backend)
+        assert self.backend != "dgl" or dgl is not None, "The dgl LGCN backend needs DGL installed."
         d_x = cfg.SITU_D_FEAT #\TODO infer this value from dataset statistics method
         d_cmd = cfg.SITU_D_CMD
         d_loc = cfg.SITU_D_CTX
@@ -66,19 +209,25 @@ class LGCNLayer(nn.Module):
 
         return x_loc, x_ctx
     
-    def extract_textual_command(self, cmd_h, cmd_out, cmdLength, t):
-
-        raw_att = self.W1(cmd_out * self.W2_layers[t](F.relu(self.W3(cmd_h)).unsqueeze(1))).squeeze(-1)
-        
-        mask = sequence_mask(cmdLength)
+    def extract_textual_commands(self, cmd_h, cmd_out, cmdLength):
+        """
+        The commands of all message passing iterations only differ by W2_layers[t], so they are computed at once.
+        :return: [batch_size, T, d_cmd] command of every iteration
+        """
+        # [T, d_cmd, d_cmd], the weights stay in W2_layers so checkpoints load unchanged
+        W2 = th.stack([layer.weight for layer in self.W2_layers])
+        query = th.einsum('bd,ted->bte', F.relu(self.W3(cmd_h)), W2)
+        # W1(cmd_out * query) = query . (cmd_out * w1), for all iterations in one bmm: [batch_size, T, max_length]
+        raw_att = th.bmm(query, (cmd_out * self.W1.weight).transpose(1, 2))
+
+        mask = sequence_mask(cmdLength, max_len=cmd_out.size(1))
         att = masked_softmax(raw_att, mask)
-        cmd = th.bmm(att[:, None, :], cmd_out).squeeze(1)
+        cmd = th.bmm(att, cmd_out)
 
         return cmd
 
-    def graph_nn(self, g, h, ctx, c, graph_membership):
+    def graph_nn(self, g, h, ctx, c, graph_membership, layout=None):
 
-        g = g.local_var()
         c_broadcast = F.embedding(graph_membership, c)
         fuse = self.W4(self.read_drop(h)) * self.W5(self.read_drop(ctx))
         cat = th.cat([h, ctx, fuse], dim=1)
@@ -89,41 +238,85 @@ class LGCNLayer(nn.Module):
 
 
 
+        ft = self.W9(cat) * self.W10(c_broadcast)
+
+        if self.backend == "dgl":
+            message = self.dgl_message(g, src_ctx, dst_ctx, ft)
+        elif isinstance(layout, th.Tensor):
+            message = self.edge_list_message(layout, src_ctx, dst_ctx, ft)
+        else:
+            message = self.dense_message(layout, src_ctx, dst_ctx, ft, graph_membership)
+        ctx = self.W11(ctx) + self.W11b(message)
+
+        rst = ctx
+
+        return rst
+
+    def dgl_message(self, g, src_ctx, dst_ctx, ft):
+        g = g.local_var()
         g.srcdata.update({"s_e": src_ctx})
         g.dstdata.update({"d_e": dst_ctx})
         g.apply_edges(fn.u_dot_v("s_e", "d_e", "e"))
         e = g.edata.pop('e')
 
-
         g.edata['a'] = edge_softmax(g, e)
-        g.ndata['ft'] = self.W9(cat) * self.W10(c_broadcast)
+        g.ndata['ft'] = ft
 
         g.update_all(fn.u_mul_e('ft', 'a', 'm'), fn.sum('m', 's'))
-        ctx = self.W11(ctx) + self.W11b(g.ndata['s'])
-
-        rst = ctx
-
-        return rst
-
-    
-
-    def forward(self, situation_x, batch_g, cmd_h, cmd_out, cmdLength, batch_size, graph_membership):
+        return g.ndata['s']
+
+    @staticmethod
+    def edge_list_message(edges, src_ctx, dst_ctx, ft):
+        src, dst = edges
+        e = (src_ctx[src] * dst_ctx[dst]).sum(dim=-1)
+        # softmax over the incoming edges of every node, like edge_softmax
+        e_max = e.new_full((dst_ctx.size(0),), float('-inf')).scatter_reduce(0, dst, e, 'amax', include_self=False)
+        e = th.exp(e - e_max[dst])
+        a = e / e.new_zeros(dst_ctx.size(0)).index_add(0, dst, e)[dst]
+        # a node without incoming edges receives nothing
+        return ft.new_zeros(ft.size()).index_add(0, dst, a[:, None] * ft[src])
+
+    def dense_message(self, layout, src_ctx, dst_ctx, ft, graph_membership):
+        positions, edge_mask = layout
+        batch_size, max_nodes, _ = edge_mask.size()
+
+        def pad(x):
+            padded = x.new_zeros(batch_size, max_nodes, x.size(-1))
+            padded[graph_membership, positions] = x
+            return padded
+
+        # e[b, v, u]: score of the edge u -> v, normalized over the sources of v like edge_softmax
+        e = th.bmm(pad(dst_ctx), pad(src_ctx).transpose(1, 2))
+        # a node without neighbours (a single-node graph) receives nothing, as in the DGL backend
+        a = masked_softmax(e, edge_mask) * edge_mask
+        return th.bmm(a, pad(ft))[graph_membership, positions]
+
+
+
+    def forward(self, situation_x, batch_g, cmd_h, cmd_out, cmdLength, batch_size, graph_membership, edges=None):
+        """
+        :param batch_g: batched graph from CompleteGraphBuilder, only used (and may be None otherwise) by the dgl
+        backend
+        :param edges: [2, num_edges] edge list from an EdgePolicy for the dense backend, the complete graphs by default
+        :return: [total number of nodes, d] output of every node, packed like situation_x, and [batch_size + 1] node
+        offsets: the nodes of graph i are rows offsets[i]:offsets[i + 1]
+        """
+        # the nodes of graph i are consecutive and follow the nodes of graph i - 1
+        num_nodes = th.bincount(graph_membership, minlength=batch_size)
+        layout = None
+        if self.backend == "dense":
+            layout = padding_layout(graph_membership, num_nodes) if edges is None else edges
         x_loc, x_ctx = self.loc_ctx_init(situation_x)
+        cmds = self.extract_textual_commands(cmd_h, cmd_out, cmdLength) #\TODO check whether mixing cmd_h, cmd_out
         for t in range(self.T):
-            cmd = self.extract_textual_command(cmd_h, cmd_out, cmdLength, t) #\TODO check whether mixing cmd_h, cmd_out
-            x_ctx = self.graph_nn(batch_g, x_loc, x_ctx, cmd, graph_membership)
+            x_ctx = self.graph_nn(batch_g, x_loc, x_ctx, cmds[:, t], graph_membership, layout)
         
         x_out = self.W12(th.cat([x_loc, x_ctx], dim=-1))
 
 
 
-        # \TODO ATTENTION: not sure unbatching using dgl will break or not. Seems not
-        batch_g.ndata['out'] = x_out
-        g_list = dgl.unbatch(batch_g)
-        ret = []
-        for g in g_list:
-            ret.append(g.ndata['out'])
+        node_offsets = th.cat([num_nodes.new_zeros(1), th.cumsum(num_nodes, dim=0)])
 
-        return ret
+        return x_out, node_offsets
 
 
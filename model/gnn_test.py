@@ -0,0 +1,147 @@
+# TODO: use test framework instead of asserts
+import logging
+import time
+
+import torch as th
+import torch.nn.functional as F
+
+from model.config import cfg
+from model.gnn import CompleteGraphBuilder, LGCNLayer, dgl, graph_membership_of, padding_layout
+from model.testing import gradients_match, weighted_gradients
+from model.utils import masked_softmax, sequence_mask
+
+logger = logging.getLogger(__name__)
+
+# includes a single-node graph, whose node has no neighbours to receive messages from
+TEST_NUM_NODES = [5, 1, 3, 8, 2]
+TEST_COMMAND_LENGTHS = [4, 7, 2, 7, 5]
+
+
+def lgcn_inputs(num_nodes, command_lengths):
+    num_nodes = th.tensor(num_nodes, dtype=th.long)
+    command_lengths = th.tensor(command_lengths, dtype=th.long)
+    batch_size = num_nodes.size(0)
+    situation_x = th.randn(int(num_nodes.sum()), cfg.SITU_D_FEAT, requires_grad=True)
+    cmd_h = th.randn(batch_size, cfg.SITU_D_CMD, requires_grad=True)
+    cmd_out = th.randn(batch_size, int(command_lengths.max()), cfg.SITU_D_CMD, requires_grad=True)
+    return num_nodes, situation_x, cmd_h, cmd_out, command_lengths
+
+
+def complete_graph_edges(num_nodes):
+    """:return: [2, num_edges] source and destination of the edges of the complete graphs, without self loops"""
+    _, edge_mask = padding_layout(graph_membership_of(num_nodes), num_nodes)
+    graph, dst, src = edge_mask.nonzero(as_tuple=True)
+    node_offsets = th.cumsum(num_nodes, 0) - num_nodes
+    return th.stack([src + node_offsets[graph], dst + node_offsets[graph]])
+
+
+def textual_command_reference(lgcn, cmd_h, cmd_out, command_lengths, t):
+    """:return: [batch_size, d_cmd] command of message passing iteration t, attending with W1, W2_layers[t] and W3"""
+    raw_att = lgcn.W1(cmd_out * lgcn.W2_layers[t](F.relu(lgcn.W3(cmd_h))).unsqueeze(1)).squeeze(-1)
+    att = masked_softmax(raw_att, sequence_mask(command_lengths, max_len=cmd_out.size(1)))
+    return th.bmm(att[:, None, :], cmd_out).squeeze(1)
+
+
+def test_textual_commands_match_per_iteration():
+    start = time.time()
+    th.manual_seed(0)
+    lgcn = LGCNLayer(backend="dense")
+    _, _, cmd_h, cmd_out, command_lengths = lgcn_inputs(TEST_NUM_NODES, TEST_COMMAND_LENGTHS)
+    inputs = [cmd_h, cmd_out] + [parameter for name, parameter in lgcn.named_parameters()
+                                 if name.split('.')[0] in ('W1', 'W2_layers', 'W3')]
+
+    commands = lgcn.extract_textual_commands(cmd_h, cmd_out, command_lengths)
+    reference_commands = th.stack([textual_command_reference(lgcn, cmd_h, cmd_out, command_lengths, t)
+                                   for t in range(lgcn.T)], dim=1)
+    assert commands.shape == (cmd_h.size(0), lgcn.T, cfg.SITU_D_CMD), "test_textual_commands_match_per_iteration FAILED"
+    assert th.allclose(commands, reference_commands, atol=1e-6), "test_textual_commands_match_per_iteration FAILED"
+    assert gradients_match(weighted_gradients(commands, inputs), weighted_gradients(reference_commands, inputs),
+                           atol=1e-5), "test_textual_commands_match_per_iteration FAILED"
+    end = time.time()
+    logger.info("test_textual_commands_match_per_iteration PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_dense_backend_matches_edge_list():
+    start = time.time()
+    th.manual_seed(0)
+    lgcn = LGCNLayer(backend="dense").eval()
+    num_nodes, situation_x, cmd_h, cmd_out, command_lengths = lgcn_inputs(TEST_NUM_NODES, TEST_COMMAND_LENGTHS)
+    graph_membership = graph_membership_of(num_nodes)
+
+    # padded masked attention on the complete graphs, and gathers and scatters over their edge list
+    outputs, gradients = [], []
+    for edges in (None, complete_graph_edges(num_nodes)):
+        out, _ = lgcn(situation_x, None, cmd_h, cmd_out, command_lengths, num_nodes.size(0), graph_membership,
+                      edges=edges)
+        inputs = [situation_x, cmd_h, cmd_out] + list(lgcn.parameters())
+        gradients.append(weighted_gradients(out, inputs))
+        outputs.append(out)
+    assert th.allclose(outputs[0], outputs[1], atol=1e-5), "test_dense_backend_matches_edge_list FAILED"
+    assert gradients_match(*gradients, atol=1e-5), "test_dense_backend_matches_edge_list FAILED"
+    end = time.time()
+    logger.info("test_dense_backend_matches_edge_list PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_dense_backend_matches_dgl():
+    start = time.time()
+    if dgl is None:
+        logger.info("test_dense_backend_matches_dgl SKIPPED, DGL is not installed")
+        return
+    th.manual_seed(0)
+    dgl_lgcn = LGCNLayer(backend="dgl").eval()
+    dense_lgcn = LGCNLayer(backend="dense").eval()
+    dense_lgcn.load_state_dict(dgl_lgcn.state_dict())
+    num_nodes, situation_x, cmd_h, cmd_out, command_lengths = lgcn_inputs(TEST_NUM_NODES, TEST_COMMAND_LENGTHS)
+    graph_membership = graph_membership_of(num_nodes)
+
+    outputs, gradients = [], []
+    for lgcn, batch_g in [(dgl_lgcn, CompleteGraphBuilder()(num_nodes)), (dense_lgcn, None)]:
+        out, node_offsets = lgcn(situation_x, batch_g, cmd_h, cmd_out, command_lengths, num_nodes.size(0),
+                                 graph_membership)
+        assert (node_offsets[1:] - node_offsets[:-1]).tolist() == TEST_NUM_NODES, \
+            "test_dense_backend_matches_dgl FAILED"
+        inputs = [situation_x, cmd_h, cmd_out] + list(lgcn.parameters())
+        gradients.append(weighted_gradients(out, inputs))
+        outputs.append(out)
+    assert th.allclose(outputs[0], outputs[1], atol=1e-5), "test_dense_backend_matches_dgl FAILED"
+    assert gradients_match(*gradients, atol=1e-5), "test_dense_backend_matches_dgl FAILED"
+    end = time.time()
+    logger.info("test_dense_backend_matches_dgl PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_complete_graph_builder():
+    start = time.time()
+    num_nodes = th.tensor(TEST_NUM_NODES, dtype=th.long)
+    edges = CompleteGraphBuilder.complete_edges(num_nodes)
+    reference_edges = complete_graph_edges(num_nodes)
+    total_nodes = int(num_nodes.sum())
+    edge_keys, reference_keys = edges[0] * total_nodes + edges[1], reference_edges[0] * total_nodes + reference_edges[1]
+    assert th.equal(edge_keys, th.sort(reference_keys)[0]), "test_complete_graph_builder FAILED"
+    if dgl is None:
+        logger.info("test_complete_graph_builder SKIPPED, DGL is not installed")
+        return
+    batch_g = CompleteGraphBuilder()(num_nodes)
+    src, dst = batch_g.edges()
+    graph_membership = graph_membership_of(num_nodes)
+    expected_edges = sum(n * (n - 1) for n in TEST_NUM_NODES)
+    assert src.size(0) == expected_edges, "test_complete_graph_builder FAILED"
+    assert (src != dst).all(), "test_complete_graph_builder FAILED"
+    assert (graph_membership[src.long()] == graph_membership[dst.long()]).all(), "test_complete_graph_builder FAILED"
+    end = time.time()
+    logger.info("test_complete_graph_builder PASSED in {} seconds".format(end - start))
+    return
+
+
+def run_all_tests():
+    test_complete_graph_builder()
+    test_textual_commands_match_per_iteration()
+    test_dense_backend_matches_edge_list()
+    test_dense_backend_matches_dgl()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    run_all_tests()
@@ -1,16 +1,18 @@
 import logging
 import os
-import shutil
 
-import dgl
+import numpy as np
 import torch as th
 import torch.nn as nn
+import torch.nn.functional as F
 
 from model.cnn_model import ConvolutionalNet
+from .checkpoint import checkpoint_writer
 from .config import cfg
 from .decoder import Decoder
 from .encoder import Encoder
-from .gnn import LGCNLayer
+from .gnn import CompleteGraphBuilder, EdgePolicy, LGCNLayer, graph_membership_of
+from .situation import SITUATION_CATEGORIES, SituationTable, SparseSituation, situation_categories
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +21,7 @@ device = th.device("cuda" if th.cuda.is_available() else "cpu")
 
 class GSCAN_model(nn.Module):
     def __init__(self, pad_idx, target_eos_idx, input_vocab_size, target_vocab_size, output_directory=None,
-                 is_baseline=False, multigpu=False,
-                 ):
+                 is_baseline=False):
         super().__init__()
 
         self.num_vocab = input_vocab_size
@@ -56,16 +57,12 @@ class GSCAN_model(nn.Module):
                                                       dropout_probability=0.1,
                                                       flatten_output=True)
             self.lgcn = LGCNLayer()
+            self.graph_builder = CompleteGraphBuilder() if self.lgcn.backend == "dgl" else None
+            self.edge_policy = None
+            if cfg.GRAPH_EDGE_POLICY != "complete":
+                self.edge_policy = EdgePolicy(cfg.GRAPH_EDGE_POLICY, k=cfg.GRAPH_KNN, radius=cfg.GRAPH_RADIUS)
             self.decoder = Decoder(target_vocab_size, pad_idx, is_baseline=is_baseline)
 
-        if multigpu:
-            raise Exception("Buggy implmentation!")
-            self.encoder = th.nn.DataParallel(self.encoder)
-            self.decoder = th.nn.DataParallel(self.decoder)
-            if self.lgcn is not None:
-                self.lgcn = th.nn.DataParallel(self.lgcn)
-            self.situation_encoder = th.nn.DataParallel(self.situation_encoder)
-
         self.loss_criterion = nn.NLLLoss(ignore_index=pad_idx)
         self.tanh = nn.Tanh()
         self.target_eos_idx = target_eos_idx
@@ -79,28 +76,55 @@ class GSCAN_model(nn.Module):
         self.best_accuracy = 0
 
         self.device = th.device("cuda" if th.cuda.is_available() else "cpu")
+        self.situation_buffer = None
 
     def nonzero_extractor(self, x, cnn_out=None):
-        lx = []
-        for i in range(x.size(0)):
-            sum_x = th.sum(x[i], dim=-1)
-            if cnn_out is None:
-                lx.append(x[i, sum_x.gt(0), :])
-            else:
-                lx.append(cnn_out[i, sum_x.gt(0), :])
-        return lx
+        """
+        :param x: [B, H, W, K] situations, a cell is occupied when any of its features is set
+        :param cnn_out: [B, H, W, d] features to extract instead of x
+        :return: [number of occupied cells, d] features of the occupied cells, packed over the batch in row-major order,
+        and [B + 1] offsets: the cells of example i are rows offsets[i]:offsets[i + 1]
+        """
+        occupied = x.sum(dim=-1).gt(0)
+        nodes = (x if cnn_out is None else cnn_out)[occupied]
+        num_nodes = occupied.flatten(1).sum(dim=1)
+        offsets = th.cat([num_nodes.new_zeros(1), th.cumsum(num_nodes, dim=0)])
+        return nodes, offsets
 
     def nonzero_insertor(self, node_out, situation_batch):
-        padding_len = node_out[0].size()[-1] - situation_batch.size()[-1]
-        # assume B X H X W X K size for situation_batch
-        B, H, W, _ = situation_batch.size()
-        situation_paddng = th.zeros(B, H, W, padding_len).to(situation_batch.device)
-        situation_batch = th.cat((situation_batch, situation_paddng), dim=-1)
-        for i in range(situation_batch.size(0)):
-            sum_x = th.sum(situation_batch[i], dim=-1)
-            situation_batch[i, sum_x.gt(0), :] = node_out[i]
+        """
+        Writes the output of every occupied cell back onto the grid; empty cells are zero.
+        :param node_out: [number of occupied cells, d] packed as by nonzero_extractor (or the SparseSituation)
+        :param situation_batch: [B, H, W, K] situations or a SparseSituation, gives the occupied cells
+        :return: [B, H, W, d] tensor, without gradients a view of a buffer that is reused by the next call
+        """
+        if isinstance(situation_batch, SparseSituation):
+            B, H, W = situation_batch.batch_size, situation_batch.grid_size, situation_batch.grid_size
+        else:
+            # assume B X H X W X K size for situation_batch
+            B, H, W, _ = situation_batch.size()
+        situation_out = self.insertor_buffer((B, H, W, node_out.size(-1)), node_out)
+        if isinstance(situation_batch, SparseSituation):
+            situation_out.view(B * H * W, -1)[situation_batch.flat_cells()] = node_out
+        else:
+            situation_out[situation_batch.sum(dim=-1).gt(0)] = node_out
 
-        return situation_batch
+        return situation_out
+
+    def insertor_buffer(self, shape, like):
+        """
+        :return: zeroed tensor of the given shape; without gradients (decoding, evaluation), it shares the storage that
+        nonzero_insertor reuses across calls, with gradients a fresh tensor, as autograd may still need the previous one
+        (e.g. several forward passes before backward)
+        """
+        if th.is_grad_enabled():
+            return like.new_zeros(shape)
+        numel = int(np.prod(shape))
+        if self.situation_buffer is None or self.situation_buffer.numel() < numel or \
+                self.situation_buffer.device != like.device or self.situation_buffer.dtype != like.dtype:
+            self.situation_buffer = like.new_empty(numel)
+        # detached, so the buffer never carries the autograd history of a previous step
+        return self.situation_buffer[:numel].detach().view(shape).zero_()
 
     @staticmethod
     def remove_start_of_sequence(input_tensor, target_pad_idx=0):
@@ -134,6 +158,43 @@ class GSCAN_model(nn.Module):
             accuracy = 100. * match_targets_sum / total
         return accuracy, exact_match
 
+    def situation_embedding_table(self):
+        """
+        The projections of one-hot blocks are lookups of their weight columns. Row c of the block of a feature holds the
+        embedding of its category c (see model.situation.situation_categories), row 0 being the empty block, and every
+        block fills its own 16 of the 64 dimensions.
+        :return: [5 + 4 + 5 + 5, 64] lookup table of the size, shape, color and agent blocks, built from the weights of
+        the four projections so it stays trained and loaded with them
+        """
+        size, shape, rgb, agent = [embedding.weight.t() for embedding in (self.size_embedding, self.shape_embedding,
+                                                                          self.yrgb_embedding, self.agent_embedding)]
+        # a cell with the agent has the agent bit set on top of its direction
+        agent = agent[:1] + agent[1:]
+        blocks = [th.cat([block.new_zeros(1, block.size(1)), block], dim=0) for block in (size, shape, rgb, agent)]
+        return th.block_diag(*blocks)
+
+    def embed_situation(self, situation, categories=None, categorical=None):
+        """
+        :param situation: [..., 16] situation features (size, shape, color and agent one-hots)
+        :param categories: [..., 4] situation_categories of the features, computed from them when not given
+        :param categorical: whether the features are one-hot blocks, None if unknown: cfg.SITUATION_LOOKUP_EMBEDDING
+        decides, False falls back to the projections
+        :return: [..., 64] embedded situation features
+        """
+        if categories is not None or (cfg.SITUATION_LOOKUP_EMBEDDING and categorical is not False):
+            if categories is None:
+                categories = situation_categories(situation)
+            # one gather: every cell sums the rows of its four categories, offset to their block in the table
+            block_offsets = categories.new_tensor(np.cumsum([0] + SITUATION_CATEGORIES[:-1]))
+            embedded = F.embedding_bag((categories + block_offsets).view(-1, 4).long(),
+                                       self.situation_embedding_table(), mode='sum')
+            return embedded.view(*categories.shape[:-1], -1)
+        size = self.size_embedding(situation[..., :4])
+        shape = self.shape_embedding(situation[..., 4:7])
+        rgb = self.yrgb_embedding(situation[..., 7:11])
+        agent = self.agent_embedding(situation[..., 11:])
+        return th.cat([size, shape, rgb, agent], dim=-1)
+
     def encode_input(self, cmd_batch, situation_batch):
         batchSize = cmd_batch[0].size(0)
         # print("batch size is ", batchSize)
@@ -143,45 +204,67 @@ class GSCAN_model(nn.Module):
         # LSTM
         cmd_out, cmd_h = self.encoder(cmdIndices, cmdLengths)
 
-        # convert situation to embedding
-        size = self.size_embedding(situation_batch[:, :, :, :4])
-        shape = self.shape_embedding(situation_batch[:, :, :, 4:7])
-        rgb = self.yrgb_embedding(situation_batch[:, :, :, 7:11])
-        agent = self.agent_embedding(situation_batch[:, :, :, 11:])
-        embedded_situation = th.cat([size, shape, rgb, agent], dim=-1)
+        # a SituationTable holds every distinct situation of the batch once: whatever only depends on the situation is
+        # computed per distinct situation and gathered with situation_index afterwards
+        situation_index, categorical = None, None
+        if isinstance(situation_batch, SituationTable):
+            situation_batch, situation_index, categorical = situation_batch.situations, situation_batch.index, \
+                                                            situation_batch.categorical
+        # a SparseSituation only carries the occupied cells, which are all the LGCN needs
+        is_sparse = isinstance(situation_batch, SparseSituation)
 
         if self.is_baseline:
+            if is_sparse:
+                situation_batch = situation_batch.to_dense()
             # situation_out = self.situation_encoder(embedded_situation)  # ablation
             situation_out = self.situation_encoder(situation_batch)  # baseline
+            if situation_index is not None:
+                situation_out = situation_out[situation_index]
             batch_size, image_num_memory, _ = situation_out.size()
-            situations_lengths = [image_num_memory for _ in range(batch_size)]
+            situations_lengths = th.full((batch_size,), image_num_memory, dtype=th.long, device=situation_out.device)
         else:
             # LGCN first, then CNN
-            xs = self.nonzero_extractor(situation_batch, embedded_situation)
-            gs = []
-            graph_membership = []
-            dgl_gs = [dgl.DGLGraph() for _ in range(batchSize)]
-            for i, x in enumerate(xs):
-                dgl_gs[i].add_nodes(x.size(0))
-                src_l, dst_l = [], []
-                for j in range(x.size(0)):
-                    for k in range(x.size(0)):
-                        if j != k:
-                            src_l.append(j)
-                            dst_l.append(k)
-                dgl_gs[i].add_edges(src_l, dst_l)
-                graph_membership += [i for _ in range(x.size(0))]
-            batch_g = dgl.batch(dgl_gs)
-            situation_X = th.cat(xs, dim=0)
-            graph_membership = th.tensor(graph_membership, dtype=th.long, device=self.device)
+            # the embedding only depends on the situation; from the LGCN on, everything is conditioned on the command,
+            # so every example needs its own copy
+            if is_sparse:
+                # the embedded cells keep the cell layout, so they can be gathered per example like the situation
+                embedded_cells = self.embed_situation(situation_batch.features, situation_batch.categories,
+                                                      categorical)
+                situation_batch = SparseSituation(situation_batch.cells, embedded_cells, situation_batch.offsets,
+                                                  situation_batch.grid_size)
+                if situation_index is not None:
+                    situation_batch = situation_batch.select(situation_index)
+                situation_X, num_nodes = situation_batch.features, situation_batch.num_cells()
+            else:
+                # only the occupied cells are embedded, once per distinct situation
+                situation_X, node_offsets = self.nonzero_extractor(situation_batch)
+                situation_X = self.embed_situation(situation_X, categorical=categorical)
+                if situation_index is not None:
+                    # the embedded cells are packed as a SparseSituation to be gathered per example like above
+                    cells = situation_batch.sum(dim=-1).gt(0).flatten(1).nonzero()[:, 1]
+                    situation_batch = SparseSituation(cells, situation_X, node_offsets,
+                                                      situation_batch.size(1)).select(situation_index)
+                    situation_X, is_sparse = situation_batch.features, True
+                    node_offsets = situation_batch.offsets
+                num_nodes = node_offsets[1:] - node_offsets[:-1]
+            graph_membership = graph_membership_of(num_nodes)
+            edges = None
+            if self.edge_policy is not None:
+                if is_sparse:
+                    cells, grid_size = situation_batch.cells, situation_batch.grid_size
+                else:
+                    cells = situation_batch.sum(dim=-1).gt(0).flatten(1).nonzero()[:, 1]
+                    grid_size = situation_batch.size(1)
+                edges = self.edge_policy(cells, graph_membership, num_nodes, grid_size)
+            batch_g = self.graph_builder(num_nodes, edges) if self.graph_builder is not None else None
 
             # LGCN
-            situation_out_node = self.lgcn(situation_X, batch_g, cmd_h, cmd_out, cmdLengths, batchSize,
-                                           graph_membership)
+            situation_out_node, _ = self.lgcn(situation_X, batch_g, cmd_h, cmd_out, cmdLengths, batchSize,
+                                              graph_membership, edges)
             situation_batch = self.nonzero_insertor(situation_out_node, situation_batch)
             situation_out = self.situation_encoder(situation_batch)
             batch_size, image_num_memory, _ = situation_out.size()
-            situations_lengths = [image_num_memory for _ in range(batch_size)]
+            situations_lengths = th.full((batch_size,), image_num_memory, dtype=th.long, device=situation_out.device)
 
         return cmd_h, cmd_out, cmdLengths, situation_out, situations_lengths
 
@@ -189,7 +272,7 @@ class GSCAN_model(nn.Module):
         '''
         cmd_batch[0]: batchsize x max_length
         cmd_batch[1]: batchsize
-        situation_batch[0]: batchsize x grid x grid x k
+        situation_batch[0]: batchsize x grid x grid x k, a SparseSituation or a SituationTable
         '''
         batchSize = cmd_batch[0].size(0)
         # print("batch size is ", batchSize)
@@ -228,21 +311,25 @@ class GSCAN_model(nn.Module):
             self.best_accuracy = accuracy
             self.best_iteration = self.trained_iterations
 
-    def save_checkpoint(self, file_name: str, is_best: bool, optimizer_state_dict: dict) -> str:
+    def save_checkpoint(self, file_name: str, is_best: bool, optimizer_state_dict: dict,
+                        model_state_dict=None, rotate=False) -> str:
         """
+        The checkpoint is copied to the CPU and written in the background, see CheckpointWriter in model/checkpoint.py;
+        wait_for_checkpoints() blocks until it is on disk.
         :param file_name: filename to save checkpoint in.
         :param is_best: boolean describing whether or not the current state is the best the model has ever been.
         :param optimizer_state_dict: state of the optimizer.
+        :param model_state_dict: weights to save instead of the current ones, e.g. a snapshot evaluated meanwhile.
+        :param rotate: only the last cfg.TRAIN.KEEP_LAST_CHECKPOINTS checkpoints saved with rotate are kept.
         :return: str to path where the model is saved.
         """
-        path = os.path.join(self.output_directory, file_name)
-        state = self.get_current_state()
+        state = self.get_current_state() if model_state_dict is None else {'model_state_dict': model_state_dict}
         state["optimizer_state_dict"] = optimizer_state_dict
-        th.save(state, path)
-        if is_best:
-            best_path = os.path.join(self.output_directory, 'model_best.pth.tar')
-            shutil.copyfile(path, best_path)
-        return path
+        writer = checkpoint_writer(self.output_directory, keep_last=cfg.TRAIN.KEEP_LAST_CHECKPOINTS)
+        return writer.save(file_name, state, is_best=is_best, rotate=rotate)
+
+    def wait_for_checkpoints(self):
+        checkpoint_writer(self.output_directory, keep_last=cfg.TRAIN.KEEP_LAST_CHECKPOINTS).wait()
 
     def get_current_state(self):
         return {'model_state_dict': self.state_dict()}
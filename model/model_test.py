@@ -0,0 +1,113 @@
+# TODO: use test framework instead of asserts
+import logging
+import time
+
+import torch
+
+from model.config import cfg
+from model.model import GSCAN_model
+from model.situation import SITUATION_CATEGORIES, SituationTable, situation_features
+from model.testing import gradients_match, weighted_gradients
+
+logger = logging.getLogger(__name__)
+
+TEST_INPUT_VOCAB_SIZE = 12
+TEST_TARGET_VOCAB_SIZE = 9
+TEST_PAD_IDX, TEST_EOS_IDX = 1, 3
+TEST_NUM_SITUATIONS = 3
+TEST_GRID_SIZE = 6
+
+
+def random_categories(num_situations, grid_size):
+    """:return: [num_situations, grid_size, grid_size, 4] categories, about half of the cells empty"""
+    categories = torch.stack([torch.randint(0, num_categories, (num_situations, grid_size, grid_size))
+                              for num_categories in SITUATION_CATEGORIES], dim=-1)
+    return categories * torch.randint(0, 2, (num_situations, grid_size, grid_size, 1))
+
+
+def lookup_embedding_model():
+    torch.manual_seed(0)
+    model = GSCAN_model(TEST_PAD_IDX, TEST_EOS_IDX, TEST_INPUT_VOCAB_SIZE, TEST_TARGET_VOCAB_SIZE)
+    # trained projection weights instead of the initial ones
+    projections = {name: torch.randn_like(weight) for name, weight in model.state_dict().items()
+                   if name.split('.')[0] in ('size_embedding', 'shape_embedding', 'yrgb_embedding', 'agent_embedding')}
+    model.load_state_dict(projections, strict=False)
+    return model
+
+
+def test_lookup_embedding_matches_projections():
+    start = time.time()
+    model = lookup_embedding_model()
+    categories = random_categories(TEST_NUM_SITUATIONS, TEST_GRID_SIZE)
+    features = situation_features(categories).float()
+
+    # the lookup from the categories, from the features, and the projections of the features
+    embedded = [model.embed_situation(features, categories), model.embed_situation(features, categorical=True),
+                model.embed_situation(features, categorical=False)]
+    weights = [projection.weight for projection in (model.size_embedding, model.shape_embedding,
+                                                    model.yrgb_embedding, model.agent_embedding)]
+    gradients = [weighted_gradients(embedding, weights) for embedding in embedded]
+    for embedding, embedding_gradients in zip(embedded[:2], gradients[:2]):
+        assert torch.allclose(embedding, embedded[2], atol=1e-6), "test_lookup_embedding_matches_projections FAILED"
+        assert gradients_match(embedding_gradients, gradients[2], atol=1e-5), \
+            "test_lookup_embedding_matches_projections FAILED"
+    end = time.time()
+    logger.info("test_lookup_embedding_matches_projections PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_non_categorical_situations_are_projected():
+    start = time.time()
+    model = lookup_embedding_model().eval()
+    commands = torch.randint(2, TEST_INPUT_VOCAB_SIZE, (4, 5)), torch.full((4,), 5, dtype=torch.long)
+    # features that are not one-hot blocks, e.g. normalized or noisy ones
+    situations = situation_features(random_categories(TEST_NUM_SITUATIONS, TEST_GRID_SIZE)).float()
+    situations = situations * torch.rand(situations.shape)
+    index = torch.tensor([0, 2, 2, 1])
+
+    lookup_embedding = cfg.SITUATION_LOOKUP_EMBEDDING
+    with torch.no_grad():
+        cfg.SITUATION_LOOKUP_EMBEDDING = False
+        expected = model.encode_input(commands, SituationTable(situations, index))[3]
+        cfg.SITUATION_LOOKUP_EMBEDDING = True
+        encoded = model.encode_input(commands, SituationTable(situations, index, categorical=False))[3]
+    cfg.SITUATION_LOOKUP_EMBEDDING = lookup_embedding
+    assert torch.allclose(encoded, expected, atol=1e-6), "test_non_categorical_situations_are_projected FAILED"
+    end = time.time()
+    logger.info("test_non_categorical_situations_are_projected PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_situation_table_matches_expanded_batch():
+    start = time.time()
+    commands = torch.randint(2, TEST_INPUT_VOCAB_SIZE, (4, 5)), torch.full((4,), 5, dtype=torch.long)
+    situations = situation_features(random_categories(TEST_NUM_SITUATIONS, TEST_GRID_SIZE)).float()
+    index = torch.tensor([0, 2, 2, 1])
+
+    edge_policy = cfg.GRAPH_EDGE_POLICY
+    for cfg.GRAPH_EDGE_POLICY in ("complete", "knn"):
+        model = lookup_embedding_model().eval()
+        weights = [projection.weight for projection in (model.size_embedding, model.shape_embedding,
+                                                        model.yrgb_embedding, model.agent_embedding)]
+        # the distinct situations embedded once and gathered, and every example embedded on its own
+        encoded = [model.encode_input(commands, batch)[3] for batch in (SituationTable(situations, index),
+                                                                        situations[index])]
+        gradients = [weighted_gradients(encoding, weights) for encoding in encoded]
+        assert torch.allclose(encoded[0], encoded[1], atol=1e-6), "test_situation_table_matches_expanded_batch FAILED"
+        assert gradients_match(gradients[0], gradients[1], atol=1e-5), \
+            "test_situation_table_matches_expanded_batch FAILED"
+    cfg.GRAPH_EDGE_POLICY = edge_policy
+    end = time.time()
+    logger.info("test_situation_table_matches_expanded_batch PASSED in {} seconds".format(end - start))
+    return
+
+
+def run_all_tests():
+    test_lookup_embedding_matches_projections()
+    test_non_categorical_situations_are_projected()
+    test_situation_table_matches_expanded_batch()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    run_all_tests()
@@ -0,0 +1,133 @@
+import torch
+
+# The features of a cell are one-hot blocks over size, shape and color of the object on it, followed by the agent bit
+# and the one-hot agent direction. (start, end) of every block:
+SITUATION_BLOCKS = [(0, 4), (4, 7), (7, 11), (11, 16)]
+# number of categories of every block, category 0 meaning the block is empty (no object or no agent on the cell)
+SITUATION_CATEGORIES = [5, 4, 5, 5]
+
+
+def situation_categories(features: torch.Tensor) -> torch.Tensor:
+    """
+    :param features: [..., 16] cell features
+    :return: [..., 4] category of the size, shape, color and agent block: 0 when the block is empty, otherwise 1 + the
+    index of its set entry (for the agent block, of its direction)
+    """
+    categories = []
+    for i, (start, end) in enumerate(SITUATION_BLOCKS):
+        block = features[..., start:end]
+        if i == len(SITUATION_BLOCKS) - 1:
+            present, block = block[..., 0] > 0, block[..., 1:]
+        else:
+            present = block.sum(dim=-1) > 0
+        categories.append((block.argmax(dim=-1) + 1) * present.long())
+    return torch.stack(categories, dim=-1)
+
+
+def situation_features(categories: torch.Tensor) -> torch.Tensor:
+    """:return: [..., 16] the cell features of the given categories, inverse of situation_categories for one-hot cells"""
+    blocks = []
+    for i, ((start, end), category) in enumerate(zip(SITUATION_BLOCKS, categories.unbind(dim=-1))):
+        one_hot = torch.nn.functional.one_hot(category.long(), SITUATION_CATEGORIES[i])
+        if i == len(SITUATION_BLOCKS) - 1:
+            blocks.append(torch.cat([one_hot[..., 1:].sum(dim=-1, keepdim=True), one_hot[..., 1:]], dim=-1))
+        else:
+            blocks.append(one_hot[..., 1:])
+    return torch.cat(blocks, dim=-1)
+
+
+class SparseSituation(object):
+    """
+    A batch of grid situations stored as its occupied cells only, packed over the batch:
+      cells: [num_cells] flat index (row * grid_size + column) of every occupied cell, ascending within an example
+      features: [num_cells, num_features] feature vector of every occupied cell
+      offsets: [batch_size + 1] the cells of example i are cells[offsets[i]:offsets[i + 1]]
+      categories: optional [num_cells, 4] situation_categories of every cell, when the features are one-hot blocks
+    """
+
+    def __init__(self, cells: torch.Tensor, features: torch.Tensor, offsets: torch.Tensor, grid_size: int,
+                 categories: torch.Tensor = None):
+        self.cells = cells
+        self.features = features
+        self.offsets = offsets
+        self.grid_size = grid_size
+        self.categories = categories
+
+    @property
+    def batch_size(self) -> int:
+        return self.offsets.size(0) - 1
+
+    def to(self, device, non_blocking=False):
+        categories = self.categories
+        if categories is not None:
+            categories = categories.to(device, non_blocking=non_blocking)
+        return SparseSituation(self.cells.to(device, non_blocking=non_blocking),
+                               self.features.to(device, non_blocking=non_blocking),
+                               self.offsets.to(device, non_blocking=non_blocking), self.grid_size, categories)
+
+    def num_cells(self) -> torch.Tensor:
+        """:return: [batch_size] number of occupied cells per example"""
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def graph_membership(self) -> torch.Tensor:
+        """:return: [num_cells] index of the example every cell belongs to"""
+        return torch.repeat_interleave(torch.arange(self.batch_size, device=self.offsets.device), self.num_cells())
+
+    def select(self, index: torch.Tensor):
+        """
+        :param index: [n] examples to gather, repetitions allowed
+        :return: SparseSituation holding the cells of the given examples, in that order
+        """
+        counts = self.num_cells()[index]
+        offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)])
+        # positions of the cells of every selected example: offsets[index[i]] + 0 ... offsets[index[i]] + counts[i] - 1
+        positions = torch.repeat_interleave(self.offsets[index] - offsets[:-1], counts) + \
+            torch.arange(int(offsets[-1]), device=offsets.device)
+        categories = None if self.categories is None else self.categories[positions]
+        return SparseSituation(self.cells[positions], self.features[positions], offsets, self.grid_size, categories)
+
+    def flat_cells(self) -> torch.Tensor:
+        """:return: [num_cells] index of every cell in the [batch_size * grid_size * grid_size] flattened grids"""
+        return self.graph_membership() * (self.grid_size * self.grid_size) + self.cells.long()
+
+    def to_dense(self, features=None) -> torch.Tensor:
+        """
+        Scatter per-cell features back onto the grid; empty cells are zero.
+        :param features: [num_cells, d] features to scatter, defaults to the cells' own features
+        :return: [batch_size, grid_size, grid_size, d]
+        """
+        features = self.features if features is None else features
+        num_grid_cells = self.grid_size * self.grid_size
+        dense = features.new_zeros(self.batch_size * num_grid_cells, features.size(-1))
+        dense = dense.index_copy(0, self.flat_cells(), features)
+        return dense.view(self.batch_size, self.grid_size, self.grid_size, features.size(-1))
+
+
+class SituationTable(object):
+    """
+    A batch of situations where every distinct situation is stored once:
+      situations: [num_situations, grid, grid, num_features] tensor, or a SparseSituation of num_situations examples
+      index: [batch_size] row of situations every example refers to
+      categorical: whether the cell features are one-hot blocks (see situation_categories), None if unknown
+    Work that only depends on the situation (embedding, graph structure, a command-independent encoder) can be done
+    once per row and gathered with index.
+    """
+
+    def __init__(self, situations, index: torch.Tensor, categorical: bool = None):
+        self.situations = situations
+        self.index = index
+        self.categorical = categorical
+
+    @property
+    def batch_size(self) -> int:
+        return self.index.size(0)
+
+    def to(self, device, non_blocking=False):
+        return SituationTable(self.situations.to(device, non_blocking=non_blocking),
+                              self.index.to(device, non_blocking=non_blocking), self.categorical)
+
+    def expand(self):
+        """:return: the situation of every example, in the representation of the table"""
+        if isinstance(self.situations, SparseSituation):
+            return self.situations.select(self.index)
+        return self.situations[self.index]
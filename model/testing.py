@@ -0,0 +1,25 @@
+import torch
+
+
+def weighted_gradients(outputs, inputs):
+    """
+    Gradients for comparing two implementations of a computation: the gradients of a sum of the outputs weighted from
+    -1 to 1 over their elements. Unlike the plain sum, it tells apart the gradients of different output elements (e.g.
+    the plain sum of a softmax is constant).
+    :param outputs: tensor or list of tensors, outputs to leave out of the comparison can be multiplied by a 0 mask
+    :param inputs: tensors to differentiate
+    :return: tuple of the gradient of every input, None for the inputs the outputs do not depend on
+    """
+    outputs = [outputs] if isinstance(outputs, torch.Tensor) else outputs
+    weighted_sum = sum((output * torch.linspace(-1, 1, output.numel()).view_as(output)).sum() for output in outputs)
+    return torch.autograd.grad(weighted_sum, inputs, allow_unused=True)
+
+
+def gradients_match(gradients, reference_gradients, atol):
+    """:return: whether every gradient is None where its reference is and within atol of it elsewhere"""
+    for gradient, reference in zip(gradients, reference_gradients):
+        if (gradient is None) != (reference is None):
+            return False
+        if gradient is not None and not torch.allclose(gradient, reference, atol=atol):
+            return False
+    return True
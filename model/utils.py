@@ -8,6 +8,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .config import cfg
+
 logger = logging.getLogger(__name__)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -60,7 +62,7 @@ def sequence_mask(sequence_lengths: torch.LongTensor, max_len=None) -> torch.ten
     if max_len is None:
         max_len = sequence_lengths.data.max()
     batch_size = sequence_lengths.size(0)
-    sequence_range = torch.arange(0, max_len).long().to(device=device)
+    sequence_range = torch.arange(0, max_len, dtype=torch.long, device=sequence_lengths.device)
 
     # [batch_size, max_len]
     sequence_range_expand = sequence_range.unsqueeze(0).expand(batch_size, max_len)
@@ -166,7 +168,7 @@ def predict_and_save(dataset_iterator, model, output_file_path, max_decoding_ste
                  auxiliary_accuracy_target) in predict(
                     dataset_iterator, model=model, max_decoding_steps=max_decoding_steps,
                     pad_idx=pad_idx, sos_idx=sos_idx,
-                    eos_idx=eos_idx):
+                    eos_idx=eos_idx, trace_attention=True):
                 i += 1
                 input_sequence = x.input
                 target_sequence = x.target
@@ -181,8 +183,8 @@ def predict_and_save(dataset_iterator, model, output_file_path, max_decoding_ste
                                # "derivation": derivation_spec,
                                "target": target_str_sequence,
                                # "situation": situation_spec,
-                               "attention_weights_input": attention_weights_commands,
-                               "attention_weights_situation": attention_weights_situations,
+                               "attention_weights_input": attention_weights_commands.tolist(),
+                               "attention_weights_situation": attention_weights_situations.tolist(),
                                "accuracy": accuracy,
                                "exact_match": True if accuracy == 100 else False,
                                "position_accuracy": auxiliary_accuracy_target})
@@ -191,8 +193,206 @@ def predict_and_save(dataset_iterator, model, output_file_path, max_decoding_ste
     return output_file_path
 
 
+def greedy_decode(model: nn.Module, input_batch, situation_batch, max_decoding_steps: int, pad_idx: int,
+                  sos_idx: int, eos_idx: int, trace_attention=False):
+    """
+    Greedy decoding of a batch until every row emitted <EOS> or max_decoding_steps were taken. Tokens are written into
+    a preallocated buffer, and the rows that finished are dropped from the decoder state (hidden state, projected keys
+    and lengths), so every step only computes the rows still decoding.
+    :param input_batch: (commands, command lengths) like Batch.input
+    :param situation_batch: situations like Batch.situation
+    :param trace_attention: whether to record the attention weights of every step, into buffers preallocated on the
+    device that are copied to the host once per batch
+    :return: output_tokens: [batch_size, num_steps + 1] long tensor, <SOS> followed by the predictions, <PAD> after
+    <EOS>; when tracing, the [num_steps, batch_size, max_input_length] command and [num_steps, batch_size,
+    situation_length] situation attention weights as numpy arrays (zeros for the rows that finished), None otherwise;
+    and the [batch_size, situation_length] sum of the situation attention weights over the steps decoded by every row
+    """
+    hidden, encoded_commands, \
+    command_lengths, encoded_situations, situations_lengths = model.encode_input(input_batch, situation_batch)
+    attention_decoder = model.decoder.attentionDecoder
+
+    projected_keys_visual = attention_decoder.visual_attention.key_layer(
+        encoded_situations)  # [batch_size, situation_length, dec_hidden_dim]
+    projected_keys_textual = attention_decoder.textual_attention.key_layer(
+        encoded_commands)  # [batch_size, max_input_length, dec_hidden_dim]
+    hidden = attention_decoder.initialize_hidden(model.decoder.tanh(model.decoder.enc_hidden_to_dec_hidden(hidden)))
+    command_lengths = torch.as_tensor(command_lengths, device=projected_keys_textual.device)
+    situations_lengths = torch.as_tensor(situations_lengths, device=projected_keys_visual.device)
+
+    batch_size = projected_keys_visual.size(0)
+    output_tokens = torch.full((batch_size, max_decoding_steps + 1), pad_idx, dtype=torch.long,
+                               device=projected_keys_visual.device)
+    output_tokens[:, 0] = sos_idx
+    # rows of the full batch that are still decoding, the decoder state only holds these rows
+    active = torch.arange(batch_size, device=output_tokens.device)
+    input_tokens = output_tokens[:, 0]
+    contexts_situation = projected_keys_visual.new_zeros(batch_size, projected_keys_visual.size(1))
+    attention_weights_commands, attention_weights_situations = None, None
+    if trace_attention:
+        attention_weights_commands = projected_keys_textual.new_zeros(max_decoding_steps, batch_size,
+                                                                      projected_keys_textual.size(1))
+        attention_weights_situations = projected_keys_visual.new_zeros(max_decoding_steps, batch_size,
+                                                                       projected_keys_visual.size(1))
+
+    num_steps = 0
+    while num_steps < max_decoding_steps:
+        (output, hidden, context_situation, attention_weights_command,
+         attention_weights_situation) = attention_decoder.forward_step(
+            input_tokens=input_tokens, last_hidden=hidden, encoded_commands=projected_keys_textual,
+            commands_lengths=command_lengths, encoded_situations=projected_keys_visual,
+            situations_lengths=situations_lengths)
+        token = output.max(dim=-1)[1]  # the arg max of the scores is the arg max of their log_softmax
+        num_steps += 1
+        output_tokens[active, num_steps] = token
+        contexts_situation[active] += context_situation
+        if trace_attention:
+            attention_weights_commands[num_steps - 1, active] = attention_weights_command
+            attention_weights_situations[num_steps - 1, active] = attention_weights_situation
+
+        unfinished = token.ne(eos_idx)
+        num_unfinished = int(unfinished.sum())
+        if num_unfinished == 0:
+            break
+        if num_unfinished < active.size(0):
+            keep = unfinished.nonzero().squeeze(1)
+            active, token = active[keep], token[keep]
+            hidden = tuple(state.index_select(1, keep) for state in hidden)
+            projected_keys_textual = projected_keys_textual.index_select(0, keep)
+            projected_keys_visual = projected_keys_visual.index_select(0, keep)
+            command_lengths, situations_lengths = command_lengths[keep], situations_lengths[keep]
+        input_tokens = token
+
+    if trace_attention:
+        attention_weights_commands = attention_weights_commands[:num_steps].cpu().numpy()
+        attention_weights_situations = attention_weights_situations[:num_steps].cpu().numpy()
+    return output_tokens[:, :num_steps + 1], attention_weights_commands, attention_weights_situations, \
+           contexts_situation
+
+
+def beam_search_decode(model: nn.Module, input_batch, situation_batch, max_decoding_steps: int, pad_idx: int,
+                       sos_idx: int, eos_idx: int, beam_size: int, length_normalization=1., trace_attention=False):
+    """
+    Batched beam search: the beam_size hypotheses of every example are decoded as rows of one batch of
+    batch_size * beam_size rows, which attend to the encoder outputs of their example without copying them (see
+    forward_step). A hypothesis finishes when its <EOS> extension ranks among the beam_size best extensions of its
+    example, so that beam_size 1 with length_normalization 0 is greedy decoding, and is scored by log-probability /
+    length ** length_normalization; an example stops decoding, and leaves the batch, once no unfinished hypothesis can
+    score better than its best finished one. Examples without any finished hypothesis after max_decoding_steps return
+    their best unfinished one.
+    :param trace_attention: whether to record the attention weights of every step of every hypothesis, which are
+    reordered with the hypotheses, to return the ones of the best hypothesis
+    :return: output_tokens: [batch_size, num_steps + 1] long tensor, <SOS> followed by the best hypothesis, <PAD> after
+    <EOS>; when tracing, the [num_steps, batch_size, max_input_length] command and [num_steps, batch_size,
+    situation_length] situation attention weights of the best hypothesis as numpy arrays (zeros after its <EOS>), None
+    otherwise; and the [batch_size, situation_length] sum of the situation attention weights of the best hypothesis
+    over its steps
+    """
+    hidden, encoded_commands, \
+    command_lengths, encoded_situations, situations_lengths = model.encode_input(input_batch, situation_batch)
+    attention_decoder = model.decoder.attentionDecoder
+
+    projected_keys_visual = attention_decoder.visual_attention.key_layer(encoded_situations)
+    projected_keys_textual = attention_decoder.textual_attention.key_layer(encoded_commands)
+    hidden = attention_decoder.initialize_hidden(model.decoder.tanh(model.decoder.enc_hidden_to_dec_hidden(hidden)))
+    hidden = tuple(state.repeat_interleave(beam_size, dim=1) for state in hidden)  # [num_layers, batch * beam, d]
+    command_lengths = torch.as_tensor(command_lengths, device=projected_keys_textual.device)
+    situations_lengths = torch.as_tensor(situations_lengths, device=projected_keys_visual.device)
+
+    batch_size, situation_length = projected_keys_visual.size(0), projected_keys_visual.size(1)
+    tokens = torch.full((batch_size, beam_size, max_decoding_steps + 1), pad_idx, dtype=torch.long,
+                        device=projected_keys_visual.device)
+    tokens[:, :, 0] = sos_idx
+    contexts_situation = projected_keys_visual.new_zeros(batch_size, beam_size, situation_length)
+    # log-probability of every hypothesis; all hypotheses start out equal, so only the first one is expanded
+    scores = projected_keys_visual.new_full((batch_size, beam_size), float('-inf'))
+    scores[:, 0] = 0.
+    best_scores = projected_keys_visual.new_full((batch_size,), float('-inf'))
+    best_tokens = tokens[:, 0].clone()
+    best_contexts = contexts_situation[:, 0].clone()
+    active = torch.arange(batch_size, device=tokens.device)
+    # [batch_size, beam_size, max_decoding_steps, memory length] attention weights of every hypothesis
+    traces, best_traces = None, None
+    if trace_attention:
+        traces = [keys.new_zeros(batch_size, beam_size, max_decoding_steps, keys.size(1))
+                  for keys in (projected_keys_textual, projected_keys_visual)]
+        best_traces = [trace[:, 0].clone() for trace in traces]
+
+    num_steps = 0
+    while num_steps < max_decoding_steps:
+        num_active = active.size(0)
+        (output, hidden, context_situation, attention_weights_command,
+         attention_weights_situation) = attention_decoder.forward_step(
+            input_tokens=tokens[active, :, num_steps].reshape(-1), last_hidden=hidden,
+            encoded_commands=projected_keys_textual, commands_lengths=command_lengths,
+            encoded_situations=projected_keys_visual, situations_lengths=situations_lengths, beam_size=beam_size)
+        num_steps += 1
+        # [num_active, beam_size, vocabulary_size]
+        candidates = scores[:, :, None] + F.log_softmax(output, dim=-1).view(num_active, beam_size, -1)
+        contexts = contexts_situation[active] + context_situation.view(num_active, beam_size, -1)
+        if trace_attention:
+            for trace, attention_weights in zip(traces, (attention_weights_command, attention_weights_situation)):
+                trace[active, :, num_steps - 1] = attention_weights.view(num_active, beam_size, -1)
+
+        # extending a hypothesis with <EOS> finishes it, if the extension is among the beam_size best ones
+        worst_kept = candidates.view(num_active, -1).topk(beam_size, dim=1)[0][:, -1:]
+        eos_candidates = candidates[:, :, eos_idx].masked_fill(candidates[:, :, eos_idx] < worst_kept, float('-inf'))
+        finished_scores, finished_beams = (eos_candidates / num_steps ** length_normalization).max(dim=1)
+        improved = finished_scores > best_scores[active]
+        if bool(improved.any()):
+            rows, beams = active[improved], finished_beams[improved]
+            best_scores[rows] = finished_scores[improved]
+            best_tokens[rows] = tokens[rows, beams]
+            best_tokens[rows, num_steps] = eos_idx
+            best_contexts[rows] = contexts[improved, beams]
+            if trace_attention:
+                for trace, best_trace in zip(traces, best_traces):
+                    best_trace[rows] = trace[rows, beams]
+
+        # the beam_size best extensions by other tokens stay unfinished
+        candidates[:, :, eos_idx] = float('-inf')
+        scores, candidate_index = candidates.view(num_active, -1).topk(beam_size, dim=1)
+        beams, candidate_tokens = candidate_index // candidates.size(2), candidate_index % candidates.size(2)
+        tokens[active] = tokens[active[:, None], beams]
+        tokens[active, :, num_steps] = candidate_tokens
+        contexts_situation[active] = contexts.gather(1, beams[:, :, None].expand(-1, -1, situation_length))
+        if trace_attention:
+            for trace in traces:
+                trace[active] = trace[active[:, None], beams]
+        hypotheses = (beams + torch.arange(num_active, device=beams.device)[:, None] * beam_size).view(-1)
+        hidden = tuple(state.index_select(1, hypotheses) for state in hidden)
+
+        # log-probabilities only decrease, so a hypothesis scores at most its current log-probability normalized by
+        # the longest length it can reach
+        bound = scores[:, 0] / (max_decoding_steps if length_normalization > 0 else num_steps) ** length_normalization
+        unfinished = bound > best_scores[active]
+        num_unfinished = int(unfinished.sum())
+        if num_unfinished == 0:
+            break
+        if num_unfinished < num_active:
+            keep = unfinished.nonzero().squeeze(1)
+            active, scores = active[keep], scores[keep]
+            hypotheses = (keep[:, None] * beam_size + torch.arange(beam_size, device=keep.device)).view(-1)
+            hidden = tuple(state.index_select(1, hypotheses) for state in hidden)
+            projected_keys_textual = projected_keys_textual.index_select(0, keep)
+            projected_keys_visual = projected_keys_visual.index_select(0, keep)
+            command_lengths, situations_lengths = command_lengths[keep], situations_lengths[keep]
+
+    # examples without a finished hypothesis after max_decoding_steps fall back to their best unfinished one
+    unfinished = active[torch.isinf(best_scores[active])]
+    best_tokens[unfinished] = tokens[unfinished, 0]
+    best_contexts[unfinished] = contexts_situation[unfinished, 0]
+    attention_weights_commands, attention_weights_situations = None, None
+    if trace_attention:
+        for trace, best_trace in zip(traces, best_traces):
+            best_trace[unfinished] = trace[unfinished, 0]
+        attention_weights_commands, attention_weights_situations = \
+            [best_trace[:, :num_steps].transpose(0, 1).cpu().numpy() for best_trace in best_traces]
+    return best_tokens[:, :num_steps + 1], attention_weights_commands, attention_weights_situations, best_contexts
+
+
 def predict(data_iterator: Iterator, model: nn.Module, max_decoding_steps: int, pad_idx: int, sos_idx: int,
-            eos_idx: int, max_examples_to_evaluate=None) -> torch.Tensor:
+            eos_idx: int, max_examples_to_evaluate=None, beam_size=None, trace_attention=False) -> torch.Tensor:
     """
     Loop over all data in data_iterator and predict until <EOS> token is reached.
     :param data_iterator: iterator containing the data to predict
@@ -202,7 +402,14 @@ def predict(data_iterator: Iterator, model: nn.Module, max_decoding_steps: int,
     :param sos_idx: the start-of-sequence idx of the target vocabulary
     :param eos_idx: the end-of-sequence idx of the target vocabulary
     :param: max_examples_to_evaluate: after how many examples to break prediction, if none all are predicted
+    :param beam_size: hypotheses kept per example, greedy decoding if 1; cfg.TEST.BEAM_SIZE by default
+    :param trace_attention: whether to record the attention weights of the predictions, see greedy_decode and
+    beam_search_decode
+    :return: per batch, the batch, the predicted tokens and the targets (cut after max_decoding_steps) with the same
+    width so that they compare position by position, the [num_steps, batch_size, ...] command and situation attention
+    weights (numpy arrays, None unless traced) and the auxiliary accuracy
     """
+    beam_size = beam_size or cfg.TEST.BEAM_SIZE
     # Disable dropout and other regularization.
     model.eval()
     start_time = time.time()
@@ -214,79 +421,79 @@ def predict(data_iterator: Iterator, model: nn.Module, max_decoding_steps: int,
         batchsize = x.input[0].shape[0]
         if max_examples_to_evaluate and i * batchsize > max_examples_to_evaluate: break
 
-        hidden, encoded_commands, \
-        command_lengths, encoded_situations, situations_lengths = model.encode_input(x.input, x.situation)
-
-        projected_keys_visual = model.decoder.attentionDecoder.visual_attention.key_layer(
-            encoded_situations)  # [batch_size, situation_length, dec_hidden_dim]
-        projected_keys_textual = model.decoder.attentionDecoder.textual_attention.key_layer(
-            encoded_commands)  # [max_input_length, batch_size, dec_hidden_dim]
-
-        hidden = model.decoder.attentionDecoder.initialize_hidden(
-            model.decoder.tanh(model.decoder.enc_hidden_to_dec_hidden(hidden))
-        )
-
-        contexts_situation = []
-        '''
-        #\TODO: this initialize hidden state from encoder output.
-        hidden = model.attention_decoder.initialize_hidden(
-            model.tanh(model.enc_hidden_to_dec_hidden(encoded_input["hidden_states"])))
-        '''
-
-        output_tokens = torch.zeros((batchsize, 1), dtype=torch.long, device=device) + sos_idx
-        decoding_iteration = 0
-        attention_weights_commands = []
-        attention_weights_situations = []
-
-        real_decoding_steps = min(max_decoding_steps, x.target[0].shape[1] - 1)
-        while decoding_iteration < real_decoding_steps:
-            (output, hidden, context_situation, attention_weights_command,
-             attention_weights_situation) = model.decoder.attentionDecoder.forward_step(
-                input_tokens=output_tokens[:, -1], last_hidden=hidden, encoded_commands=projected_keys_textual,
-                commands_lengths=command_lengths, encoded_situations=projected_keys_visual,
-                situations_lengths=situations_lengths)
-            output = F.log_softmax(output, dim=-1)
-            token = output.max(dim=-1)[1]
-            output_tokens = torch.cat([output_tokens, token.unsqueeze(1)], dim=1)
-            attention_weights_commands.append(attention_weights_command.tolist())
-            attention_weights_situations.append(attention_weights_situation.tolist())
-            contexts_situation.append(context_situation.unsqueeze(1))
-            decoding_iteration += 1
+        # decoding never looks at the targets, they only bound the width of what is compared to them
+        if beam_size > 1:
+            decoded = beam_search_decode(model, x.input, x.situation, max_decoding_steps=max_decoding_steps,
+                                         pad_idx=pad_idx, sos_idx=sos_idx, eos_idx=eos_idx, beam_size=beam_size,
+                                         length_normalization=cfg.TEST.LENGTH_NORMALIZATION,
+                                         trace_attention=trace_attention)
+        else:
+            decoded = greedy_decode(model, x.input, x.situation, max_decoding_steps=max_decoding_steps,
+                                    pad_idx=pad_idx, sos_idx=sos_idx, eos_idx=eos_idx, trace_attention=trace_attention)
+        output_tokens, attention_weights_commands, attention_weights_situations, contexts_situation = decoded
+        target_tokens = x.target[0][:, :max_decoding_steps + 1]
+        if output_tokens.size(1) < target_tokens.size(1):
+            output_tokens = F.pad(output_tokens, [0, target_tokens.size(1) - output_tokens.size(1)], value=pad_idx)
+        output_tokens = output_tokens[:, :target_tokens.size(1)]
 
         if model.auxiliary_task:
-            target_position_scores = model.auxiliary_task_forward(torch.cat(contexts_situation, dim=1).sum(dim=1))
+            target_position_scores = model.auxiliary_task_forward(contexts_situation)
             auxiliary_accuracy_target = model.get_auxiliary_accuracy(target_position_scores,
                                                                      x.target)
         else:
             auxiliary_accuracy_target = 0
-        yield (x, output_tokens, x.target[0][:, :real_decoding_steps + 1], attention_weights_commands,
+        yield (x, output_tokens, target_tokens, attention_weights_commands,
                attention_weights_situations, auxiliary_accuracy_target)
 
     elapsed_time = time.time() - start_time
     logging.info("Done predicting in {} seconds.".format(elapsed_time))
 
 
+class MetricsAccumulator(object):
+    """
+    Token accuracy, exact match and target accuracy counters of predict()'s outputs, kept as tensors on the device of
+    the predictions so that no batch waits for the host; result() reads them back once.
+    """
+
+    def __init__(self, pad_idx, sos_idx):
+        self.pad_idx = pad_idx
+        self.sos_idx = sos_idx
+        self.counters = None  # correct terms, total terms, exact matches
+        self.target_accuracy = 0.
+        self.num_examples = 0
+        self.num_batches = 0
+
+    def update(self, output_sequence, target_sequence, target_accuracy=0.):
+        """
+        :param output_sequence: [batch_size, length] predicted tokens, compared position by position to target_sequence
+        :param target_sequence: [batch_size, length] targets, <PAD> and <SOS> positions are not scored
+        :param target_accuracy: auxiliary target accuracy of the batch, a number or a tensor
+        """
+        mask = torch.eq(target_sequence, self.pad_idx) | torch.eq(target_sequence, self.sos_idx)
+        correct = torch.eq(output_sequence, target_sequence).masked_fill(mask, 0).sum(dim=-1)
+        total = (~mask).sum(dim=-1)
+        counters = torch.stack([correct.sum(), total.sum(), (correct.eq(total) & total.gt(0)).sum()])
+        self.counters = counters if self.counters is None else self.counters + counters
+        self.target_accuracy = self.target_accuracy + target_accuracy
+        self.num_examples += output_sequence.size(0)
+        self.num_batches += 1
+
+    def result(self):
+        """:return: token accuracy, exact match and mean target accuracy over the batches, in percent"""
+        if self.counters is None:
+            return 0., 0., 0.
+        correct_terms, total_terms, exact_match = self.counters.tolist()
+        return (float(correct_terms) / total_terms) * 100, (exact_match / self.num_examples) * 100, \
+               float(self.target_accuracy) / self.num_batches * 100
+
+
 def evaluate(data_iterator, model, max_decoding_steps, pad_idx, sos_idx, eos_idx, max_examples_to_evaluate=None):
-    target_accuracies = []
-    exact_match = 0
-    num_examples = 0
-    correct_terms = 0
-    total_terms = 0
+    metrics = MetricsAccumulator(pad_idx, sos_idx)
     for batch, output_sequence, target_sequence, _, _, aux_acc_target in predict(
             data_iterator=data_iterator, model=model, max_decoding_steps=max_decoding_steps, pad_idx=pad_idx,
             sos_idx=sos_idx, eos_idx=eos_idx, max_examples_to_evaluate=max_examples_to_evaluate):
-        num_examples += output_sequence.shape[0]
-        seq_eq = torch.eq(output_sequence, target_sequence)
-        mask = torch.eq(target_sequence, pad_idx) + torch.eq(target_sequence, sos_idx)
-        seq_eq.masked_fill_(mask, 0)
-        total = (~mask).sum(-1).float()
-        accuracy = seq_eq.sum(-1) / total
-        total_terms += total.sum().data.item()
-        correct_terms += seq_eq.sum().data.item()
-        exact_match += accuracy.eq(1.).sum().data.item()
-        target_accuracies.append(aux_acc_target)
-    return (float(correct_terms) / total_terms) * 100, (exact_match / num_examples) * 100, \
-           float(np.mean(np.array(target_accuracies))) * 100
+        metrics.update(output_sequence, target_sequence, aux_acc_target)
+    return metrics.result()
 
 
 def translate_sequence(seq: np.array, itos: list, eos_idx: int) -> list:
@@ -0,0 +1,179 @@
+# TODO: use test framework instead of asserts
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from model.model import GSCAN_model
+from model.situation import SITUATION_CATEGORIES, situation_features
+from model.utils import beam_search_decode, greedy_decode
+
+logger = logging.getLogger(__name__)
+
+TEST_INPUT_VOCAB_SIZE = 12
+TEST_TARGET_VOCAB_SIZE = 7
+TEST_PAD_IDX, TEST_SOS_IDX, TEST_EOS_IDX = 1, 2, 3
+TEST_COMMAND_LENGTHS = [4, 6, 3]
+TEST_GRID_SIZE = 6
+
+
+def decoding_inputs(command_lengths, grid_size):
+    """:return: random (commands, command lengths) and [batch_size, grid_size, grid_size, 16] one-hot worlds"""
+    batch_size = len(command_lengths)
+    command_lengths = torch.tensor(command_lengths, dtype=torch.long)
+    commands = torch.randint(2, TEST_INPUT_VOCAB_SIZE, (batch_size, int(command_lengths.max())))
+    commands.masked_fill_(torch.arange(commands.size(1))[None, :] >= command_lengths[:, None], TEST_PAD_IDX)
+    categories = torch.stack([torch.randint(0, num_categories, (batch_size, grid_size, grid_size))
+                              for num_categories in SITUATION_CATEGORIES], dim=-1)
+    return (commands, command_lengths), situation_features(categories).float()
+
+
+def exhaustive_search(model, input_batch, situation_batch, max_decoding_steps, eos_idx, length_normalization):
+    """
+    :return: per example, the sequence <SOS> ... <EOS> of at most max_decoding_steps tokens after <SOS> with the
+    highest log-probability / length ** length_normalization, found by expanding every prefix
+    """
+    hidden, encoded_commands, \
+    command_lengths, encoded_situations, situations_lengths = model.encode_input(input_batch, situation_batch)
+    attention_decoder = model.decoder.attentionDecoder
+    projected_keys_visual = attention_decoder.visual_attention.key_layer(encoded_situations)
+    projected_keys_textual = attention_decoder.textual_attention.key_layer(encoded_commands)
+    hidden = attention_decoder.initialize_hidden(model.decoder.tanh(model.decoder.enc_hidden_to_dec_hidden(hidden)))
+    command_lengths = torch.as_tensor(command_lengths)
+    situations_lengths = torch.as_tensor(situations_lengths)
+    best_sequences = []
+    for row in range(projected_keys_visual.size(0)):
+        prefixes = torch.full((1, 1), TEST_SOS_IDX, dtype=torch.long)
+        log_probabilities = torch.zeros(1)
+        row_hidden = tuple(state[:, row:row + 1] for state in hidden)
+        best_score, best_sequence = float('-inf'), None
+        for num_steps in range(1, max_decoding_steps + 1):
+            output, row_hidden, _, _, _ = attention_decoder.forward_step(
+                input_tokens=prefixes[:, -1], last_hidden=row_hidden,
+                encoded_commands=projected_keys_textual[row:row + 1], commands_lengths=command_lengths[row:row + 1],
+                encoded_situations=projected_keys_visual[row:row + 1],
+                situations_lengths=situations_lengths[row:row + 1], beam_size=prefixes.size(0))
+            candidates = log_probabilities[:, None] + F.log_softmax(output, dim=-1)
+            finished_score, finished_prefix = (candidates[:, eos_idx] / num_steps ** length_normalization).max(dim=0)
+            if float(finished_score) > best_score:
+                best_score = float(finished_score)
+                best_sequence = prefixes[finished_prefix].tolist() + [eos_idx]
+            candidates[:, eos_idx] = float('-inf')
+            extended, tokens = (candidates > float('-inf')).nonzero(as_tuple=True)
+            prefixes = torch.cat([prefixes[extended], tokens[:, None]], dim=1)
+            log_probabilities = candidates[extended, tokens]
+            row_hidden = tuple(state.index_select(1, extended) for state in row_hidden)
+        best_sequences.append(best_sequence)
+    return best_sequences
+
+
+def sequence_attention(model, input_batch, situation_batch, sequences, num_steps):
+    """
+    :param sequences: per example, <SOS> ... <EOS> tokens
+    :return: [num_steps, batch_size, max_input_length] command and [num_steps, batch_size, situation_length] situation
+    attention weights of decoding every sequence, zeros after its <EOS>
+    """
+    hidden, encoded_commands, \
+    command_lengths, encoded_situations, situations_lengths = model.encode_input(input_batch, situation_batch)
+    attention_decoder = model.decoder.attentionDecoder
+    projected_keys_visual = attention_decoder.visual_attention.key_layer(encoded_situations)
+    projected_keys_textual = attention_decoder.textual_attention.key_layer(encoded_commands)
+    hidden = attention_decoder.initialize_hidden(model.decoder.tanh(model.decoder.enc_hidden_to_dec_hidden(hidden)))
+    traces = [np.zeros((num_steps, len(sequences), keys.size(1)), dtype=np.float32)
+              for keys in (projected_keys_textual, projected_keys_visual)]
+    for row, sequence in enumerate(sequences):
+        row_hidden = tuple(state[:, row:row + 1] for state in hidden)
+        for step, token in enumerate(sequence[:-1]):
+            _, row_hidden, _, attention_weights_command, attention_weights_situation = attention_decoder.forward_step(
+                input_tokens=torch.tensor([token]), last_hidden=row_hidden,
+                encoded_commands=projected_keys_textual[row:row + 1],
+                commands_lengths=torch.as_tensor(command_lengths)[row:row + 1],
+                encoded_situations=projected_keys_visual[row:row + 1],
+                situations_lengths=torch.as_tensor(situations_lengths)[row:row + 1])
+            traces[0][step, row] = attention_weights_command[0].numpy()
+            traces[1][step, row] = attention_weights_situation[0].numpy()
+    return traces
+
+
+def test_wide_beam_search_matches_exhaustive_search():
+    start = time.time()
+    torch.manual_seed(0)
+    model = GSCAN_model(TEST_PAD_IDX, TEST_EOS_IDX, TEST_INPUT_VOCAB_SIZE, TEST_TARGET_VOCAB_SIZE,
+                        is_baseline=True).eval()
+    input_batch, situation_batch = decoding_inputs(TEST_COMMAND_LENGTHS, TEST_GRID_SIZE)
+    max_decoding_steps = 3
+    # the beam holds every hypothesis, so beam search is exact; another <EOS> makes finishing more or less likely
+    for eos_idx in (TEST_EOS_IDX, 5):
+        for length_normalization in (0., 0.5, 1.):
+            with torch.no_grad():
+                output_tokens = beam_search_decode(model, input_batch, situation_batch, max_decoding_steps,
+                                                   TEST_PAD_IDX, TEST_SOS_IDX, eos_idx,
+                                                   beam_size=TEST_TARGET_VOCAB_SIZE ** max_decoding_steps,
+                                                   length_normalization=length_normalization)[0]
+                best_sequences = exhaustive_search(model, input_batch, situation_batch, max_decoding_steps, eos_idx,
+                                                   length_normalization)
+            for tokens, best_sequence in zip(output_tokens.tolist(), best_sequences):
+                padding = [TEST_PAD_IDX] * (len(tokens) - len(best_sequence))
+                assert tokens == best_sequence + padding, "test_wide_beam_search_matches_exhaustive_search FAILED"
+    end = time.time()
+    logger.info("test_wide_beam_search_matches_exhaustive_search PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_beam_size_one_is_greedy_decoding():
+    start = time.time()
+    torch.manual_seed(0)
+    model = GSCAN_model(TEST_PAD_IDX, TEST_EOS_IDX, TEST_INPUT_VOCAB_SIZE, TEST_TARGET_VOCAB_SIZE,
+                        is_baseline=False).eval()
+    input_batch, situation_batch = decoding_inputs(TEST_COMMAND_LENGTHS, TEST_GRID_SIZE)
+    for eos_idx in (TEST_EOS_IDX, 5):
+        with torch.no_grad():
+            greedy_tokens, *greedy_traces, greedy_contexts = greedy_decode(
+                model, input_batch, situation_batch, 10, TEST_PAD_IDX, TEST_SOS_IDX, eos_idx, trace_attention=True)
+            beam_tokens, *beam_traces, beam_contexts = beam_search_decode(
+                model, input_batch, situation_batch, 10, TEST_PAD_IDX, TEST_SOS_IDX, eos_idx, beam_size=1,
+                length_normalization=0., trace_attention=True)
+        assert torch.equal(greedy_tokens, beam_tokens), "test_beam_size_one_is_greedy_decoding FAILED"
+        assert torch.allclose(greedy_contexts, beam_contexts, atol=1e-6), "test_beam_size_one_is_greedy_decoding FAILED"
+        for greedy_trace, beam_trace in zip(greedy_traces, beam_traces):
+            assert greedy_trace.shape == beam_trace.shape and np.allclose(greedy_trace, beam_trace, atol=1e-6), \
+                "test_beam_size_one_is_greedy_decoding FAILED"
+    end = time.time()
+    logger.info("test_beam_size_one_is_greedy_decoding PASSED in {} seconds".format(end - start))
+    return
+
+
+def test_beam_search_traces_the_best_hypothesis():
+    start = time.time()
+    torch.manual_seed(0)
+    model = GSCAN_model(TEST_PAD_IDX, TEST_EOS_IDX, TEST_INPUT_VOCAB_SIZE, TEST_TARGET_VOCAB_SIZE,
+                        is_baseline=False).eval()
+    input_batch, situation_batch = decoding_inputs(TEST_COMMAND_LENGTHS, TEST_GRID_SIZE)
+    for eos_idx in (TEST_EOS_IDX, 5):
+        with torch.no_grad():
+            output_tokens, *traces, _ = beam_search_decode(model, input_batch, situation_batch, 10, TEST_PAD_IDX,
+                                                           TEST_SOS_IDX, eos_idx, beam_size=3, trace_attention=True)
+            # the attention weights follow the best hypothesis through the reordering of the beam
+            sequences = [tokens[:tokens.index(eos_idx) + 1] if eos_idx in tokens else tokens
+                         for tokens in output_tokens.tolist()]
+            expected_traces = sequence_attention(model, input_batch, situation_batch, sequences,
+                                                 output_tokens.size(1) - 1)
+        for trace, expected_trace in zip(traces, expected_traces):
+            assert trace.shape == expected_trace.shape and np.allclose(trace, expected_trace, atol=1e-6), \
+                "test_beam_search_traces_the_best_hypothesis FAILED"
+    end = time.time()
+    logger.info("test_beam_search_traces_the_best_hypothesis PASSED in {} seconds".format(end - start))
+    return
+
+
+def run_all_tests():
+    test_wide_beam_search_matches_exhaustive_search()
+    test_beam_size_one_is_greedy_decoding()
+    test_beam_search_traces_the_best_hypothesis()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    run_all_tests()
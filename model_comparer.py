@@ -2,7 +2,8 @@ import argparse
 import os
 
 from GroundedScan.dataset import GroundedScan
-from dataloader import dataloader
+from dataloader import Vocabulary, dataloader, memmap_dataloader
+from dataset_cache import cached_dataloader
 from model.config import cfg
 from model.model import GSCAN_model
 from model.utils import *
@@ -39,9 +40,9 @@ def predict_and_write(data_iterator, model, example_indicator, max_decoding_step
         for batch, output_sequence, target_sequence, _, attention_weights_situations, \
             aux_acc_target in predict(data_iterator=data_iterator, model=model, max_decoding_steps=max_decoding_steps,
                                       pad_idx=pad_idx, sos_idx=sos_idx, eos_idx=eos_idx,
-                                      max_examples_to_evaluate=None):
+                                      max_examples_to_evaluate=None, trace_attention=True):
             # output_sequence: bs x max_decoding_steps
-            batchsize = batch.situation.shape[0]
+            batchsize = batch.input[0].shape[0]
             batch_indicator = example_indicator[indicator_idx:indicator_idx + batchsize]
             situation_idx_offsets = batch_indicator.nonzero()
             if batch_indicator.sum() == 0:
@@ -57,7 +58,7 @@ def predict_and_write(data_iterator, model, example_indicator, max_decoding_step
             selected_target = select_and_convert(target_sequence[:, 1:])
             target_tokens = translate_sequence(selected_target, target_vocab.itos, eos_idx=target_vocab.stoi['<eos>'])
 
-            selected_attn_sit = np.array(attention_weights_situations)[:, batch_indicator.cpu().numpy(), :]
+            selected_attn_sit = attention_weights_situations[:, batch_indicator.cpu().numpy(), :]
 
             for i in range(len(selected_input)):
                 situation_idx = indicator_idx + situation_idx_offsets[i]
@@ -76,41 +77,32 @@ def predict_and_write(data_iterator, model, example_indicator, max_decoding_step
 
 
 def evaluate(data_iterator, model, max_decoding_steps, pad_idx, sos_idx, eos_idx, max_examples_to_evaluate=None):
-    target_accuracies = []
-    exact_match = 0
-    num_examples = 0
-    correct_terms = 0
-    total_terms = 0
+    metrics = MetricsAccumulator(pad_idx, sos_idx)
     for input_sequence, output_sequence, target_sequence, _, _, aux_acc_target in predict(
             data_iterator=data_iterator, model=model, max_decoding_steps=max_decoding_steps, pad_idx=pad_idx,
             sos_idx=sos_idx, eos_idx=eos_idx, max_examples_to_evaluate=max_examples_to_evaluate):
-        num_examples += output_sequence.shape[0]
-        seq_eq = torch.eq(output_sequence, target_sequence)
-        mask = torch.eq(target_sequence, pad_idx) + torch.eq(target_sequence, sos_idx)
-        # torch.eq(target_sequence, eos_idx)
-        seq_eq.masked_fill_(mask, 0)
-        total = (~mask).sum(-1).float()
-        accuracy = seq_eq.sum(-1) / total
-        total_terms += total.sum().data.item()
-        correct_terms += seq_eq.sum().data.item()
-        exact_match += accuracy.eq(1.).sum().data.item()
-        target_accuracies.append(aux_acc_target)
-    return (float(correct_terms) / total_terms) * 100, (exact_match / num_examples) * 100, \
-           float(np.mean(np.array(target_accuracies))) * 100
+        metrics.update(output_sequence, target_sequence, aux_acc_target)
+    return metrics.result()
 
 
 def train(train_data_path: str, val_data_paths: dict, use_cuda: bool):
     device = torch.device(type='cuda') if use_cuda else torch.device(type='cpu')
 
+    load_data = {"json": dataloader, "memmap": memmap_dataloader, "cached": cached_dataloader}[cfg.DATA_FORMAT]
+    input_vocab, target_vocab = None, None
+    if cfg.LOAD_VOCABULARIES:
+        input_vocab, target_vocab = Vocabulary.load(cfg.INPUT_VOCAB_PATH), Vocabulary.load(cfg.TARGET_VOCAB_PATH)
     logger.info("Loading Training set...")
-    train_iter, train_input_vocab, train_target_vocab = dataloader(train_data_path,
-                                                                   batch_size=cfg.TRAIN.BATCH_SIZE,
-                                                                   use_cuda=use_cuda)
+    train_iter, train_input_vocab, train_target_vocab = load_data(train_data_path,
+                                                                  batch_size=cfg.TRAIN.BATCH_SIZE,
+                                                                  use_cuda=use_cuda,
+                                                                  input_vocab=input_vocab, target_vocab=target_vocab,
+                                                                  sparse_situations=cfg.SPARSE_SITUATIONS)
     val_iters = {}
     for split_name, path in val_data_paths.items():
-        val_iters[split_name], _, _ = dataloader(path, batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
-                                                 input_vocab=train_input_vocab, target_vocab=train_target_vocab,
-                                                 random_shuffle=False)
+        val_iters[split_name], _, _ = load_data(path, batch_size=cfg.VAL_BATCH_SIZE, use_cuda=use_cuda,
+                                                input_vocab=train_input_vocab, target_vocab=train_target_vocab,
+                                                random_shuffle=False, sparse_situations=cfg.SPARSE_SITUATIONS)
 
     pad_idx, sos_idx, eos_idx = train_target_vocab.stoi['<pad>'], train_target_vocab.stoi['<sos>'], \
                                 train_target_vocab.stoi['<eos>']
@@ -173,12 +165,16 @@ def main(flags, use_cuda):
     if not os.path.exists(cfg.OUTPUT_DIRECTORY):
         os.mkdir(os.path.join(os.getcwd(), cfg.OUTPUT_DIRECTORY))
 
-    train_data_path = os.path.join(cfg.DATA_DIRECTORY, "train.json")
+    if cfg.DATA_FORMAT == "memmap":
+        data_directory, extension = cfg.MEMMAP_DIRECTORY, ''
+    else:
+        data_directory, extension = cfg.DATA_DIRECTORY, '.json'
+    train_data_path = os.path.join(data_directory, "train" + extension)
 
     test_splits = [
         'adverb_2',
     ]
-    val_data_paths = {split_name: os.path.join(cfg.DATA_DIRECTORY, split_name + '.json') for split_name in test_splits}
+    val_data_paths = {split_name: os.path.join(data_directory, split_name + extension) for split_name in test_splits}
 
     if cfg.MODE == "train":
         train(train_data_path=train_data_path, val_data_paths=val_data_paths, use_cuda=use_cuda)
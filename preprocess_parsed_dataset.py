@@ -1,10 +1,150 @@
+import argparse
 import json
+import logging
+import multiprocessing
+import os
 
 # first parse the dataset following https://github.com/LauraRuis/multimodal_seq2seq_gSCAN/tree/master/read_gscan
 # then runs this script
+#
+# parsed_dataset.txt is one JSON object {split: [example, ...]} holding every split with full situations. It is walked
+# incrementally: only the current example is ever decoded, so memory stays flat for multi-GB files.
 
-d = json.load(open('parsed_dataset/parsed_dataset.txt', 'r'))
-for split, data in d.items():
-    with open('parsed_dataset/' + split + '.json', 'w') as f:
-        for line in data:
-            f.write(json.dumps(line) + '\n')
+logger = logging.getLogger(__name__)
+
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStream(object):
+    """Minimal incremental reader for the structure of parsed_dataset.txt (an object of arrays of objects)."""
+
+    def __init__(self, f, chunk_size=1 << 22):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self):
+        data = self.f.read(self.chunk_size)
+        if not data:
+            return False
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                raise ValueError("Unexpected end of file.")
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("Expected one of '{}' but found '{}'.".format(characters, character))
+        self.position += 1
+        return character
+
+    def decode(self):
+        """:return: the next JSON value and its source text."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                break
+            except json.JSONDecodeError:
+                # the value is cut off at the end of the buffer
+                if not self.read_more():
+                    raise
+        text = self.buffer[self.position:end]
+        self.position = end
+        return value, text
+
+    def splits(self):
+        """Yields (split name, example source text) in file order, and (split name, None) for an empty split."""
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            split, _ = self.decode()
+            self.expect(':')
+            self.expect('[')
+            if self.peek() == ']':
+                self.position += 1
+                yield split, None
+            else:
+                while True:
+                    _, text = self.decode()
+                    yield split, text
+                    if self.expect(',]') == ']':
+                        break
+            if self.expect(',}') == '}':
+                return
+
+
+def write_jsonl(dataset_path, output_directory):
+    """Writes <split>.json (one example per line) for every split, streaming. :return: example count per split."""
+    counts = {}
+    output, current_split = None, None
+    with open(dataset_path, 'r') as f:
+        for split, text in JSONStream(f).splits():
+            if split != current_split:
+                if output is not None:
+                    output.close()
+                    logger.info("Wrote {} examples of split {}.".format(counts[current_split], current_split))
+                output, current_split = open(os.path.join(output_directory, split + '.json'), 'w'), split
+                counts[split] = 0
+            if text is None:
+                continue
+            # newlines can only be whitespace between tokens in JSON, so this keeps the example valid
+            output.write(text.replace('\n', ' ').replace('\r', ' ') + '\n')
+            counts[split] += 1
+    if output is not None:
+        output.close()
+        logger.info("Wrote {} examples of split {}.".format(counts[current_split], current_split))
+    return counts
+
+
+def convert_to_memmap(split, data_directory, output_directory):
+    from build_memmap_dataset import convert_split
+    from dataloader import Vocabulary
+
+    input_vocab = Vocabulary.load(os.path.join(output_directory, 'input_vocab.json'))
+    target_vocab = Vocabulary.load(os.path.join(output_directory, 'target_vocab.json'))
+    return split, convert_split(os.path.join(data_directory, split + '.json'), os.path.join(output_directory, split),
+                                input_vocab, target_vocab)
+
+
+def main(flags):
+    counts = write_jsonl(flags.dataset_path, flags.output_directory)
+    if flags.memmap_directory:
+        from build_memmap_dataset import build_vocabularies
+
+        os.makedirs(flags.memmap_directory, exist_ok=True)
+        input_vocab, target_vocab = build_vocabularies(os.path.join(flags.output_directory, 'train.json'))
+        input_vocab.save(os.path.join(flags.memmap_directory, 'input_vocab.json'))
+        target_vocab.save(os.path.join(flags.memmap_directory, 'target_vocab.json'))
+        # each split is encoded by its own process; every writer streams its split, so memory stays per-example
+        with multiprocessing.Pool(flags.workers) as pool:
+            tasks = [pool.apply_async(convert_to_memmap, (split, flags.output_directory, flags.memmap_directory))
+                     for split, num_examples in counts.items() if num_examples > 0]
+            for task in tasks:
+                split, num_examples = task.get()
+                logger.info("Converted {} examples of split {} to {}.".format(num_examples, split,
+                                                                            flags.memmap_directory))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split parsed_dataset.txt into one .json file per split")
+    parser.add_argument('--dataset_path', type=str, default='parsed_dataset/parsed_dataset.txt')
+    parser.add_argument('--output_directory', type=str, default='parsed_dataset/')
+    parser.add_argument('--memmap_directory', type=str, default='',
+                        help='Also convert every split to the memmap format (see build_memmap_dataset.py).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of splits converted to memmap in parallel.')
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s", level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M")
+    main(args)